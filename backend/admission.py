@@ -0,0 +1,275 @@
+"""Admission control: which tool processes may start now, given per-tool, memory and CPU limits."""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .metrics import ADMISSION_REJECTED, ADMISSION_WAIT, TOOL_WAITING
+
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))
+# How often callers waiting for a slot held by another worker process check again
+MACHINE_SLOT_POLL = 0.1
+
+# How long the current request may wait for a tool slot; None waits as long
+# as it takes (background jobs are already queued, so they never shed)
+admission_max_wait: ContextVar[float | None] = ContextVar('admission_max_wait', default=ADMISSION_MAX_WAIT)
+
+
+def detect_memory_mb() -> int:
+    """Memory this process may use: the cgroup limit if there is one, else physical RAM."""
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        total = 4 * 1024 ** 3
+    for limit_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(limit_file) as f:
+                total = min(total, int(f.read().strip()))
+            break
+        except (OSError, ValueError):
+            continue
+    return total // (1024 * 1024)
+
+
+def detect_cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 2
+
+
+class MachineSlots:
+    """Tool slots shared by the worker processes of one machine.
+
+    Slot i of a tool is an flock on directory/{tool}-{i}.lock. The OS drops
+    the locks of a process that dies, so a crashed worker can't leak slots.
+    Nothing wakes a process when another frees a slot, so try_acquire never
+    blocks and waiting callers poll.
+    """
+
+    def __init__(self, directory: str, limits: dict):
+        self.directory = directory
+        self.limits = limits
+        # tool -> {slot index: locked file descriptor}
+        self._held = {tool: {} for tool in limits}
+
+    @staticmethod
+    def supported() -> bool:
+        return fcntl is not None
+
+    def try_acquire(self, tool: str) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        held = self._held[tool]
+        for index in range(self.limits[tool]):
+            if index in held:
+                continue
+            fd = os.open(os.path.join(self.directory, f'{tool}-{index}.lock'), os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            held[index] = fd
+            return True
+        return False
+
+    def release(self, tool: str):
+        _, fd = self._held[tool].popitem()
+        # Closing the descriptor drops its lock
+        os.close(fd)
+
+
+class AdmissionController:
+    """Admits tool processes within per-tool, memory and CPU limits.
+
+    Callers are served in arrival order, except that one may go ahead of
+    earlier callers waiting for a different tool that is at its limit. None
+    goes ahead of an earlier caller for the same tool, or of one waiting for
+    memory or CPU, so large processes aren't starved by small ones. When too
+    many are waiting a new caller gets a 429, and one that waits longer than
+    its budget gets a 503, both with a Retry-After estimated from recent run
+    times.
+
+    With machine slots, the tool limits are shared with the other worker
+    processes; memory, CPU and the queue are this process's own.
+    """
+
+    def __init__(
+        self, limits: dict, memory_mb: dict, memory_budget_mb: int, cpu_budget: int, max_queue: int,
+        machine: MachineSlots = None,
+    ):
+        self.limits = {tool: max(1, limit) for tool, limit in limits.items()}
+        self.memory_mb = memory_mb
+        self.memory_budget_mb = memory_budget_mb
+        self.cpu_budget = max(1, cpu_budget)
+        self.max_queue = max_queue
+        self.machine = machine
+        self.running = dict.fromkeys(limits, 0)
+        self.admitted = dict.fromkeys(limits, 0)
+        self.rejected = dict.fromkeys(limits, 0)
+        self.avg_seconds = dict.fromkeys(limits, 10.0)
+        self.memory_used_mb = 0
+        self.cpu_used = 0
+        self._waiters = []
+
+    def waiting(self, tool: str = None) -> int:
+        return sum(1 for waiting_tool, _ in self._waiters if tool is None or waiting_tool == tool)
+
+    def available(self, tool: str) -> int:
+        """Slots of tool a new caller could take now without queueing, as far as this process can tell."""
+        return max(0, self.limits[tool] - self.running[tool] - self.waiting(tool))
+
+    def retry_after(self, tool: str) -> int:
+        """Seconds until a slot for tool is likely to be free."""
+        backlog = self.waiting(tool) + 1
+        return max(1, round(self.avg_seconds[tool] * backlog / self.limits[tool]))
+
+    def reject(self, tool: str, status_code: int, reason: str):
+        self.rejected[tool] += 1
+        ADMISSION_REJECTED.labels(tool, reason).inc()
+        raise HTTPException(
+            status_code=status_code,
+            detail="Server is busy. Please try again shortly.",
+            headers={'Retry-After': str(self.retry_after(tool))},
+        )
+
+    def check(self, tool: str):
+        """Shed a new request up front if the wait queue is already full."""
+        if admission_max_wait.get() is not None and self.waiting() >= self.max_queue:
+            self.reject(tool, 429, 'queue_full')
+
+    def _fits(self, tool: str) -> bool:
+        if self.running[tool] >= self.limits[tool]:
+            return False
+        if not any(self.running.values()):
+            # Always let one process run, even if its cost exceeds the budget
+            return True
+        return (
+            self.memory_used_mb + self.memory_mb[tool] <= self.memory_budget_mb
+            and self.cpu_used + 1 <= self.cpu_budget
+        )
+
+    def _grant(self, tool: str):
+        self.running[tool] += 1
+        self.admitted[tool] += 1
+        self.memory_used_mb += self.memory_mb[tool]
+        self.cpu_used += 1
+
+    def _dispatch(self):
+        """Grant every waiting caller that may start now, in arrival order."""
+        blocked_tools, budget_blocked = set(), False
+        for waiter in list(self._waiters):
+            tool, future = waiter
+            if tool in blocked_tools:
+                continue
+            if not budget_blocked and self._fits(tool):
+                if self.machine is None or self.machine.try_acquire(tool):
+                    self._waiters.remove(waiter)
+                    self._grant(tool)
+                    future.set_result(None)
+                    continue
+                # Every slot is taken by other worker processes
+                blocked_tools.add(tool)
+                continue
+            blocked_tools.add(tool)
+            if self.running[tool] < self.limits[tool]:
+                # Waiting for memory or CPU, which every later caller needs too
+                budget_blocked = True
+
+    def _release(self, tool: str):
+        if self.machine is not None:
+            self.machine.release(tool)
+        self.running[tool] -= 1
+        self.memory_used_mb -= self.memory_mb[tool]
+        self.cpu_used -= 1
+        self._dispatch()
+
+    async def _acquire(self, tool: str):
+        max_wait = admission_max_wait.get()
+        future = asyncio.get_running_loop().create_future()
+        waiter = (tool, future)
+        self._waiters.append(waiter)
+        self._dispatch()
+        if future.done():
+            return
+        if max_wait is not None and self.waiting() > self.max_queue:
+            self._waiters.remove(waiter)
+            self.reject(tool, 429, 'queue_full')
+
+        TOOL_WAITING.labels(tool).inc()
+        start = time.monotonic()
+        try:
+            await self._wait(future, max_wait)
+        except asyncio.CancelledError:
+            if future.done():
+                self._release(tool)
+            else:
+                self._waiters.remove(waiter)
+                self._dispatch()
+            raise
+        finally:
+            TOOL_WAITING.labels(tool).dec()
+            ADMISSION_WAIT.labels(tool).observe(time.monotonic() - start)
+
+        if not future.done():
+            self._waiters.remove(waiter)
+            # Callers held back behind this one may start now
+            self._dispatch()
+            self.reject(tool, 503, 'wait_timeout')
+
+    async def _wait(self, future: asyncio.Future, max_wait: float | None):
+        """Wait up to max_wait seconds (None: as long as it takes) for future to be granted."""
+        if self.machine is None:
+            await asyncio.wait({future}, timeout=max_wait)
+            return
+        # Slots freed by other processes wake nobody here, so check again now and then
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while not future.done():
+            timeout = MACHINE_SLOT_POLL
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return
+            await asyncio.wait({future}, timeout=timeout)
+            if not future.done():
+                self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, tool: str):
+        """Hold one of tool's slots for the duration of the block."""
+        await self._acquire(tool)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            # Exponential moving average of how long a slot is held
+            self.avg_seconds[tool] = 0.8 * self.avg_seconds[tool] + 0.2 * (time.monotonic() - start)
+            self._release(tool)
+
+    def stats(self) -> dict:
+        return {
+            'tools': {
+                tool: {
+                    'running': self.running[tool],
+                    'waiting': self.waiting(tool),
+                    'limit': self.limits[tool],
+                    'admitted': self.admitted[tool],
+                    'rejected': self.rejected[tool],
+                    'avg_seconds': round(self.avg_seconds[tool], 3),
+                }
+                for tool in self.limits
+            },
+            'memory_mb': {'used': self.memory_used_mb, 'budget': self.memory_budget_mb},
+            'cpu': {'used': self.cpu_used, 'budget': self.cpu_budget},
+            'waiting': self.waiting(),
+            'max_queue': self.max_queue,
+            'max_wait': ADMISSION_MAX_WAIT,
+        }
@@ -0,0 +1,536 @@
+"""Benchmark harness for the PDF2.in API.
+
+Generates a reproducible corpus (text-heavy, scanned and form PDFs, plus
+DOCX files) and times every API operation against it, either in-process
+through FastAPI's TestClient or against a running server.
+
+Usage:
+    python backend/benchmark.py                         # in-process
+    python backend/benchmark.py --url http://localhost:8000 --server-pid 1234
+    python backend/benchmark.py --sizes small,medium --concurrency 1,4 --repeat 5
+    python backend/benchmark.py --output after.json --compare before.json
+    python backend/benchmark.py --check-parallel --sizes large
+    python backend/benchmark.py --compare-gs-engines --sizes small
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Pages per document for each corpus size
+SIZES = {'small': 2, 'medium': 20, 'large': 100}
+PDF_KINDS = ('text', 'scanned', 'form')
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat."
+).split()
+
+
+def make_pdf(pages: int, kind: str, seed: int = 0) -> bytes:
+    """Build a PDF by hand so the corpus needs no third-party libraries."""
+    rng = random.Random(f'{kind}-{pages}-{seed}')
+    objects = {}
+    page_ids = []
+    field_ids = []
+    next_id = 4  # 1: catalog, 2: pages, 3: font
+
+    def add(body: bytes) -> int:
+        nonlocal next_id
+        objects[next_id] = body
+        next_id += 1
+        return next_id - 1
+
+    def stream(data: bytes, extra: str = '') -> bytes:
+        return f'<< /Length {len(data)} {extra}>>\nstream\n'.encode() + data + b'\nendstream'
+
+    objects[3] = b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+
+    for page_number in range(pages):
+        resources = '/Font << /F1 3 0 R >>'
+        annots = ''
+
+        if kind == 'scanned':
+            # Noisy greyscale "scan" at roughly 100 dpi
+            width, height = 850, 1100
+            base = rng.randint(200, 240)
+            rows = bytearray()
+            for _ in range(height):
+                rows.extend(min(255, max(0, base + rng.randint(-40, 15))) for _ in range(width))
+            image = zlib.compress(bytes(rows), 6)
+            image_id = add(stream(
+                image,
+                f'/Type /XObject /Subtype /Image /Width {width} /Height {height} '
+                '/ColorSpace /DeviceGray /BitsPerComponent 8 /Filter /FlateDecode ',
+            ))
+            resources += f' /XObject << /Im1 {image_id} 0 R >>'
+            content = b'q 612 0 0 792 0 0 cm /Im1 Do Q'
+        else:
+            lines = []
+            for line in range(60):
+                words = ' '.join(rng.choice(LOREM) for _ in range(14))
+                lines.append(f'BT /F1 9 Tf 40 {760 - line * 12} Td ({words}) Tj ET')
+            content = '\n'.join(lines).encode()
+
+        if kind == 'form':
+            widgets = []
+            for field in range(5):
+                y = 700 - field * 120
+                field_id = add(
+                    f'<< /Type /Annot /Subtype /Widget /FT /Tx /T (field{page_number}_{field}) '
+                    f'/V (value {field}) /Rect [300 {y} 560 {y + 20}] /F 4 >>'.encode()
+                )
+                widgets.append(field_id)
+                field_ids.append(field_id)
+            annots = f'/Annots [{" ".join(f"{i} 0 R" for i in widgets)}]'
+
+        content_id = add(stream(zlib.compress(content), '/Filter /FlateDecode '))
+        page_ids.append(add(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            f'/Resources << {resources} >> /Contents {content_id} 0 R {annots}>>'.encode()
+        ))
+
+    acroform = ''
+    if field_ids:
+        acroform = f'/AcroForm << /Fields [{" ".join(f"{i} 0 R" for i in field_ids)}] >>'
+    objects[1] = f'<< /Type /Catalog /Pages 2 0 R {acroform}>>'.encode()
+    objects[2] = (
+        f'<< /Type /Pages /Kids [{" ".join(f"{i} 0 R" for i in page_ids)}] /Count {len(page_ids)} >>'
+    ).encode()
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = out.tell()
+        out.write(f'{obj_id} 0 obj\n'.encode() + objects[obj_id] + b'\nendobj\n')
+    xref = out.tell()
+    out.write(f'xref\n0 {next_id}\n0000000000 65535 f \n'.encode())
+    for obj_id in range(1, next_id):
+        out.write(f'{offsets[obj_id]:010d} 00000 n \n'.encode())
+    out.write(f'trailer\n<< /Size {next_id} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+    return out.getvalue()
+
+
+def make_docx(pages: int, seed: int = 0) -> bytes:
+    """Build a minimal DOCX with roughly `pages` pages of text."""
+    rng = random.Random(f'docx-{pages}-{seed}')
+    paragraphs = []
+    for _ in range(pages * 8):
+        text = ' '.join(rng.choice(LOREM) for _ in range(60))
+        paragraphs.append(f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>')
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ))
+        zf.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="word/document.xml"/>'
+            '</Relationships>'
+        ))
+        zf.writestr('word/document.xml', (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{"".join(paragraphs)}</w:body></w:document>'
+        ))
+    return out.getvalue()
+
+
+def build_corpus(sizes: list[str]) -> list[dict]:
+    corpus = []
+    for size in sizes:
+        for kind in PDF_KINDS:
+            corpus.append({
+                'name': f'{kind}-{size}.pdf',
+                'kind': kind,
+                'size': size,
+                'content': make_pdf(SIZES[size], kind),
+            })
+        corpus.append({
+            'name': f'document-{size}.docx',
+            'kind': 'docx',
+            'size': size,
+            'content': make_docx(SIZES[size]),
+        })
+    return corpus
+
+
+# (name, endpoint, form fields, input kind)
+SCENARIOS = [
+    *[(f'compress-{q}', '/api/compress', {'quality': q}, 'pdf') for q in ('low', 'medium', 'high', 'maximum')],
+    ('compress-images-medium', '/api/compress', {'quality': 'medium', 'engine': 'images'}, 'pdf'),
+    ('lock', '/api/lock', {'password': 'benchmark'}, 'pdf'),
+    ('unlock', '/api/unlock', {'password': 'benchmark'}, 'pdf'),
+    ('pipeline-compress-lock', '/api/pipeline', {'steps': json.dumps([
+        {'operation': 'compress', 'quality': 'medium'},
+        {'operation': 'lock', 'password': 'benchmark'},
+    ])}, 'pdf'),
+    ('pdf-to-docx', '/api/pdf-to-docx', {}, 'pdf'),
+    ('pdf-to-docx-native', '/api/pdf-to-docx', {'engine': 'native'}, 'pdf'),
+    ('pdf-to-docx-calibre', '/api/pdf-to-docx', {'engine': 'calibre'}, 'pdf'),
+    ('docx-to-pdf', '/api/docx-to-pdf', {}, 'docx'),
+]
+
+
+def import_app():
+    """Import the app in-process, whichever directory the benchmark is run from."""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from backend import main
+
+    return main
+
+
+class InProcessClient:
+    """Calls the app through FastAPI's TestClient, bypassing the network."""
+
+    def __init__(self):
+        from fastapi.testclient import TestClient
+
+        main = import_app()
+        self.client = TestClient(main.app)
+        self.client.__enter__()
+
+    def post(self, endpoint: str, filename: str, content: bytes, fields: dict) -> tuple[int, bytes]:
+        response = self.client.post(endpoint, files={'file': (filename, content)}, data=fields)
+        return response.status_code, response.content
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+
+class HTTPClient:
+    """Calls a running server over HTTP using only the standard library."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip('/')
+
+    def post(self, endpoint: str, filename: str, content: bytes, fields: dict) -> tuple[int, bytes]:
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, value in fields.items():
+            body.write(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'.encode()
+        )
+        body.write(content)
+        body.write(f'\r\n--{boundary}--\r\n'.encode())
+
+        request = urllib.request.Request(
+            self.base_url + endpoint,
+            data=body.getvalue(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def close(self):
+        pass
+
+
+def peak_rss_bytes(server_pid: int = None) -> dict:
+    """Peak resident memory of the server process and of its tool subprocesses, where the platform reports it."""
+    if server_pid:
+        try:
+            with open(f'/proc/{server_pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return {'server': int(line.split()[1]) * 1024}
+        except OSError:
+            pass
+        return {}
+
+    if resource is None:
+        return {}
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return {
+        'server': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'largest_tool': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(client, scenario, document: dict, repeat: int, concurrency: int, server_pid: int) -> dict:
+    name, endpoint, fields, _ = scenario
+
+    def call(i: int) -> tuple[float, int, int]:
+        start_time = time.perf_counter()
+        status, body = client.post(endpoint, document['name'], document['content'], fields)
+        return time.perf_counter() - start_time, status, len(body)
+
+    # Identical repeats would be served from the result cache, or share a run
+    # already in flight. Both are off while the cache is disabled: in-process
+    # runs disable it, and a server under test should set RESULT_CACHE_MAX_BYTES=0
+    calls = repeat * concurrency
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(calls)))
+    wall_time = time.perf_counter() - wall_start
+
+    latencies = [r[0] for r in results]
+    ok = [r for r in results if r[1] == 200]
+    return {
+        'scenario': name,
+        'document': document['name'],
+        'kind': document['kind'],
+        'size': document['size'],
+        'input_bytes': len(document['content']),
+        'output_bytes': statistics.median(r[2] for r in ok) if ok else None,
+        'concurrency': concurrency,
+        'calls': calls,
+        'errors': calls - len(ok),
+        'statuses': sorted({r[1] for r in results}),
+        'latency': {
+            'min': min(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies),
+        },
+        'throughput': calls / wall_time if wall_time else None,
+        'peak_rss': peak_rss_bytes(server_pid),
+    }
+
+
+def compare(results: list[dict], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {
+        (r['scenario'], r['document'], r['concurrency']): r for r in baseline['results']
+    }
+
+    print(f"\n{'scenario':<26}{'document':<22}{'conc':>5}{'p50 before':>12}{'p50 after':>12}{'change':>9}")
+    for r in results:
+        old = previous.get((r['scenario'], r['document'], r['concurrency']))
+        if not old:
+            continue
+        before, after = old['latency']['p50'], r['latency']['p50']
+        change = (after - before) / before * 100 if before else 0
+        print(f"{r['scenario']:<26}{r['document']:<22}{r['concurrency']:>5}"
+              f"{before:>11.3f}s{after:>11.3f}s{change:>+8.1f}%")
+
+
+async def check_parallel_compress(corpus: list[dict], chunks: int) -> bool:
+    """Compress every PDF single-pass and page-parallel and compare the outputs.
+
+    Returns False if any parallel output is missing pages or fails.
+    """
+    main = import_app()
+
+    await asyncio.to_thread(main.tool_registry.refresh)
+    ok = True
+
+    async def compress(path: str, work_dir: str, quality: str, parallel: bool):
+        main.PARALLEL_COMPRESS_MIN_BYTES = 0 if parallel else sys.maxsize
+        main.PARALLEL_COMPRESS_MIN_PAGES = 2
+        main.PARALLEL_COMPRESS_CHUNK_PAGES = 1
+        main.PARALLEL_COMPRESS_MAX_CHUNKS = chunks
+        start = time.perf_counter()
+        result = await main.compress_file(path, work_dir, quality)
+        return result, time.perf_counter() - start, await main.count_pdf_pages(result.path)
+
+    for document in corpus:
+        if document['kind'] == 'docx':
+            continue
+        for quality in main.QUALITY_SETTINGS:
+            work_dir = tempfile.mkdtemp(prefix='benchmark_')
+            try:
+                input_path = os.path.join(work_dir, document['name'])
+                with open(input_path, 'wb') as f:
+                    f.write(document['content'])
+                os.makedirs(os.path.join(work_dir, 'single'))
+                os.makedirs(os.path.join(work_dir, 'parallel'))
+                single, single_time, single_pages = await compress(
+                    input_path, os.path.join(work_dir, 'single'), quality, False)
+                parallel, parallel_time, parallel_pages = await compress(
+                    input_path, os.path.join(work_dir, 'parallel'), quality, True)
+            except Exception as e:
+                print(f"{document['name']:<22}{quality:<9}FAILED: {e}")
+                ok = False
+                continue
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+            single_size = int(single.headers['X-Compressed-Size'])
+            parallel_size = int(parallel.headers['X-Compressed-Size'])
+            match = single_pages == parallel_pages == SIZES[document['size']]
+            ok = ok and match
+            print(
+                f"{document['name']:<22}{quality:<9}pages {single_pages}/{parallel_pages} "
+                f"chunks={parallel.headers['X-Compression-Chunks']} "
+                f"size {single_size}B/{parallel_size}B ({parallel_size / max(single_size, 1):.2f}x) "
+                f"time {single_time:.2f}s/{parallel_time:.2f}s {'OK' if match else 'MISMATCH'}"
+            )
+    return ok
+
+
+async def compare_ghostscript_engines(corpus: list[dict], calls: int) -> bool:
+    """Time Ghostscript operations on the gs CLI and on libgs workers.
+
+    Prints the median time per call for each engine and the overhead the
+    libgs workers save. Returns False if the libgs engine can't be used.
+    """
+    main = import_app()
+
+    await asyncio.to_thread(main.tool_registry.refresh)
+    operations = {
+        'count-pages': lambda path, work_dir: main.count_pdf_pages(path),
+        'compress': lambda path, work_dir: main.compress_file(path, work_dir, 'medium'),
+        'lock': lambda path, work_dir: main.lock_file(path, work_dir, 'benchmark'),
+        'flatten': lambda path, work_dir: main.flatten_pdf_with_ghostscript(path, os.path.join(work_dir, 'flat.pdf')),
+    }
+    documents = [document for document in corpus if document['kind'] != 'docx']
+    timings = {}
+
+    for engine in ('cli', 'libgs'):
+        if engine == 'libgs':
+            await main.ghostscript_pool.start()
+            if not main.ghostscript_pool.enabled:
+                print("libgs engine unavailable (install libgs or set LIBGS_PATH)")
+                return False
+        for document in documents:
+            input_dir = tempfile.mkdtemp(prefix='benchmark_')
+            input_path = os.path.join(input_dir, document['name'])
+            with open(input_path, 'wb') as f:
+                f.write(document['content'])
+            try:
+                for name, operation in operations.items():
+                    times = []
+                    for _ in range(calls):
+                        work_dir = tempfile.mkdtemp(prefix='benchmark_')
+                        try:
+                            start = time.perf_counter()
+                            await operation(input_path, work_dir)
+                            times.append(time.perf_counter() - start)
+                        finally:
+                            shutil.rmtree(work_dir, ignore_errors=True)
+                    timings[document['name'], name, engine] = statistics.median(times)
+            finally:
+                shutil.rmtree(input_dir, ignore_errors=True)
+    await main.ghostscript_pool.stop()
+
+    print(f"{'document':<22}{'operation':<13}{'cli p50':>10}{'libgs p50':>11}{'saved':>10}")
+    for document in documents:
+        for name in operations:
+            cli, libgs = timings[document['name'], name, 'cli'], timings[document['name'], name, 'libgs']
+            print(f"{document['name']:<22}{name:<13}{cli * 1000:>8.1f}ms{libgs * 1000:>9.1f}ms"
+                  f"{(cli - libgs) * 1000:>+8.1f}ms")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Benchmark a running server instead of the app in-process")
+    parser.add_argument('--server-pid', type=int, help="PID of the server, to report its peak RSS with --url")
+    parser.add_argument('--sizes', default='small,medium', help=f"Comma-separated from {list(SIZES)}")
+    parser.add_argument('--scenarios', help="Comma-separated scenario names (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="Calls per worker for each scenario")
+    parser.add_argument('--concurrency', default='1,4', help="Comma-separated concurrency levels")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--compare', help="Print p50 changes against a previous JSON result file")
+    parser.add_argument('--check-parallel', type=int, nargs='?', const=4, metavar='CHUNKS',
+                        help="Compare page-parallel compression against a single pass, then exit")
+    parser.add_argument('--compare-gs-engines', type=int, nargs='?', const=20, metavar='CALLS',
+                        help="Time Ghostscript calls on the gs CLI and on libgs workers, then exit")
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(',')
+    unknown = set(sizes) - set(SIZES)
+    if unknown:
+        parser.error(f"Unknown sizes: {sorted(unknown)}")
+
+    if args.check_parallel:
+        sys.exit(0 if asyncio.run(check_parallel_compress(build_corpus(sizes), args.check_parallel)) else 1)
+    if args.compare_gs_engines:
+        sys.exit(0 if asyncio.run(compare_ghostscript_engines(build_corpus(sizes), args.compare_gs_engines)) else 1)
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        wanted = set(args.scenarios.split(','))
+        scenarios = [s for s in SCENARIOS if s[0] in wanted]
+
+    if not args.url:
+        # Repeats must measure the work, not the result cache
+        os.environ.setdefault('RESULT_CACHE_MAX_BYTES', '0')
+
+    corpus = build_corpus(sizes)
+    client = HTTPClient(args.url) if args.url else InProcessClient()
+    results = []
+    try:
+        for scenario in scenarios:
+            input_kind = scenario[3]
+            for document in corpus:
+                if (document['kind'] == 'docx') != (input_kind == 'docx'):
+                    continue
+                for concurrency in (int(c) for c in args.concurrency.split(',')):
+                    result = run_scenario(client, scenario, document, args.repeat, concurrency, args.server_pid)
+                    results.append(result)
+                    output = f"{result['output_bytes']:>10.0f}B" if result['output_bytes'] else ' ' * 11
+                    print(
+                        f"{result['scenario']:<26}{result['document']:<22}c={concurrency:<3}"
+                        f"p50={result['latency']['p50']:.3f}s p90={result['latency']['p90']:.3f}s "
+                        f"{result['throughput']:.2f}req/s {result['input_bytes']:>10}B ->{output} "
+                        f"errors={result['errors']}"
+                    )
+    finally:
+        client.close()
+
+    report = {
+        'created_at': time.time(),
+        'target': args.url or 'in-process',
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""On-disk cache of operation results keyed by content hash."""
+import asyncio
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def link_or_copy(src: str, dst: str):
+    """Hard link src to dst, copying when they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def call_params(func, params: dict, skip: tuple[str, ...] = ()) -> dict:
+    """params with the defaults of func's other parameters filled in, leaving out those named in skip.
+
+    A call that relies on a default and one that passes the same value
+    explicitly do the same work, so they should share a cache key.
+    """
+    filled = dict(params)
+    for name, parameter in inspect.signature(func).parameters.items():
+        if name not in filled and name not in skip and parameter.default is not inspect.Parameter.empty:
+            filled[name] = parameter.default
+    return filled
+
+
+class ResultCache:
+    """On-disk cache of operation outputs keyed by input hash + operation + parameters.
+
+    Each entry is a result file plus a JSON sidecar holding its creation time
+    and response metadata. The result file's mtime is bumped on every hit and
+    used for LRU eviction once the cache exceeds max_bytes.
+
+    The size of the cache is kept as a running total, so a write only scans
+    the directory when the total passes max_bytes, or once every
+    rescan_interval seconds to pick up what other processes wrote.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: int, rescan_interval: float = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.rescan_interval = rescan_interval
+        # Bytes of result files, as of the last scan plus writes since; None until scanned
+        self._total = None
+        self._scanned_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(input_digest: str, operation: str, versions: dict = None, settings: dict = None, **params) -> str:
+        """The key for an operation's result on an input.
+
+        versions holds the versions of the tools the operation runs on, so
+        results made by an older version stop matching after an upgrade;
+        settings does the same for server settings that change the output.
+        """
+        payload = json.dumps([input_digest, operation, versions or {}, settings or {}, params], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + '.bin', base + '.json'
+
+    def _get(self, key: str, dest_path: str):
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if time.time() - meta['created'] > self.ttl:
+                self._remove(key)
+                return None
+            # Hard link when possible so eviction can't pull the file out from
+            # under a response that is still streaming it
+            link_or_copy(data_path, dest_path)
+            os.utime(data_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return meta['result']
+
+    def _put(self, key: str, src_path: str, result: dict, evict: bool = True):
+        os.makedirs(self.directory, exist_ok=True)
+        data_path, meta_path = self._paths(key)
+        tmp_path = f'{data_path}.{uuid.uuid4().hex}.tmp'
+        shutil.copyfile(src_path, tmp_path)
+        size = os.path.getsize(tmp_path) - self._size(data_path)
+        os.replace(tmp_path, data_path)
+        if self._total is not None:
+            self._total += size
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'result': result}, f)
+        os.replace(tmp_path, meta_path)
+        if evict:
+            self._evict_if_needed()
+
+    @staticmethod
+    def _size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _remove(self, key: str):
+        size = self._size(self._paths(key)[0])
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self._total is not None:
+            self._total = max(0, self._total - size)
+
+    def _evict_if_needed(self):
+        if self._total is None or self._total > self.max_bytes \
+                or time.time() - self._scanned_at > self.rescan_interval:
+            self._evict()
+
+    def _evict(self):
+        """Scan the directory, removing expired entries and then the least recently used until under max_bytes."""
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.bin'):
+                continue
+            key = entry.name[:-4]
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove(key)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, key))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            total -= size
+        self._total = total
+        self._scanned_at = now
+
+    async def get(self, key: str, dest_path: str):
+        """Copy a cached result to dest_path. Returns its metadata, or None on a miss."""
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self._get, key, dest_path)
+
+    async def put(self, key: str, src_path: str, result: dict):
+        """Store src_path and its metadata as the result for key. Failures are logged, not raised."""
+        if not self.enabled:
+            return
+        try:
+            await asyncio.to_thread(self._put, key, src_path, result)
+        except OSError as e:
+            logger.warning(f"Result cache write failed: {e}")
+
+    async def put_many(self, items: list[tuple[str, str, dict]]):
+        """Store several (key, src_path, metadata) results, evicting once at the end."""
+        if not self.enabled:
+            return
+
+        def put_all():
+            for key, src_path, result in items:
+                self._put(key, src_path, result, evict=False)
+            self._evict_if_needed()
+
+        try:
+            await asyncio.to_thread(put_all)
+        except OSError as e:
+            logger.warning(f"Result cache write failed: {e}")
@@ -0,0 +1,163 @@
+"""Ghostscript worker process for the libgs engine.
+
+Loads the Ghostscript shared library once and runs Ghostscript invocations
+through its C API, so each call skips the fork/exec, dynamic linking and
+start-up of a fresh gs binary. main.py keeps a pool of these processes.
+
+Usage: python gs_worker.py LIBGS_PATH [--version]
+
+After start-up the worker writes one JSON line with the library version,
+then reads one request per line on stdin, with the arguments that would
+follow "gs" on a command line:
+
+    {"args": ["-q", "-dNOPAUSE", "-dBATCH", ..., "input.pdf"], "cpu_limit": 300}
+
+and answers each with one line on stdout:
+
+    {"returncode": 0, "stdout": "...", "stderr": "...", "cpu_time": 0.12, "max_rss": 52428800}
+"""
+import ctypes
+import json
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+GS_ARG_ENCODING_UTF8 = 1
+# Returned by a clean "quit"; not an error
+GS_ERROR_QUIT = -101
+
+STDIO_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int)
+
+
+class Revision(ctypes.Structure):
+    _fields_ = [
+        ('product', ctypes.c_char_p),
+        ('copyright', ctypes.c_char_p),
+        ('revision', ctypes.c_long),
+        ('revisiondate', ctypes.c_long),
+    ]
+
+
+def load_library(path: str) -> ctypes.CDLL:
+    lib = ctypes.CDLL(path)
+    lib.gsapi_revision.argtypes = [ctypes.POINTER(Revision), ctypes.c_int]
+    lib.gsapi_new_instance.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p]
+    lib.gsapi_set_stdio.argtypes = [ctypes.c_void_p, STDIO_CALLBACK, STDIO_CALLBACK, STDIO_CALLBACK]
+    lib.gsapi_set_arg_encoding.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.gsapi_init_with_args.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_char_p)]
+    lib.gsapi_exit.argtypes = [ctypes.c_void_p]
+    lib.gsapi_delete_instance.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+def version(lib: ctypes.CDLL) -> str:
+    revision = Revision()
+    if lib.gsapi_revision(ctypes.byref(revision), ctypes.sizeof(revision)) != 0:
+        return ''
+    major, minor = divmod(revision.revision, 1000)
+    return f"{major}.{minor // 10:02d}.{minor % 10}"
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    # Linux: writing 5 resets the VmHWM high-water mark read below
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def run(lib: ctypes.CDLL, args: list[str]) -> tuple[int, str, str]:
+    """Run one Ghostscript invocation on a fresh instance. Returns (returncode, stdout, stderr)."""
+    stdout, stderr = [], []
+
+    def reader(_handle, _buffer, _length):
+        return 0  # stdin is empty, as with stdin=DEVNULL
+
+    def writer(chunks):
+        def write(_handle, data, length):
+            chunks.append(ctypes.string_at(data, length))
+            return length
+        return write
+
+    # Kept referenced until the instance is deleted
+    callbacks = (STDIO_CALLBACK(reader), STDIO_CALLBACK(writer(stdout)), STDIO_CALLBACK(writer(stderr)))
+
+    instance = ctypes.c_void_p()
+    code = lib.gsapi_new_instance(ctypes.byref(instance), None)
+    if code < 0:
+        return 1, '', f"gsapi_new_instance failed with {code}"
+    try:
+        lib.gsapi_set_stdio(instance, *callbacks)
+        lib.gsapi_set_arg_encoding(instance, GS_ARG_ENCODING_UTF8)
+        argv = [b'gs'] + [arg.encode() for arg in args]
+        code = lib.gsapi_init_with_args(instance, len(argv), (ctypes.c_char_p * len(argv))(*argv))
+        exit_code = lib.gsapi_exit(instance)
+        if code in (0, GS_ERROR_QUIT):
+            code = exit_code
+    finally:
+        lib.gsapi_delete_instance(instance)
+
+    returncode = 0 if code in (0, GS_ERROR_QUIT) else 1
+    return returncode, b''.join(stdout).decode(errors='replace'), b''.join(stderr).decode(errors='replace')
+
+
+def main():
+    lib = load_library(sys.argv[1])
+    if '--version' in sys.argv[2:]:
+        print(version(lib))
+        return
+
+    # Keep the protocol on its own descriptor; anything written straight to
+    # fd 1 (not through the stdio callbacks) ends up on stderr instead
+    protocol = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    # Warm up: the first instance loads fonts and resources into memory
+    run(lib, ['-q', '-dSAFER', '-dNODISPLAY', '-dBATCH', '-dNOPAUSE', '-c', 'quit'])
+    protocol.write(json.dumps({'version': version(lib)}) + '\n')
+    protocol.flush()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        if resource is not None and request.get('cpu_limit'):
+            # The CPU limit counts over the process's life, so move it along per call
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = int(cpu_seconds()) + request['cpu_limit']
+            if hard == resource.RLIM_INFINITY or soft <= hard:
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        reset_peak_rss()
+        start_cpu = cpu_seconds() if resource is not None else None
+        returncode, out, err = run(lib, request['args'])
+        protocol.write(json.dumps({
+            'returncode': returncode,
+            'stdout': out,
+            'stderr': err,
+            'cpu_time': cpu_seconds() - start_cpu if start_cpu is not None else None,
+            'max_rss': peak_rss(),
+        }) + '\n')
+        protocol.flush()
+
+
+if __name__ == '__main__':
+    main()
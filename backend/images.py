@@ -0,0 +1,513 @@
+"""The images compression engine: each distinct image stored once, re-encoded to suit its content."""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+
+from fastapi import HTTPException
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    from PIL import Image, ImageChops, features as pil_features
+except ImportError:
+    Image = ImageChops = pil_features = None
+
+from .admission import AdmissionController
+from .jobs import report_progress
+from .metrics import IMAGE_BYTES_SAVED
+from .pages import expand_page_ranges, format_page_list, parse_page_ranges
+
+logger = logging.getLogger(__name__)
+
+
+def engine_available() -> bool:
+    """Whether pypdf and Pillow, which the engine needs, are installed."""
+    return pypdf is not None and Image is not None
+
+
+def engine_version() -> str | None:
+    """The pypdf and Pillow versions the engine runs on, or None if it can't run."""
+    if not engine_available():
+        return None
+    return f'pypdf {pypdf.__version__}, Pillow {Image.__version__}'
+
+
+@dataclass(frozen=True)
+class ImagePreset:
+    """How the images compression engine treats images at one quality."""
+    jpeg_quality: int
+    resolution: int       # target dpi for colour and gray images
+    mono_resolution: int  # target dpi for black-and-white images
+    bilevel: bool         # store near black-and-white images with 1 bit per pixel
+
+
+# Modelled on the Ghostscript presets (QUALITY_SETTINGS in main.py)
+IMAGE_PRESETS = {
+    'low': ImagePreset(jpeg_quality=40, resolution=72, mono_resolution=300, bilevel=True),
+    'medium': ImagePreset(jpeg_quality=60, resolution=150, mono_resolution=300, bilevel=True),
+    'high': ImagePreset(jpeg_quality=80, resolution=300, mono_resolution=1200, bilevel=True),
+    'maximum': ImagePreset(jpeg_quality=90, resolution=300, mono_resolution=1200, bilevel=False),
+}
+# As Ghostscript's DownsampleThreshold: only images drawn at more than this
+# multiple of the target resolution are downsampled
+IMAGE_DOWNSAMPLE_THRESHOLD = 1.5
+# Images with less encoded data than this are not worth re-encoding
+IMAGE_MIN_BYTES = int(os.environ.get('IMAGE_MIN_BYTES', 2048))
+# Share of a gray image's pixels that must be near black or white for it to
+# be stored as black and white
+IMAGE_BILEVEL_MIN_SHARE = float(os.environ.get('IMAGE_BILEVEL_MIN_SHARE', 0.97))
+# Gray images with at most this many levels are palette-like, as charts,
+# and stay lossless; any with more, as scans, are also tried as JPEG
+IMAGE_PALETTE_MAX_GRAYS = 16
+# Colour images whose channels differ by at most this on 99.9% of pixels are stored as gray
+IMAGE_GRAY_TOLERANCE = 16
+# Images listed in the X-Image-Report header, largest savings first
+IMAGE_REPORT_MAX = 20
+# Image dictionary entries that describe the encoding, replaced when re-encoding
+IMAGE_ENCODING_KEYS = {
+    '/Length', '/Filter', '/DecodeParms', '/DL', '/Width', '/Height', '/BitsPerComponent', '/ColorSpace',
+}
+# Image dictionary entries that don't change how an image looks
+IMAGE_HASH_IGNORED_KEYS = {'/Length', '/Name', '/Metadata', '/StructParent'}
+# Filters whose data is left alone: already compact, or not decodable here
+IMAGE_KEPT_FILTERS = {'/JPXDecode', '/JBIG2Decode', '/CCITTFaxDecode'}
+IDENTITY_MATRIX = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+MAX_FORM_DEPTH = 3
+
+
+@dataclass
+class IndexedImage:
+    """A distinct image in a PDF, with every copy of it and every use."""
+    ref: object  # the copy kept in the output
+    width: int
+    height: int
+    copies: set = field(default_factory=set)  # object numbers of identical copies
+    uses: dict = field(default_factory=dict)  # (id(XObject dict), name) -> (XObject dict, name)
+    pages: set = field(default_factory=set)
+    original_bytes: int = 0  # encoded size of all copies
+    dpi: float = None  # lowest resolution it is drawn at, when known
+    codec: str = 'original'
+    bytes: int = 0  # encoded size in the output
+
+
+def pdf_get(dictionary, key: str, default=None):
+    """dictionary[key] with an indirect reference resolved, or default."""
+    value = dictionary.get(key)
+    return default if value is None else value.get_object()
+
+
+def multiply_matrices(m: tuple, n: tuple) -> tuple:
+    """Product of two PDF matrices [a b c d e f]: m applied first, then n."""
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return (
+        a * a2 + b * c2, a * b2 + b * d2,
+        c * a2 + d * c2, c * b2 + d * d2,
+        e * a2 + f * c2 + e2, e * b2 + f * d2 + f2,
+    )
+
+
+def image_digest(image) -> str:
+    """Content hash of an image XObject: its encoded data plus the entries that affect how it looks."""
+    digest = hashlib.sha256(image._data)
+    for key in sorted(image):
+        if key not in IMAGE_HASH_IGNORED_KEYS:
+            digest.update(f'{key}={image.raw_get(key)!r};'.encode())
+    return digest.hexdigest()
+
+
+def index_images(writer) -> list[IndexedImage]:
+    """Find the images used on writer's pages, grouping identical copies by content hash.
+
+    The page and form content streams are also read to work out the lowest
+    resolution each image is drawn at.
+    """
+    by_digest, by_object, form_operations = {}, {}, {}
+
+    def register(ref, image, xobjects, name: str, page_number: int) -> IndexedImage:
+        indexed = by_object.get(ref.idnum)
+        if indexed is None:
+            digest = image_digest(image)
+            indexed = by_digest.get(digest)
+            if indexed is None:
+                indexed = by_digest[digest] = IndexedImage(
+                    ref, int(pdf_get(image, '/Width', 0)), int(pdf_get(image, '/Height', 0))
+                )
+            indexed.copies.add(ref.idnum)
+            indexed.original_bytes += len(image._data)
+            by_object[ref.idnum] = indexed
+        indexed.uses[(id(xobjects), name)] = (xobjects, name)
+        indexed.pages.add(page_number)
+        return indexed
+
+    def operations_of(form):
+        if id(form) not in form_operations:
+            form_operations[id(form)] = pypdf.generic.ContentStream(form, writer).operations
+        return form_operations[id(form)]
+
+    def visit(resources, operations, ctm: tuple, page_number: int, depth: int):
+        xobjects = pdf_get(resources.get_object(), '/XObject') if resources is not None else None
+        if xobjects is None:
+            return
+        images = {}
+        for name in list(xobjects):
+            ref = xobjects.raw_get(name)
+            if isinstance(ref, pypdf.generic.IndirectObject) and ref.get_object().get('/Subtype') == '/Image':
+                images[name] = register(ref, ref.get_object(), xobjects, name, page_number)
+
+        stack = []
+        for operands, operator in operations or ():
+            if operator == b'q':
+                stack.append(ctm)
+            elif operator == b'Q':
+                ctm = stack.pop() if stack else ctm
+            elif operator == b'cm' and len(operands) == 6:
+                ctm = multiply_matrices(tuple(float(value) for value in operands), ctm)
+            elif operator == b'Do' and operands and operands[0] in images:
+                # The image fills the unit square, so the CTM scale is its size in points
+                indexed = images[operands[0]]
+                width, height = math.hypot(ctm[0], ctm[1]), math.hypot(ctm[2], ctm[3])
+                if width > 0 and height > 0:
+                    dpi = min(indexed.width * 72 / width, indexed.height * 72 / height)
+                    indexed.dpi = dpi if indexed.dpi is None else min(indexed.dpi, dpi)
+            elif operator == b'Do' and operands and depth < MAX_FORM_DEPTH:
+                form = pdf_get(xobjects, operands[0])
+                if form is not None and form.get('/Subtype') == '/Form':
+                    matrix = tuple(float(value) for value in pdf_get(form, '/Matrix', IDENTITY_MATRIX))
+                    visit(
+                        form.get('/Resources', resources), operations_of(form),
+                        multiply_matrices(matrix, ctm), page_number, depth + 1,
+                    )
+
+    for number, page in enumerate(writer.pages, 1):
+        resources = page.get('/Resources')
+        try:
+            contents = page.get_contents()
+            visit(resources, contents.operations if contents is not None else None, IDENTITY_MATRIX, number, 0)
+        except Exception as e:
+            # Unreadable content: still index the page's images, without resolutions
+            logger.warning(f"Images: can't read the content of page {number}: {e}")
+            visit(resources, None, IDENTITY_MATRIX, number, 0)
+    return list(by_digest.values())
+
+
+def is_gray(image) -> bool:
+    """Whether an RGB image is, but for noise, gray."""
+    red, green, blue = image.split()
+    limit = image.width * image.height // 1000
+    return all(
+        sum(ImageChops.difference(a, b).histogram()[IMAGE_GRAY_TOLERANCE + 1:]) <= limit
+        for a, b in ((red, green), (green, blue))
+    )
+
+
+def is_bilevel(image) -> bool:
+    """Whether a gray image is, but for anti-aliasing, black and white."""
+    histogram = image.histogram()
+    return sum(histogram[:64]) + sum(histogram[192:]) >= IMAGE_BILEVEL_MIN_SHARE * image.width * image.height
+
+
+def png_flate(image) -> tuple[bytes, int, bytes | None]:
+    """Flate data with PNG predictors for an 8-bit image, taken from Pillow's PNG encoder.
+
+    Returns (data, bits per component, palette or None).
+    """
+    buffer = io.BytesIO()
+    # Predictors on fewer bits per sample trip up some PDF readers
+    image.save(buffer, 'PNG', optimize=True, **({'bits': 8} if image.mode == 'P' else {}))
+    png = buffer.getvalue()
+    position, idat, bits, palette = 8, [], 8, None
+    while position < len(png):
+        length, kind = struct.unpack('>I4s', png[position:position + 8])
+        chunk = png[position + 8:position + 8 + length]
+        if kind == b'IHDR':
+            bits = chunk[8]
+        elif kind == b'PLTE':
+            palette = chunk
+        elif kind == b'IDAT':
+            idat.append(chunk)
+        position += 12 + length
+    return b''.join(idat), bits, palette
+
+
+def ccitt_g4(image) -> bytes | None:
+    """CCITT Group 4 data for a 1-bit image, or None when Pillow lacks libtiff."""
+    if not pil_features.check('libtiff'):
+        return None
+    buffer = io.BytesIO()
+    # Inverted so white pixels are coded as fax white, and in one strip so
+    # the data is a single G4 stream
+    ImageChops.invert(image).save(buffer, 'TIFF', compression='group4', tiffinfo={278: image.height})
+    tiff = Image.open(buffer)
+    offsets, counts = tiff.tag_v2.get(273), tiff.tag_v2.get(279)
+    if not offsets or len(offsets) != 1:
+        return None
+    return buffer.getvalue()[offsets[0]:offsets[0] + counts[0]]
+
+
+def image_xobject(
+    source, data: bytes, size: tuple[int, int], color_space, bits: int, filter_name: str, parms: dict = None
+):
+    """A new image XObject holding data, keeping source's entries that don't describe the encoding."""
+    generic = pypdf.generic
+    stream = generic.DecodedStreamObject()
+    for key in source:
+        if key not in IMAGE_ENCODING_KEYS:
+            stream[generic.NameObject(key)] = source.raw_get(key)
+    stream[generic.NameObject('/Width')] = generic.NumberObject(size[0])
+    stream[generic.NameObject('/Height')] = generic.NumberObject(size[1])
+    stream[generic.NameObject('/ColorSpace')] = color_space
+    stream[generic.NameObject('/BitsPerComponent')] = generic.NumberObject(bits)
+    stream[generic.NameObject('/Filter')] = generic.NameObject(filter_name)
+    if parms:
+        stream[generic.NameObject('/DecodeParms')] = generic.DictionaryObject({
+            generic.NameObject(key): generic.NumberObject(value) for key, value in parms.items()
+        })
+    stream.set_data(data)
+    return stream
+
+
+def recompress_image(image, preset: ImagePreset, dpi: float | None) -> tuple[object, str] | None:
+    """Re-encode one image XObject with the codec that suits its content.
+
+    Black-and-white images get 1 bit per pixel (CCITT G4 or Flate), images
+    with few colours lossless Flate (indexed when in colour), colour photos
+    JPEG and gray photos JPEG or Flate, whichever is smaller. Images drawn
+    well above the preset's resolution are downsampled. Returns (new
+    XObject, codec) when that is smaller, else None.
+    """
+    generic = pypdf.generic
+    filters = pdf_get(image, '/Filter')
+    filters = [filters] if isinstance(filters, str) else list(filters or [])
+    if (
+        len(image._data) < IMAGE_MIN_BYTES
+        # Stencil masks; BooleanObject(False) is truthy, so compare
+        or pdf_get(image, '/ImageMask') == generic.BooleanObject(True)
+        or '/Decode' in image
+        # Colour key masking depends on the exact sample values
+        or isinstance(pdf_get(image, '/Mask'), generic.ArrayObject)
+        or IMAGE_KEPT_FILTERS.intersection(filters)
+    ):
+        return None
+
+    # Keep an ICC profile if the image keeps its number of components
+    color_space = pdf_get(image, '/ColorSpace')
+    if color_space in ('/DeviceGray', '/DeviceRGB'):
+        profile, components = None, 1 if color_space == '/DeviceGray' else 3
+    elif isinstance(color_space, generic.ArrayObject) and color_space[0] == '/ICCBased':
+        profile, components = image.raw_get('/ColorSpace'), color_space[1].get_object().get('/N')
+        if components not in (1, 3):
+            return None
+    else:
+        return None
+
+    def color_space_for(count: int):
+        if count == components and profile is not None:
+            return profile
+        return generic.NameObject('/DeviceGray' if count == 1 else '/DeviceRGB')
+
+    try:
+        picture = image.decode_as_image()
+        picture.load()
+    finally:
+        # Don't keep the decoded pixels cached on the document
+        if getattr(image, 'decoded_self', None) is not None:
+            image.decoded_self = None
+    if picture.mode in ('LA', 'RGBA'):
+        # A soft mask is applied as alpha; it stays a separate image here
+        picture = picture.convert(picture.mode[:-1])
+    if picture.mode not in ('1', 'L', 'RGB'):
+        return None
+    if picture.mode == 'RGB' and is_gray(picture):
+        picture = picture.convert('L')
+
+    bilevel = picture.mode == '1' or (preset.bilevel and picture.mode == 'L' and is_bilevel(picture))
+    target = preset.mono_resolution if bilevel else preset.resolution
+    if dpi and dpi > target * IMAGE_DOWNSAMPLE_THRESHOLD:
+        scale = target / dpi
+        size = (max(1, round(picture.width * scale)), max(1, round(picture.height * scale)))
+        picture = (picture.convert('L') if picture.mode == '1' else picture).resize(size, Image.Resampling.LANCZOS)
+    if bilevel and picture.mode != '1':
+        picture = picture.convert('1', dither=Image.Dither.NONE)
+
+    # (codec, data, color space, bits per component, filter, decode parms)
+    candidates = []
+    size = picture.size
+    if picture.mode == '1':
+        g4 = ccitt_g4(picture)
+        if g4 is not None:
+            candidates.append(('ccitt', g4, color_space_for(1), 1, '/CCITTFaxDecode', {
+                '/K': -1, '/Columns': size[0], '/Rows': size[1],
+            }))
+        # Rows of packed bits, as PDF expects them
+        candidates.append(('flate', zlib.compress(picture.tobytes(), 9), color_space_for(1), 1, '/FlateDecode', None))
+    else:
+        # A gray image always fits in 256 colours, so count its levels instead
+        colors = picture.getcolors(256)
+        if colors is None or (picture.mode == 'L' and len(colors) > IMAGE_PALETTE_MAX_GRAYS):
+            buffer = io.BytesIO()
+            picture.save(buffer, 'JPEG', quality=preset.jpeg_quality, optimize=True)
+            count = len(picture.getbands())
+            candidates.append(('jpeg', buffer.getvalue(), color_space_for(count), 8, '/DCTDecode', None))
+        if picture.mode == 'RGB' and colors is not None:
+            # Few colours, as in slides and screenshots: lossless, with a palette
+            indexed = picture.convert('P', palette=Image.Palette.ADAPTIVE, colors=256)
+            if ImageChops.difference(indexed.convert('RGB'), picture).getbbox() is None:
+                data, bits, palette = png_flate(indexed)
+                if palette:
+                    palette = palette[:3 * (indexed.getextrema()[1] + 1)]
+                    color_space = generic.ArrayObject([
+                        generic.NameObject('/Indexed'), color_space_for(3),
+                        generic.NumberObject(len(palette) // 3 - 1), generic.ByteStringObject(palette),
+                    ])
+                    candidates.append(('indexed', data, color_space, bits, '/FlateDecode', {
+                        '/Predictor': 15, '/Colors': 1, '/BitsPerComponent': bits, '/Columns': size[0],
+                    }))
+        elif picture.mode == 'L':
+            data, bits, _ = png_flate(picture)
+            candidates.append(('flate', data, color_space_for(1), bits, '/FlateDecode', {
+                '/Predictor': 15, '/Colors': 1, '/BitsPerComponent': bits, '/Columns': size[0],
+            }))
+
+    if not candidates:
+        return None
+    codec, data, color_space, bits, filter_name, parms = min(candidates, key=lambda candidate: len(candidate[1]))
+    if len(data) >= len(image._data):
+        return None
+    return image_xobject(image, data, size, color_space, bits, filter_name, parms), codec
+
+
+def read_images(input_path: str, pages: str = None) -> tuple[object, list[IndexedImage], list[int] | None]:
+    """Load a PDF for the images engine. Returns (writer, images, selected page numbers or None)."""
+    reader = pypdf.PdfReader(input_path)
+    if reader.is_encrypted and not reader.decrypt(''):
+        raise HTTPException(status_code=400, detail="PDF is password protected. Unlock it first.")
+    numbers = None
+    if pages:
+        numbers = expand_page_ranges(parse_page_ranges(pages), len(reader.pages))
+        writer = pypdf.PdfWriter()
+        writer.append(reader, pages=[number - 1 for number in numbers])
+    else:
+        writer = pypdf.PdfWriter(clone_from=reader)
+    return writer, index_images(writer), numbers
+
+
+def write_images(writer, images: list[IndexedImage], results: list, output_path: str):
+    """Point every use of an image at its one kept copy, re-encoded if that helped, and write the PDF."""
+    for indexed, result in zip(images, results):
+        if result is None:
+            target = indexed.ref
+            indexed.bytes = len(indexed.ref.get_object()._data)
+        else:
+            stream, indexed.codec = result
+            target = writer._add_object(stream)
+            indexed.bytes = len(stream.get_data())
+            indexed.width, indexed.height = stream['/Width'], stream['/Height']
+        for xobjects, name in indexed.uses.values():
+            xobjects[name] = target
+    # Drops the copies no longer used, and merges any other identical objects
+    writer.compress_identical_objects()
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+
+async def recompress_images(images: list[IndexedImage], preset: ImagePreset, admission: AdmissionController) -> list:
+    """Run recompress_image on every image, as many at once as admission control allows."""
+    results = [None] * len(images)
+    pending = iter(range(len(images)))
+    done = 0
+
+    def recompress(indexed: IndexedImage):
+        try:
+            return recompress_image(indexed.ref.get_object(), preset, indexed.dpi)
+        except Exception as e:
+            logger.warning(f"Images: keeping image {indexed.ref.idnum} as it is: {e}")
+            return None
+
+    async def worker():
+        nonlocal done
+        for index in pending:
+            async with admission.slot('images'):
+                results[index] = await asyncio.to_thread(recompress, images[index])
+            done += 1
+            report_progress(10 + 80 * done // len(images), 'images')
+
+    # A few workers taking images in turn, rather than a slot request per image
+    workers = [asyncio.create_task(worker()) for _ in range(min(len(images), admission.limits['images']))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return results
+
+
+async def compress_images(
+    input_path: str, output_path: str, quality: str, admission: AdmissionController, pages: str = None
+) -> dict:
+    """Compress a PDF by storing each distinct image once, re-encoded to suit it.
+
+    Images are indexed by content hash so one embedded on every page is kept
+    once, then re-encoded in parallel (see recompress_image). Text and
+    vector content are copied as they are. Returns response headers that
+    report the savings, per image in X-Image-Report.
+    """
+    start_time = time.time()
+    try:
+        async with admission.slot('pypdf'):
+            writer, images, numbers = await asyncio.to_thread(read_images, input_path, pages)
+        report_progress(10, 'images')
+        results = await recompress_images(images, IMAGE_PRESETS[quality], admission)
+        report_progress(90, 'write')
+        async with admission.slot('pypdf'):
+            await asyncio.to_thread(write_images, writer, images, results, output_path)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Images compression failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Compression failed: {e}")
+
+    report = []
+    for indexed in images:
+        saved = indexed.original_bytes - indexed.bytes
+        if saved > 0:
+            IMAGE_BYTES_SAVED.labels(indexed.codec).inc(saved)
+        report.append({
+            'object': indexed.ref.idnum,
+            'copies': len(indexed.copies),
+            'pages': len(indexed.pages),
+            'width': indexed.width,
+            'height': indexed.height,
+            'codec': indexed.codec,
+            'before': indexed.original_bytes,
+            'after': indexed.bytes,
+        })
+    report.sort(key=lambda entry: entry['after'] - entry['before'])
+    saved = sum(entry['before'] - entry['after'] for entry in report)
+    logger.info(
+        f"Images: {len(images)} distinct image(s), {sum(e['codec'] != 'original' for e in report)} re-encoded, "
+        f"{saved} bytes saved in {time.time() - start_time:.2f}s"
+    )
+
+    headers = {
+        'X-Images': str(sum(entry['copies'] for entry in report)),
+        'X-Images-Unique': str(len(images)),
+        'X-Images-Recompressed': str(sum(entry['codec'] != 'original' for entry in report)),
+        'X-Image-Bytes-Saved': str(saved),
+        'X-Image-Report': json.dumps(report[:IMAGE_REPORT_MAX], separators=(',', ':')),
+    }
+    if numbers is not None:
+        headers['X-Pages'] = format_page_list(numbers)
+    return headers
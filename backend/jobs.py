@@ -0,0 +1,247 @@
+"""Persistence for background jobs, and progress reporting from the operations they run."""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from contextvars import ContextVar
+
+from .scratch import process_alive
+
+logger = logging.getLogger(__name__)
+
+# Set by the job queue while a job runs so long operations can report progress
+job_progress = ContextVar('job_progress', default=None)
+
+
+def report_progress(percent: int, stage: str):
+    callback = job_progress.get()
+    if callback is not None:
+        callback(percent, stage)
+
+
+# A running job's progress is saved at most this often
+JOB_PROGRESS_INTERVAL = 0.5
+
+
+class ProgressWriter:
+    """Saves a running job's progress, off the event loop and at most once per interval.
+
+    Used as an async context manager around the operation: reports made
+    inside it only record the latest (percent, stage), which one task
+    writes to the store, so an operation reporting per page or per image
+    costs a write per interval rather than a blocking write per report.
+    """
+
+    def __init__(self, store: 'JobStore', job_id: str, interval: float = JOB_PROGRESS_INTERVAL):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self._latest = None
+        self._written = None
+        self._changed = asyncio.Event()
+        self._write = None
+        self._task = None
+        self._token = None
+
+    def report(self, percent: int, stage: str):
+        self._latest = (percent, stage)
+        if self._latest != self._written:
+            self._changed.set()
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            percent, stage = self._written = self._latest
+            self._write = asyncio.ensure_future(
+                asyncio.to_thread(self.store.update, self.job_id, progress=percent, stage=stage)
+            )
+            try:
+                # Shielded so close() can wait for the write instead of leaving it running
+                await asyncio.shield(self._write)
+            except sqlite3.Error as e:
+                logger.warning(f"Jobs: Failed to save progress of job {self.job_id}: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self):
+        self._token = job_progress.set(self.report)
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        job_progress.reset(self._token)
+        self._task.cancel()
+        # The job's final state is written next; a progress write landing
+        # after it would overwrite its stage
+        await asyncio.gather(self._task, *[self._write] if self._write else [], return_exceptions=True)
+
+
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    params TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    stage TEXT,
+    error TEXT,
+    status_code INTEGER,
+    result_path TEXT,
+    media_type TEXT,
+    result_filename TEXT,
+    headers TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    cpu_seconds REAL,
+    peak_rss_bytes INTEGER,
+    worker_pid INTEGER,
+    owner_pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, created_at);
+"""
+
+
+class JobStore:
+    """SQLite persistence for jobs. All methods are blocking; call via asyncio.to_thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(JOB_SCHEMA)
+            # Columns added after the first release
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for name, kind in (
+                ('cpu_seconds', 'REAL'),
+                ('peak_rss_bytes', 'INTEGER'),
+                ('worker_pid', 'INTEGER'),
+                ('owner_pid', 'INTEGER'),
+            ):
+                if name not in columns:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {name} {kind}')
+
+    def insert(self, job: dict):
+        columns = ', '.join(job)
+        placeholders = ', '.join('?' for _ in job)
+        with closing(self._connect()) as conn:
+            conn.execute(f'INSERT INTO jobs ({columns}) VALUES ({placeholders})', list(job.values()))
+
+    def get(self, job_id: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id: str, **fields):
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with closing(self._connect()) as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', [*fields.values(), job_id])
+
+    def delete(self, job_id: str):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def count_all_queued(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def count_queued(self, client: str) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client = ? AND status = 'queued'", (client,)
+            ).fetchone()[0]
+
+    def queue_position(self, job: dict) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+                "(priority > ? OR (priority = ? AND created_at < ?))",
+                (job['priority'], job['priority'], job['created_at']),
+            ).fetchone()[0]
+
+    def claim_next(self, pid: int):
+        """Atomically move the next queued job to running, owned by process pid.
+
+        Highest priority first; within a priority, clients with the fewest
+        running jobs go first so one client's burst can't monopolise workers.
+        Jobs whose secrets live in another process's memory are left to it.
+        """
+        with closing(self._connect()) as conn:
+            while True:
+                row = conn.execute(
+                    """
+                    SELECT j.* FROM jobs j
+                    WHERE j.status = 'queued' AND (j.owner_pid IS NULL OR j.owner_pid = ?)
+                    ORDER BY j.priority DESC,
+                             (SELECT COUNT(*) FROM jobs r WHERE r.client = j.client AND r.status = 'running'),
+                             j.created_at
+                    LIMIT 1
+                    """,
+                    (pid,),
+                ).fetchone()
+                if row is None:
+                    return None
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, progress = 5, stage = 'running', "
+                    "worker_pid = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), pid, row['id']),
+                ).rowcount
+                if claimed:
+                    return dict(row)
+
+    def recover_orphaned(self, stale_pids: set[int] = frozenset()) -> tuple[list[dict], list[dict]]:
+        """Recover jobs whose process died: requeue running jobs, fail jobs whose secrets died with it.
+
+        A process is dead if it no longer exists or its pid is in stale_pids
+        (e.g. our own pid at startup, left by an earlier process that had it).
+        Returns (requeued, failed).
+        """
+        def dead(pid):
+            return pid is None or pid in stale_pids or not process_alive(pid)
+
+        requeued, failed = [], []
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'running' OR (status = 'queued' AND owner_pid IS NOT NULL)"
+            ).fetchall()
+            for row in rows:
+                if row['owner_pid'] is not None and dead(row['owner_pid']):
+                    changed = conn.execute(
+                        "UPDATE jobs SET status = 'failed', stage = 'failed', error = ?, status_code = 503, "
+                        "finished_at = ? WHERE id = ? AND status = ?",
+                        ("Job was interrupted by a server restart", time.time(), row['id'], row['status']),
+                    ).rowcount
+                    if changed:
+                        failed.append(dict(row))
+                elif row['status'] == 'running' and dead(row['worker_pid']):
+                    changed = conn.execute(
+                        "UPDATE jobs SET status = 'queued', progress = 0, stage = NULL, started_at = NULL, "
+                        "worker_pid = NULL WHERE id = ? AND status = 'running' AND worker_pid IS ?",
+                        (row['id'], row['worker_pid']),
+                    ).rowcount
+                    if changed:
+                        requeued.append(dict(row))
+        return requeued, failed
+
+    def expired(self, cutoff: float) -> list[dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+                (cutoff,),
+            ).fetchall()
+        return [dict(row) for row in rows]
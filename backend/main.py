@@ -1,18 +1,94 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import FileResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+from prometheus_client import multiprocess
+import asyncio
+import ctypes.util
+import difflib
+import itertools
+import hashlib
+import json
+import mmap
+import re
 import subprocess
 import tempfile
 import os
 import platform
 import shutil
+import signal
 import logging
+import sqlite3
+import sys
 import time
+import uuid
+import zipfile
+import zlib
 import glob as glob_module
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable
+from xml.sax.saxutils import escape as xml_escape
+
+try:
+    import fcntl
+    import resource
+except ImportError:  # Windows
+    fcntl = None
+    resource = None
+
+try:
+    import pypdf
+except ImportError:  # the native PDF to DOCX engine is optional
+    pypdf = None
+
+from .admission import AdmissionController, MachineSlots, admission_max_wait, detect_cpu_count, detect_memory_mb
+from .cache import ResultCache, call_params
+from .images import (
+    compress_images, engine_available as images_engine_available, engine_version as images_engine_version,
+)
+from .jobs import JobStore, ProgressWriter, report_progress
+from .metrics import (
+    COMPRESSION_RATIO, JOBS_FINISHED, JOBS_QUEUED, OPERATION_CPU, OPERATION_PEAK_RSS, REQUEST_BYTES,
+    REQUEST_DURATION, REQUESTS, RESPONSE_BYTES, SINGLE_FLIGHT_SHARED, STAGE_DURATION, TOOL_RUNNING, TOOL_TIMEOUTS,
+    TOOL_WAITING, ResourceUsage, operation_usage, record_tool_usage, stage_timer,
+)
+from .pages import boundary_pages, expand_page_ranges, format_page_list, parse_page_ranges, split_page_ranges
+from .scratch import ScratchManager
+from .singleflight import SingleFlight, flight_lock
+from .uploads import PDF_HEAD_BYTES, PDF_TAIL_BYTES, UploadSessions, analyze_pdf_ends
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Under backend/server.py the tools were already probed once for all workers
+    if not (TOOL_SNAPSHOT and await asyncio.to_thread(tool_registry.load, TOOL_SNAPSHOT)):
+        await asyncio.to_thread(tool_registry.refresh, TOOL_SNAPSHOT)
+    await scratch.start()
+    ghostscript_pool.slot = libreoffice_pool.slot = await asyncio.to_thread(claim_worker_slot)
+    await ghostscript_pool.start()
+    if get_libreoffice_command():
+        await libreoffice_pool.start()
+    await job_queue.start()
+    await uploads.start()
+    yield
+    await uploads.stop()
+    # The server has stopped taking requests and finished the ones in flight;
+    # let running jobs finish too before the tools they use go away
+    await job_queue.stop(drain_timeout=GRACEFUL_TIMEOUT)
+    await libreoffice_pool.stop()
+    await ghostscript_pool.stop()
+    await scratch.stop()
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
 app = FastAPI(
     title="PDF2.in API",
     description="API for PDF compression and other operations",
@@ -20,15 +96,18 @@ app = FastAPI(
     docs_url=None,
     redoc_url=None,
     openapi_url=None,
+    lifespan=lifespan,
 )
 
 # Security constants
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 50 * 1024 * 1024))  # 50MB
 PDF_MAGIC_BYTES = b'%PDF'
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
 
-def get_ghostscript_command():
-    """Get the Ghostscript command for the current platform."""
+
+def find_ghostscript_command():
+    """Find the Ghostscript command for the current platform."""
     if platform.system() == 'Windows':
         for cmd in ['gswin64c', 'gswin32c', 'gs']:
             found = shutil.which(cmd)
@@ -50,8 +129,8 @@ def get_ghostscript_command():
         return shutil.which('gs')
 
 
-def get_libreoffice_command():
-    """Get the LibreOffice command for the current platform."""
+def find_libreoffice_command():
+    """Find the LibreOffice command for the current platform."""
     if platform.system() == 'Windows':
         for cmd in ['soffice', 'soffice.exe']:
             found = shutil.which(cmd)
@@ -70,8 +149,8 @@ def get_libreoffice_command():
         return shutil.which('soffice') or shutil.which('libreoffice')
 
 
-def get_calibre_command():
-    """Get the Calibre ebook-convert command."""
+def find_calibre_command():
+    """Find the Calibre ebook-convert command."""
     if platform.system() == 'Windows':
         for cmd in ['ebook-convert', 'ebook-convert.exe']:
             found = shutil.which(cmd)
@@ -89,6 +168,942 @@ def get_calibre_command():
         return shutil.which('ebook-convert')
 
 
+def probe_ghostscript(path: str) -> tuple[str, list[str]]:
+    """Return Ghostscript's version and output devices."""
+    version = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=10, check=True)
+    help_text = subprocess.run([path, '-h'], capture_output=True, text=True, timeout=10).stdout
+
+    devices = []
+    in_devices = False
+    for line in help_text.splitlines():
+        if line.startswith('Available devices:'):
+            in_devices = True
+        elif in_devices and line.startswith(' '):
+            devices.extend(line.split())
+        elif in_devices:
+            break
+
+    if devices and 'pdfwrite' not in devices:
+        raise RuntimeError("Ghostscript was built without the pdfwrite device")
+
+    return version.stdout.strip(), devices
+
+
+def probe_libreoffice(path: str) -> tuple[str, list[str]]:
+    # soffice --version can take a few seconds on a cold start
+    version = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=60, check=True)
+    return version.stdout.strip(), []
+
+
+def probe_calibre(path: str) -> tuple[str, list[str]]:
+    version = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=30, check=True)
+    return version.stdout.strip().splitlines()[0] if version.stdout.strip() else '', []
+
+
+# Ghostscript engine: 'cli' runs the gs binary for every call, 'libgs' runs
+# calls on worker processes that keep the Ghostscript library loaded, and
+# 'auto' uses libgs when the library is installed and loads
+GHOSTSCRIPT_ENGINE = os.environ.get('GHOSTSCRIPT_ENGINE', 'auto')
+GS_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gs_worker.py')
+
+
+def find_libgs():
+    """Find the Ghostscript shared library, unless the CLI engine is selected."""
+    if GHOSTSCRIPT_ENGINE == 'cli':
+        return None
+    return os.environ.get('LIBGS_PATH') or ctypes.util.find_library('gs')
+
+
+def probe_libgs(path: str) -> tuple[str, list[str]]:
+    # Loaded in a throwaway process; a broken library must not take down the API
+    version = subprocess.run(
+        [sys.executable, GS_WORKER_SCRIPT, path, '--version'], capture_output=True, text=True, timeout=30, check=True
+    )
+    return version.stdout.strip(), []
+
+
+def probe_qpdf(path: str) -> tuple[str, list[str]]:
+    version = subprocess.run([path, '--version'], capture_output=True, text=True, timeout=30, check=True)
+    return version.stdout.strip().splitlines()[0] if version.stdout.strip() else '', []
+
+
+@dataclass
+class ToolInfo:
+    name: str
+    path: str = None
+    version: str = None
+    features: list[str] = field(default_factory=list)
+    error: str = None
+    checked_at: float = None
+
+    @property
+    def available(self) -> bool:
+        return self.path is not None and self.error is None
+
+
+class ToolRegistry:
+    """External tools resolved once at startup instead of on every request.
+
+    refresh() finds each tool, runs it to record its version and features,
+    and marks tools that are missing or fail to run as unavailable.
+    """
+
+    # name -> (finder, prober)
+    TOOLS = {
+        'ghostscript': (find_ghostscript_command, probe_ghostscript),
+        'libreoffice': (find_libreoffice_command, probe_libreoffice),
+        'calibre': (find_calibre_command, probe_calibre),
+        'unoserver': (lambda: shutil.which('unoserver'), None),
+        'unoconvert': (lambda: shutil.which('unoconvert'), None),
+        'qpdf': (lambda: shutil.which('qpdf'), probe_qpdf),
+        'libgs': (find_libgs, probe_libgs),
+    }
+
+    def __init__(self):
+        self._tools = {}
+        self.refreshed_at = None
+
+    def resolve(self, name: str) -> ToolInfo:
+        finder, prober = self.TOOLS[name]
+        info = ToolInfo(name=name, checked_at=time.time())
+        try:
+            info.path = finder()
+            if info.path is None:
+                info.error = 'not_found'
+            elif prober is not None:
+                info.version, info.features = prober(info.path)
+        except subprocess.CalledProcessError as e:
+            info.error = f"exited with {e.returncode}: {(e.stderr or '')[:200]}"
+        except Exception as e:
+            info.error = str(e) or type(e).__name__
+        return info
+
+    def refresh(self, snapshot: str = None):
+        """Re-resolve every tool, saving the result to snapshot if given. Blocking; run via asyncio.to_thread."""
+        tools = {name: self.resolve(name) for name in self.TOOLS}
+        self._tools = tools
+        self.refreshed_at = time.time()
+        for info in tools.values():
+            if info.available:
+                logger.info(f"Tools: {info.name} {info.version or ''} at {info.path}")
+            else:
+                logger.warning(f"Tools: {info.name} unavailable ({info.error})")
+        if snapshot:
+            self.save(snapshot)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'refreshed_at': self.refreshed_at, 'tools': [asdict(info) for info in self._tools.values()]}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> bool:
+        """Adopt a snapshot saved by another process if it is newer than ours. Returns whether one was loaded."""
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            if self.refreshed_at and snapshot['refreshed_at'] <= self.refreshed_at:
+                return False
+            tools = {info['name']: ToolInfo(**info) for info in snapshot['tools']}
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self._tools = tools
+        self.refreshed_at = snapshot['refreshed_at']
+        return True
+
+    def get(self, name: str) -> ToolInfo:
+        info = self._tools.get(name)
+        if info is None:
+            # Used before startup ran (e.g. scripts importing this module):
+            # locate the tool without probing it
+            finder, _ = self.TOOLS[name]
+            path = finder()
+            info = ToolInfo(name=name, path=path, error=None if path else 'not_found')
+            self._tools[name] = info
+        return info
+
+    def path(self, name: str):
+        info = self.get(name)
+        return info.path if info.available else None
+
+    def status(self) -> dict:
+        tools = {}
+        for name in self.TOOLS:
+            info = self.get(name)
+            tools[name] = {**asdict(info), 'available': info.available}
+        return tools
+
+
+tool_registry = ToolRegistry()
+
+
+def engine_versions(*names: str) -> dict:
+    """Versions of the named tools and libraries, or of all of them, for cache keys."""
+    versions = {name: tool_registry.get(name).version for name in ToolRegistry.TOOLS}
+    versions['pypdf'] = pypdf.__version__ if pypdf is not None else None
+    versions['images'] = images_engine_version()
+    return {name: versions[name] for name in names} if names else versions
+
+# Tools every endpoint group depends on; /ready fails if one is unavailable
+REQUIRED_TOOLS = ('ghostscript', 'libreoffice', 'calibre')
+TOOL_REFRESH_INTERVAL = 30
+
+
+def get_ghostscript_command():
+    """Get the Ghostscript command for the current platform."""
+    return tool_registry.path('ghostscript')
+
+
+def get_libreoffice_command():
+    """Get the LibreOffice command for the current platform."""
+    return tool_registry.path('libreoffice')
+
+
+def get_calibre_command():
+    """Get the Calibre ebook-convert command."""
+    return tool_registry.path('calibre')
+
+
+# Worker processes serving the app (backend/server.py sets this). Limits
+# below are for the whole machine: tool limits are shared by the workers,
+# budgets split between them.
+WEB_CONCURRENCY = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+# Seconds in-flight jobs get to finish on shutdown before they are cut off
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 120))
+# Local state shared by the workers of one server
+RUNTIME_DIR = os.environ.get('RUNTIME_DIR', os.path.join(tempfile.gettempdir(), 'pdf2-runtime'))
+# Tool probe results written by the server process so workers skip probing
+TOOL_SNAPSHOT = os.environ.get('TOOL_SNAPSHOT')
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def worker_share(total: int) -> int:
+    """This worker's equal share of a budget that each worker enforces on its own.
+
+    At least 1, so a total below WEB_CONCURRENCY is exceeded; backend/server.py
+    warns about that at startup.
+    """
+    return max(1, total // WEB_CONCURRENCY)
+
+
+def worker_slot_share(total: int, slot: int) -> int:
+    """Worker slot's part of total, for things each worker owns, like tool daemons.
+
+    The parts of all the workers add up to total exactly, so some may be 0.
+    """
+    return total // WEB_CONCURRENCY + (slot % WEB_CONCURRENCY < total % WEB_CONCURRENCY)
+
+
+_worker_slot_lock = None
+
+
+def claim_worker_slot() -> int:
+    """Lock the lowest free worker slot for the life of this process.
+
+    Slots give each worker its own LibreOffice ports and profiles. The lock
+    is released by the OS when the process exits, so a restarted worker
+    takes over the slot of the one it replaces.
+    """
+    global _worker_slot_lock
+    if fcntl is None:
+        return 0
+    os.makedirs(RUNTIME_DIR, exist_ok=True)
+    for index in itertools.count():
+        lock = open(os.path.join(RUNTIME_DIR, f'worker-{index}.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        _worker_slot_lock = lock
+        return index
+
+
+# Concurrency limits for external tools. Each tool gets its own semaphore so a
+# burst of slow LibreOffice conversions cannot starve Ghostscript jobs. With
+# several workers they hold for all of them together, through MachineSlots.
+TOOL_CONCURRENCY = {
+    'ghostscript': max(1, int(os.environ.get('GHOSTSCRIPT_CONCURRENCY', os.cpu_count() or 2))),
+    'libreoffice': max(1, int(os.environ.get('LIBREOFFICE_CONCURRENCY', 2))),
+    'calibre': max(1, int(os.environ.get('CALIBRE_CONCURRENCY', 2))),
+    'qpdf': max(1, int(os.environ.get('QPDF_CONCURRENCY', 2))),
+    # In-process text extraction for the native PDF to DOCX engine
+    'pypdf': max(1, int(os.environ.get('PYPDF_CONCURRENCY', 2))),
+    # In-process image re-encoding for the images compression engine
+    'images': max(1, int(os.environ.get('IMAGES_CONCURRENCY', os.cpu_count() or 2))),
+}
+
+# Rough resident memory of one process per tool, in MB. Together with one CPU
+# per process this is what admission control charges against the budgets.
+TOOL_MEMORY_MB = {
+    'ghostscript': int(os.environ.get('GHOSTSCRIPT_MEMORY_MB', 300)),
+    'libreoffice': int(os.environ.get('LIBREOFFICE_MEMORY_MB', 600)),
+    'calibre': int(os.environ.get('CALIBRE_MEMORY_MB', 600)),
+    'qpdf': int(os.environ.get('QPDF_MEMORY_MB', 150)),
+    'pypdf': int(os.environ.get('PYPDF_MEMORY_MB', 200)),
+    'images': int(os.environ.get('IMAGES_MEMORY_MB', 200)),
+}
+
+
+# Machine-wide budgets each worker enforces an equal share of, by setting
+SPLIT_BUDGETS = {
+    'ADMISSION_MEMORY_BUDGET_MB': int(os.environ.get('ADMISSION_MEMORY_BUDGET_MB', detect_memory_mb() * 3 // 4)),
+    'ADMISSION_CPU_BUDGET': int(os.environ.get('ADMISSION_CPU_BUDGET', detect_cpu_count())),
+    'ADMISSION_MAX_QUEUE': int(os.environ.get('ADMISSION_MAX_QUEUE', 64)),
+}
+ADMISSION_MEMORY_BUDGET_MB = worker_share(SPLIT_BUDGETS['ADMISSION_MEMORY_BUDGET_MB'])
+ADMISSION_CPU_BUDGET = worker_share(SPLIT_BUDGETS['ADMISSION_CPU_BUDGET'])
+ADMISSION_MAX_QUEUE = worker_share(SPLIT_BUDGETS['ADMISSION_MAX_QUEUE'])
+
+
+admission = AdmissionController(
+    TOOL_CONCURRENCY, TOOL_MEMORY_MB, ADMISSION_MEMORY_BUDGET_MB, ADMISSION_CPU_BUDGET, ADMISSION_MAX_QUEUE,
+    MachineSlots(os.path.join(RUNTIME_DIR, 'slots'), TOOL_CONCURRENCY)
+    if WEB_CONCURRENCY > 1 and MachineSlots.supported() else None,
+)
+
+
+# Limits applied to every tool process. Address space is capped per tool
+# because LibreOffice and Calibre reserve far more virtual memory than they
+# ever touch, so they are left to the cgroup by default. 0 disables a limit.
+TOOL_MAX_MEMORY_MB = {
+    'ghostscript': int(os.environ.get('GHOSTSCRIPT_MAX_MEMORY_MB', 2048)),
+    'libreoffice': int(os.environ.get('LIBREOFFICE_MAX_MEMORY_MB', 0)),
+    'calibre': int(os.environ.get('CALIBRE_MAX_MEMORY_MB', 0)),
+    'qpdf': int(os.environ.get('QPDF_MAX_MEMORY_MB', 1024)),
+}
+TOOL_MAX_CPU_SECONDS = int(os.environ.get('TOOL_MAX_CPU_SECONDS', 300))
+TOOL_MAX_FILE_SIZE_MB = int(os.environ.get('TOOL_MAX_FILE_SIZE_MB', 1024))
+TOOL_MAX_OPEN_FILES = int(os.environ.get('TOOL_MAX_OPEN_FILES', 1024))
+# Niceness for tool processes, so the API itself stays responsive under load
+TOOL_NICE = int(os.environ.get('TOOL_NICE', 5))
+# Optional cgroup v2 directory with one writable child group per tool
+# (e.g. /sys/fs/cgroup/pdf2/ghostscript) whose cpu.weight/memory.max are
+# set by the operator
+TOOL_CGROUP_ROOT = os.environ.get('TOOL_CGROUP_ROOT', '')
+
+
+def set_process_limit(pid: int, which: int, value: int, grace: int = 0):
+    """Lower one rlimit of a running process, never above its current hard limit."""
+    _, hard = resource.prlimit(pid, which)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+        grace = min(value + grace, hard) - value
+    resource.prlimit(pid, which, (value, value + grace))
+
+
+def confine_process(pid: int, tool: str, daemon: bool = False):
+    """Apply the tool's rlimits, niceness and cgroup to a process that just started.
+
+    Limits are set from the parent with prlimit rather than in a preexec_fn,
+    which is unsafe in a threaded server. Daemons get no CPU-time limit
+    since it would accumulate over their lifetime.
+    """
+    if resource is not None and hasattr(resource, 'prlimit'):
+        limits = [
+            (resource.RLIMIT_AS, TOOL_MAX_MEMORY_MB.get(tool, 0) * 1024 * 1024, 0),
+            (resource.RLIMIT_FSIZE, TOOL_MAX_FILE_SIZE_MB * 1024 * 1024, 0),
+            (resource.RLIMIT_NOFILE, TOOL_MAX_OPEN_FILES, 0),
+        ]
+        if not daemon:
+            # SIGXCPU at the soft limit, SIGKILL 5 seconds later
+            limits.append((resource.RLIMIT_CPU, TOOL_MAX_CPU_SECONDS, 5))
+        for which, value, grace in limits:
+            if value <= 0:
+                continue
+            try:
+                set_process_limit(pid, which, value, grace)
+            except (OSError, ValueError) as e:
+                logger.debug(f"Could not set limit {which} on {tool} process {pid}: {e}")
+
+    if TOOL_NICE and hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, TOOL_NICE)
+        except OSError as e:
+            logger.debug(f"Could not renice {tool} process {pid}: {e}")
+
+    if TOOL_CGROUP_ROOT:
+        try:
+            with open(os.path.join(TOOL_CGROUP_ROOT, tool, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError as e:
+            logger.debug(f"Could not move {tool} process {pid} to its cgroup: {e}")
+
+
+def kill_process_group(pid: int, sig: int = signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM):
+    """Signal every process in the group led by pid, ignoring a group that is gone."""
+    if not hasattr(os, 'killpg'):
+        return
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+# Threads that wait on tool processes; sized so every tool slot can have one
+_process_waiters = ThreadPoolExecutor(
+    max_workers=sum(TOOL_CONCURRENCY.values()) + 4,
+    thread_name_prefix='tool-wait',
+)
+
+
+class ToolResult(subprocess.CompletedProcess):
+    """CompletedProcess plus the resources the process used."""
+
+    def __init__(self, args, returncode, stdout, stderr, wall_time, cpu_time=None, max_rss=None):
+        super().__init__(args, returncode, stdout, stderr)
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+
+
+def wait_for_exit(proc: subprocess.Popen) -> tuple:
+    """Reap proc and return (cpu_seconds, max_rss_bytes), or Nones where unsupported."""
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None, None
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = usage.ru_maxrss if platform.system() == 'Darwin' else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, max_rss
+
+
+async def run_process(cmd: list[str], timeout: float, tool: str = None) -> ToolResult:
+    """Run a command without blocking the event loop.
+
+    Mirrors subprocess.run(capture_output=True, text=True): returns a
+    CompletedProcess and raises subprocess.TimeoutExpired on timeout, after
+    killing the process. The process is reaped on a waiter thread so its CPU
+    time and peak memory can be recorded.
+
+    The command runs in its own process group, confined with the limits of
+    tool when given, and the whole group is killed on timeout or when it
+    exits, so helpers it spawned can't outlive it.
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        start_time = time.monotonic()
+        proc = subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr, start_new_session=True
+        )
+        if tool:
+            confine_process(proc.pid, tool)
+        waiter = loop.run_in_executor(_process_waiters, wait_for_exit, proc)
+        try:
+            cpu_time, max_rss = await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+        except asyncio.TimeoutError:
+            kill_process_group(proc.pid)
+            await waiter
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except asyncio.CancelledError:
+            # Client went away; don't leave the tool running in the background
+            kill_process_group(proc.pid)
+            await waiter
+            raise
+        finally:
+            kill_process_group(proc.pid)
+
+        stdout.seek(0)
+        stderr.seek(0)
+        return ToolResult(
+            cmd,
+            proc.returncode,
+            stdout.read().decode(errors='replace'),
+            stderr.read().decode(errors='replace'),
+            wall_time=time.monotonic() - start_time,
+            cpu_time=cpu_time,
+            max_rss=max_rss,
+        )
+
+
+async def run_tool_now(tool: str, cmd: list[str], timeout: float) -> ToolResult:
+    """Run an external tool for a caller that already holds one of its slots."""
+    TOOL_RUNNING.labels(tool).inc()
+    try:
+        if tool == 'ghostscript' and ghostscript_pool.enabled:
+            result = await ghostscript_pool.run(cmd, timeout)
+        else:
+            result = await run_process(cmd, timeout, tool)
+    except subprocess.TimeoutExpired:
+        TOOL_TIMEOUTS.labels(tool).inc()
+        raise
+    finally:
+        TOOL_RUNNING.labels(tool).dec()
+
+    record_tool_usage(tool, result)
+    return result
+
+
+async def run_tool(tool: str, cmd: list[str], timeout: float) -> ToolResult:
+    """Run an external tool once admission control gives it a slot."""
+    async with admission.slot(tool):
+        return await run_tool_now(tool, cmd, timeout)
+
+
+# LibreOffice instance pool. Each instance owns an isolated user profile so
+# concurrent conversions never share one, and when unoserver is installed it
+# keeps a headless LibreOffice listening on its own port between jobs.
+LIBREOFFICE_MAX_JOBS = int(os.environ.get('LIBREOFFICE_MAX_JOBS', 200))
+LIBREOFFICE_BASE_PORT = int(os.environ.get('LIBREOFFICE_BASE_PORT', 2002))
+LIBREOFFICE_PROFILE_DIR = os.environ.get(
+    'LIBREOFFICE_PROFILE_DIR',
+    os.path.join(tempfile.gettempdir(), 'pdf2-libreoffice'),
+)
+
+
+def get_unoserver_commands():
+    """Get the (unoserver, unoconvert) commands, or None if either is missing."""
+    server = tool_registry.path('unoserver')
+    client = tool_registry.path('unoconvert')
+    if server and client:
+        return server, client
+    return None
+
+
+class LibreOfficeInstance:
+    """One LibreOffice slot: a private profile and, if available and daemon is set, a unoserver daemon."""
+
+    def __init__(self, index: int, daemon: bool = True):
+        self.index = index
+        self.daemon = daemon
+        self.profile_dir = os.path.join(LIBREOFFICE_PROFILE_DIR, f'instance-{index}')
+        # unoserver needs two ports: XML-RPC for unoconvert and UNO for soffice
+        self.port = LIBREOFFICE_BASE_PORT + index * 2
+        self.uno_port = self.port + 1
+        self.process = None
+        self.jobs = 0
+
+    @property
+    def profile_url(self) -> str:
+        return Path(self.profile_dir).resolve().as_uri()
+
+    async def start(self):
+        self.jobs = 0
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        unoserver = get_unoserver_commands()
+        lo_cmd = get_libreoffice_command()
+        if not self.daemon or not unoserver or not lo_cmd:
+            return
+
+        self.process = await asyncio.create_subprocess_exec(
+            unoserver[0],
+            '--interface', '127.0.0.1',
+            '--port', str(self.port),
+            '--uno-port', str(self.uno_port),
+            '--executable', lo_cmd,
+            '--user-installation', self.profile_url,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        confine_process(self.process.pid, 'libreoffice', daemon=True)
+
+        # Wait for the listener so the first job doesn't race soffice startup
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if await self.is_healthy():
+                logger.info(f"LibreOffice instance {self.index} listening on port {self.port}")
+                return
+            if self.process.returncode is not None:
+                break
+            await asyncio.sleep(0.5)
+
+        logger.error(f"LibreOffice instance {self.index} failed to start, using cold conversions")
+        await self.stop()
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        if self.process:
+            # unoserver's soffice child lives in the same process group
+            kill_process_group(self.process.pid)
+        self.process = None
+
+    async def restart(self):
+        await self.stop()
+        # Recycle the profile too; LibreOffice profiles grow and occasionally corrupt
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        await self.start()
+
+    async def is_healthy(self) -> bool:
+        if self.process is None or self.process.returncode is not None:
+            return False
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection('127.0.0.1', self.port), timeout=1
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    async def convert_to_pdf(self, input_path: str, output_dir: str, timeout: float) -> tuple[subprocess.CompletedProcess, str]:
+        """Convert a document to PDF in output_dir.
+
+        Returns (result, output_path)
+        """
+        self.jobs += 1
+        output_path = os.path.join(
+            output_dir, os.path.splitext(os.path.basename(input_path))[0] + '.pdf'
+        )
+
+        unoserver = get_unoserver_commands()
+        if self.process is not None and unoserver:
+            cmd = [
+                unoserver[1],
+                '--host', '127.0.0.1',
+                '--port', str(self.port),
+                '--convert-to', 'pdf',
+                input_path,
+                output_path,
+            ]
+        else:
+            cmd = [
+                get_libreoffice_command(),
+                f'-env:UserInstallation={self.profile_url}',
+                '--headless',
+                '--convert-to', 'pdf',
+                '--outdir', output_dir,
+                input_path,
+            ]
+
+        return await run_tool_now('libreoffice', cmd, timeout), output_path
+
+
+class LibreOfficePool:
+    """Hands out LibreOffice instances one job at a time.
+
+    The machine's total daemons are divided between the workers, so a worker
+    may run more conversions than it has daemons (admission shares the
+    machine's slots between workers). The extra ones run cold, each with a
+    profile of its own.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        # Worker slot; instances of different workers get different ports and profiles
+        self.slot = 0
+        self._idle = None
+        self._cold = None
+        self._instances = []
+        self._start_lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._start_lock:
+            if self._idle is not None:
+                return
+            size = worker_slot_share(self.total, self.slot)
+            first = sum(worker_slot_share(self.total, slot) for slot in range(self.slot))
+            # Numbered after every worker's daemons
+            first_cold = self.total * (self.slot + 1)
+            self._instances = [LibreOfficeInstance(first + i) for i in range(size)]
+            cold = [LibreOfficeInstance(first_cold + i, daemon=False) for i in range(self.total - size)]
+            await asyncio.gather(*(instance.start() for instance in self._instances + cold))
+            self._instances += cold
+            self._idle = asyncio.Queue()
+            self._cold = asyncio.Queue()
+            for instance in self._instances:
+                (self._idle if instance.daemon else self._cold).put_nowait(instance)
+
+    async def stop(self):
+        await asyncio.gather(*(instance.stop() for instance in self._instances))
+        self._instances = []
+        self._idle = None
+        self._cold = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self._idle is None:
+            await self.start()
+        if self._idle.empty() and not self._cold.empty():
+            idle = self._cold
+        else:
+            idle = self._idle
+        TOOL_WAITING.labels('libreoffice').inc()
+        try:
+            instance = await idle.get()
+        finally:
+            TOOL_WAITING.labels('libreoffice').dec()
+        try:
+            if instance.process is not None and not await instance.is_healthy():
+                logger.warning(f"LibreOffice instance {instance.index} unhealthy, restarting")
+                await instance.restart()
+            yield instance
+        finally:
+            if instance.jobs >= LIBREOFFICE_MAX_JOBS or (
+                instance.process is not None and instance.process.returncode is not None
+            ):
+                await instance.restart()
+            idle.put_nowait(instance)
+
+
+libreoffice_pool = LibreOfficePool(TOOL_CONCURRENCY['libreoffice'])
+
+
+# Calls per libgs worker before it is replaced, in case of leaks in the library
+GHOSTSCRIPT_WORKER_MAX_JOBS = int(os.environ.get('GHOSTSCRIPT_WORKER_MAX_JOBS', 500))
+# Responses carry the call's whole stdout and stderr on one line
+GS_WORKER_LINE_LIMIT = 64 * 1024 * 1024
+
+
+class GhostscriptWorker:
+    """A gs_worker.py process that runs Ghostscript calls through libgs, one at a time."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.jobs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self, library: str) -> bool:
+        self.jobs = 0
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, GS_WORKER_SCRIPT, library,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=GS_WORKER_LINE_LIMIT,
+        )
+        confine_process(self.process.pid, 'ghostscript', daemon=True)
+        # The worker reports in once the library is loaded and warmed up
+        try:
+            ready = await asyncio.wait_for(self.process.stdout.readline(), timeout=30)
+        except asyncio.TimeoutError:
+            ready = b''
+        if not ready:
+            logger.error(f"Ghostscript worker {self.index} failed to start")
+            await self.stop()
+            return False
+        return True
+
+    async def stop(self):
+        if self.process:
+            kill_process_group(self.process.pid)
+            await self.process.wait()
+        self.process = None
+
+    async def run(self, cmd: list[str], timeout: float) -> ToolResult:
+        """Run a gs command line on this worker; cmd[0], the gs binary, is not used.
+
+        Behaves like run_process: raises subprocess.TimeoutExpired on timeout.
+        A call in progress can't be interrupted, so on timeout or
+        cancellation the worker is killed along with it.
+        """
+        self.jobs += 1
+        start_time = time.monotonic()
+        request = json.dumps({'args': cmd[1:], 'cpu_limit': TOOL_MAX_CPU_SECONDS})
+        try:
+            self.process.stdin.write(request.encode() + b'\n')
+            await self.process.stdin.drain()
+            line = await asyncio.wait_for(self.process.stdout.readline(), timeout=timeout)
+        except asyncio.TimeoutError:
+            await self.stop()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except asyncio.CancelledError:
+            await self.stop()
+            raise
+        except ConnectionError:
+            line = b''
+
+        if not line:
+            # Died mid-call, e.g. killed at its CPU or memory limit
+            returncode = await self.process.wait()
+            await self.stop()
+            return ToolResult(
+                cmd, returncode or 1, '', 'Ghostscript worker exited', wall_time=time.monotonic() - start_time
+            )
+
+        response = json.loads(line)
+        return ToolResult(
+            cmd,
+            response['returncode'],
+            response['stdout'],
+            response['stderr'],
+            wall_time=time.monotonic() - start_time,
+            cpu_time=response['cpu_time'],
+            max_rss=response['max_rss'],
+        )
+
+
+class GhostscriptPool:
+    """Hands out libgs workers one call at a time.
+
+    Not started when the CLI engine is selected or libgs is missing or fails
+    to load, or when this worker's share of the machine's libgs workers is
+    none, in which case Ghostscript runs as a new gs process per call.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        # Worker slot, which decides this worker's share of the total
+        self.slot = 0
+        self.size = 0
+        self._library = None
+        self._idle = None
+        self._workers = []
+        self._recycling = set()
+        self._start_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._idle is not None
+
+    async def start(self):
+        async with self._start_lock:
+            if self._idle is not None:
+                return
+            library = tool_registry.path('libgs')
+            if library is None:
+                if GHOSTSCRIPT_ENGINE == 'libgs':
+                    logger.warning("Ghostscript: libgs is unavailable, using the gs CLI")
+                return
+            self.size = worker_slot_share(self.total, self.slot)
+            if self.size == 0:
+                logger.info("Ghostscript: the other workers hold all libgs workers, using the gs CLI")
+                return
+
+            workers = [GhostscriptWorker(i) for i in range(self.size)]
+            if not all(await asyncio.gather(*(worker.start(library) for worker in workers))):
+                await asyncio.gather(*(worker.stop() for worker in workers))
+                logger.error("Ghostscript: libgs workers failed to start, using the gs CLI")
+                return
+            self._library = library
+            self._workers = workers
+            self._idle = asyncio.Queue()
+            for worker in workers:
+                self._idle.put_nowait(worker)
+            logger.info(f"Ghostscript: {self.size} libgs worker(s) ready ({library})")
+
+    async def stop(self):
+        for task in self._recycling:
+            task.cancel()
+        await asyncio.gather(*self._recycling, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self._workers))
+        self._workers = []
+        self._idle = None
+
+    async def run(self, cmd: list[str], timeout: float) -> ToolResult:
+        """Run a gs command line on an idle worker, or as a gs process if none is idle.
+
+        Callers hold a Ghostscript admission slot, but slots are shared by
+        all the server's workers while each has only its share of libgs
+        workers; none is idle either when this worker holds more slots than
+        that, or while one is being replaced.
+        """
+        idle = self._idle
+        try:
+            worker = idle.get_nowait()
+        except asyncio.QueueEmpty:
+            return await run_process(cmd, timeout, 'ghostscript')
+        try:
+            if not worker.alive and not await worker.start(self._library):
+                return await run_process(cmd, timeout, 'ghostscript')
+            return await worker.run(cmd, timeout)
+        finally:
+            if worker.alive and worker.jobs < GHOSTSCRIPT_WORKER_MAX_JOBS:
+                idle.put_nowait(worker)
+            else:
+                # Replace it off the request path
+                task = asyncio.create_task(self._recycle(worker, idle))
+                self._recycling.add(task)
+                task.add_done_callback(self._recycling.discard)
+
+    async def _recycle(self, worker: GhostscriptWorker, idle: asyncio.Queue):
+        try:
+            await worker.stop()
+            await worker.start(self._library)
+        finally:
+            idle.put_nowait(worker)
+
+
+ghostscript_pool = GhostscriptPool(TOOL_CONCURRENCY['ghostscript'])
+
+
+# Room for multipart framing and the form fields sent along with a file
+MULTIPART_OVERHEAD = 1024 * 1024
+UPLOAD_CHUNK_PATH_RE = re.compile(r'^/api/uploads/[^/]+/chunks/[^/]+$')
+
+
+def request_body_limit(scope: dict) -> int:
+    """Largest request body a path accepts: a batch of files, an upload chunk or one file."""
+    path = scope['path']
+    if path.startswith('/api/batch/'):
+        return BATCH_MAX_FILES * (MAX_FILE_SIZE + MULTIPART_OVERHEAD)
+    if scope['method'] == 'PUT' and UPLOAD_CHUNK_PATH_RE.match(path):
+        return uploads.chunk_size
+    return MAX_FILE_SIZE + MULTIPART_OVERHEAD
+
+
+class BodySizeLimitMiddleware:
+    """Rejects request bodies over request_body_limit() with 413.
+
+    Starlette spools a multipart body to disk before the handler runs, so
+    the handlers' own size checks come after an oversized upload has been
+    received. Here the Content-Length header is checked before anything is
+    read, and bodies sent without one are counted as they arrive.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def too_large(limit: int) -> HTTPException:
+        return HTTPException(status_code=413, detail=f"Request too large. Maximum size is {limit // (1024 * 1024)}MB")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        limit = request_body_limit(scope)
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > limit:
+            error = self.too_large(limit)
+            response = JSONResponse({'detail': error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # Handlers and form parsing let HTTPException through as is
+                    raise self.too_large(limit)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except HTTPException as e:
+            if e.status_code != 413 or response_started:
+                raise
+            await JSONResponse({'detail': e.detail}, status_code=413)(scope, receive, send)
+
+
+app.add_middleware(BodySizeLimitMiddleware)
+
+
 # CORS for Next.js frontend
 allowed_origins = os.environ.get(
     "ALLOWED_ORIGINS",
@@ -101,13 +1116,174 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["X-Conversion-Engine"],
+    expose_headers=[
+        "X-Conversion-Engine", "X-Conversion-Fidelity", "X-Cache", "X-Batch-Succeeded", "X-Batch-Failed", "X-Pages",
+        "X-Render-Cached", "Retry-After", "X-Linearized", "X-Ghostscript-Passes",
+        # Compression with a target size
+        "X-Compression-Quality", "X-Target-Size", "X-Target-Met",
+        # The images compression engine's report
+        "X-Compression-Engine", "X-Images", "X-Images-Unique", "X-Images-Recompressed", "X-Image-Bytes-Saved",
+        "X-Image-Report",
+        # For viewers loading results in parts with range requests
+        "Accept-Ranges", "Content-Range", "Content-Length",
+    ],
+)
+
+
+class MetricsMiddleware:
+    """Records request count, latency and body sizes per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.monotonic()
+        status = 500
+        bytes_in = 0
+        bytes_out = 0
+
+        async def counting_receive():
+            nonlocal bytes_in
+            message = await receive()
+            if message['type'] == 'http.request':
+                bytes_in += len(message.get('body', b''))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, bytes_out
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                bytes_out += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            # Label by route template so job ids don't explode the label space
+            route = scope.get('route')
+            endpoint = route.path if route else 'unmatched'
+            REQUESTS.labels(endpoint, scope['method'], str(status)).inc()
+            REQUEST_DURATION.labels(endpoint).observe(time.monotonic() - start_time)
+            REQUEST_BYTES.labels(endpoint).inc(bytes_in)
+            RESPONSE_BYTES.labels(endpoint).inc(bytes_out)
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+# Scratch space for requests. RAM-backed storage is used while the quota
+# allows, everything else goes to disk.
+SCRATCH_RAM_DIR = os.environ.get('SCRATCH_RAM_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else '')
+SCRATCH_RAM_QUOTA_BYTES = worker_share(int(os.environ.get('SCRATCH_RAM_QUOTA_BYTES', 512 * 1024 * 1024)))
+SCRATCH_DISK_DIR = os.environ.get('SCRATCH_DISK_DIR', tempfile.gettempdir())
+
+
+scratch = ScratchManager(SCRATCH_RAM_DIR, SCRATCH_RAM_QUOTA_BYTES, SCRATCH_DISK_DIR)
+
+
+@contextmanager
+def scratch_dir(size_hint: int = 0):
+    """Create a scratch working directory for one request.
+
+    The directory is removed if the request fails. On success the handler
+    passes it to file_response(), which removes it after the result is sent.
+    """
+    temp_dir = scratch.create(size_hint)
+    try:
+        yield temp_dir
+    except BaseException:
+        scratch.release(temp_dir)
+        raise
+
+
+async def save_upload(file: UploadFile, path: str, magic: bytes = None) -> tuple[int, str]:
+    """Stream an uploaded file to disk chunk by chunk.
+
+    Enforces MAX_FILE_SIZE as bytes arrive and checks the magic bytes on the
+    first chunk, so an invalid upload is rejected without buffering it.
+    Returns (bytes_written, sha256_hexdigest)
+    """
+    size = 0
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if size == 0 and magic and not chunk.startswith(magic):
+                raise HTTPException(status_code=400, detail="Invalid PDF file")
+            size += len(chunk)
+            if size > MAX_FILE_SIZE:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"
+                )
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+
+    if size == 0 and magic:
+        raise HTTPException(status_code=400, detail="Invalid PDF file")
+
+    return size, digest.hexdigest()
+
+
+def file_response(
+    path: str,
+    media_type: str,
+    filename: str,
+    temp_dir: str,
+    headers: dict = None,
+    operation: str = 'download',
+) -> FileResponse:
+    """Stream a result file to the client and remove temp_dir once it has been sent."""
+    created = time.monotonic()
+
+    def cleanup():
+        # Background tasks run once the body is sent, so this times the download
+        STAGE_DURATION.labels(operation, 'send').observe(time.monotonic() - created)
+        scratch.release(temp_dir)
+
+    return FileResponse(
+        path,
+        media_type=media_type,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            **(headers or {}),
+        },
+        background=BackgroundTask(cleanup),
+    )
+
+
+# Result cache for deterministic operations (compress and document conversions).
+# Lock/unlock are never cached: their output depends on a password, and a cached
+# unlock result would hand decrypted content to anyone re-uploading the file.
+RESULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'pdf2-cache'),
 )
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))  # 1GB
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 24 * 60 * 60))  # 1 day
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+# Rendered pages get their own cache so thumbnails don't evict conversions
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pdf2-render-cache'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256MB
+
+render_cache = ResultCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+
+# Removes form fields and annotations and flattens layers when re-writing a PDF
+FLATTEN_OPTIONS = ['-dPreserveAnnots=false', '-dFlattenAnnots=true']
 
 
-def flatten_pdf_with_ghostscript(input_path: str, output_path: str) -> tuple[bool, str]:
+async def flatten_pdf_with_ghostscript(input_path: str, output_path: str, page_list: str = None) -> tuple[bool, str]:
     """Flatten a PDF using Ghostscript to remove annotations, form fields, and interactive elements.
 
+    page_list (Ghostscript -sPageList syntax, e.g. '1-3,5') keeps only those pages.
+
     Returns (success, error_message)
     """
     gs_cmd = get_ghostscript_command()
@@ -124,19 +1300,14 @@ def flatten_pdf_with_ghostscript(input_path: str, output_path: str) -> tuple[boo
             '-dQUIET',
             '-sDEVICE=pdfwrite',
             '-dCompatibilityLevel=1.4',
-            '-dPreserveAnnots=false',
-            '-dFlattenAnnots=true',
+            *FLATTEN_OPTIONS,
             '-dPDFSETTINGS=/prepress',
+            *([f'-sPageList={page_list}'] if page_list else []),
             f'-sOutputFile={output_path}',
             input_path
         ]
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
+        result = await run_tool('ghostscript', cmd, timeout=60)
 
         if result.returncode != 0:
             logger.error(f"Ghostscript flatten failed: {result.stderr}")
@@ -154,7 +1325,7 @@ def flatten_pdf_with_ghostscript(input_path: str, output_path: str) -> tuple[boo
         return False, str(e)
 
 
-def convert_pdf_to_docx_calibre(input_path: str, output_path: str) -> tuple[bool, str]:
+async def convert_pdf_to_docx_calibre(input_path: str, output_path: str) -> tuple[bool, str]:
     """Convert PDF to DOCX using Calibre's ebook-convert.
 
     Returns (success, engine_used)
@@ -171,12 +1342,7 @@ def convert_pdf_to_docx_calibre(input_path: str, output_path: str) -> tuple[bool
             output_path,
         ]
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
+        result = await run_tool('calibre', cmd, timeout=120)
 
         if result.returncode != 0:
             logger.error(f"Calibre failed: {result.stderr}")
@@ -194,231 +1360,1303 @@ def convert_pdf_to_docx_calibre(input_path: str, output_path: str) -> tuple[bool
         return False, str(e)
 
 
-@app.post("/api/compress")
-async def compress_pdf(
-    file: UploadFile = File(...),
-    quality: str = Form("medium")
-):
-    """Compress a PDF file using Ghostscript."""
-    gs_cmd = get_ghostscript_command()
-    if not gs_cmd:
-        raise HTTPException(
-            status_code=500,
-            detail="Ghostscript is not installed. PDF compression requires Ghostscript."
-        )
+# Annotation subtypes that draw something on the page. Link annotations are
+# the only common kind that doesn't, and converters keep them as hyperlinks.
+DRAWN_ANNOTATION_SUBTYPES = {
+    b'Text', b'FreeText', b'Line', b'Square', b'Circle', b'Polygon', b'PolyLine',
+    b'Highlight', b'Underline', b'Squiggly', b'StrikeOut', b'Stamp', b'Caret', b'Ink',
+    b'FileAttachment', b'Sound', b'Movie', b'Widget', b'Screen', b'Watermark', b'Redact', b'3D',
+}
+PDF_SUBTYPE_RE = re.compile(rb'/Subtype\s*/([A-Za-z0-9]+)')
+PDF_OBJSTM_RE = re.compile(rb'/Type\s*/ObjStm\b')
+# Most a scan inflates from one object stream, and from all of them; past
+# that a stream counts as unreadable, so a small upload can't inflate into
+# gigabytes in the API process
+PDF_SCAN_MAX_STREAM_BYTES = 8 * 1024 * 1024
+PDF_SCAN_MAX_INFLATED_BYTES = 64 * 1024 * 1024
+
+
+@dataclass
+class PdfScan:
+    """What a cheap byte-level scan found in a PDF."""
+    acroform: bool = False
+    optional_content: bool = False
+    encrypted: bool = False
+    annotations: set = field(default_factory=set)
+    images: int = 0
+    unreadable_streams: int = 0
+
+    @property
+    def flatten_reasons(self) -> list[str]:
+        reasons = []
+        if self.acroform:
+            reasons.append('form fields')
+        if self.optional_content:
+            reasons.append('optional content')
+        if self.annotations & DRAWN_ANNOTATION_SUBTYPES:
+            reasons.append('annotations')
+        if self.encrypted or self.unreadable_streams:
+            # Can't see inside some object streams, so assume the worst
+            reasons.append('unreadable objects')
+        return reasons
+
+
+def scan_pdf(path: str) -> PdfScan:
+    """Look for form fields, drawn annotations and optional content in a PDF.
+
+    Scans the raw file plus any Flate-compressed object streams, where PDF
+    1.5+ writers put most dictionaries, up to PDF_SCAN_MAX_STREAM_BYTES
+    each. Errs on the side of reporting something to flatten.
+    """
+    scan = PdfScan()
+    inflated = 0
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return scan
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks = [data]
+            for match in PDF_OBJSTM_RE.finditer(data):
+                start = data.find(b'stream', match.end())
+                end = data.find(b'endstream', start)
+                if start < 0 or end < 0:
+                    scan.unreadable_streams += 1
+                    continue
+                start += len(b'stream')
+                start += 2 if data[start:start + 2] == b'\r\n' else 1
+                inflater = zlib.decompressobj()
+                try:
+                    chunk = inflater.decompress(data[start:end], PDF_SCAN_MAX_STREAM_BYTES)
+                except zlib.error:
+                    scan.unreadable_streams += 1
+                    continue
+                inflated += len(chunk)
+                if inflater.unconsumed_tail or len(chunk) >= PDF_SCAN_MAX_STREAM_BYTES \
+                        or inflated > PDF_SCAN_MAX_INFLATED_BYTES:
+                    scan.unreadable_streams += 1
+                    continue
+                chunks.append(chunk)
+
+            for chunk in chunks:
+                scan.acroform = scan.acroform or chunk.find(b'/AcroForm') >= 0
+                scan.optional_content = scan.optional_content or chunk.find(b'/OCProperties') >= 0
+                scan.encrypted = scan.encrypted or chunk.find(b'/Encrypt') >= 0
+                for subtype in PDF_SUBTYPE_RE.findall(chunk):
+                    if subtype == b'Image':
+                        scan.images += 1
+                    elif subtype in DRAWN_ANNOTATION_SUBTYPES or subtype == b'Link':
+                        scan.annotations.add(subtype)
+            del chunks
+    return scan
+
+
+# Minimum share of pages the native engine must convert without losing
+# anything (no images, text extracted) before it is used over Calibre
+PDF_TO_DOCX_NATIVE_MIN_FIDELITY = float(os.environ.get('PDF_TO_DOCX_NATIVE_MIN_FIDELITY', 0.95))
+# Extracted characters below which a page with content counts as not converted
+NATIVE_MIN_PAGE_CHARS = 20
+# Characters XML 1.0 can't carry, plus lone surrogates from broken font maps
+XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff\ud800-\udfff]')
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
 
-    if not file.filename or not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="File must be a PDF document")
 
-    quality_settings = {
-        "low": "/screen",
-        "medium": "/ebook",
-        "high": "/printer",
-        "maximum": "/prepress"
-    }
+def page_has_images(resources, depth: int = 0) -> bool:
+    """Whether a page's resources (or its form XObjects') include an image."""
+    if resources is None or depth > 3:
+        return False
+    xobjects = resources.get_object().get('/XObject')
+    if xobjects is None:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        if xobject.get('/Subtype') == '/Image':
+            return True
+        if xobject.get('/Subtype') == '/Form' and page_has_images(xobject.get('/Resources'), depth + 1):
+            return True
+    return False
 
-    if quality not in quality_settings:
-        raise HTTPException(status_code=400, detail=f"Invalid quality. Choose from: {list(quality_settings.keys())}")
 
-    content = await file.read()
+def text_paragraphs(text: str) -> list[str]:
+    """Rejoin extracted lines into paragraphs.
 
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
+    A paragraph ends at a blank line or at a line noticeably shorter than
+    the page's typical line, which is where a wrapped paragraph stops.
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    lengths = sorted(len(line) for line in lines if line)
+    if not lengths:
+        return []
+    typical = lengths[len(lengths) * 3 // 4]
+
+    paragraphs, current = [], []
+    for line in lines:
+        if line:
+            current.append(line)
+        if current and (not line or len(line) < typical * 0.6):
+            paragraphs.append(' '.join(current))
+            current = []
+    if current:
+        paragraphs.append(' '.join(current))
+    return paragraphs
+
+
+def write_docx(pages: list[str], output_path: str):
+    """Write page texts to a minimal DOCX, one page break between pages."""
+    body = []
+    for index, text in enumerate(pages):
+        if index:
+            body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        for paragraph in text_paragraphs(XML_INVALID_RE.sub('', text)):
+            body.append(f'<w:p><w:r><w:t xml:space="preserve">{xml_escape(paragraph)}</w:t></w:r></w:p>')
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+        + ''.join(body)
+        + '</w:body></w:document>'
+    )
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        docx.writestr('_rels/.rels', DOCX_RELS)
+        docx.writestr('word/document.xml', document)
+
+
+def extract_pdf_text(input_path: str) -> tuple[list[str], float]:
+    """Extract each page's text with pypdf.
+
+    Returns (page_texts, fidelity), where fidelity is the share of pages
+    that lose nothing in a text-only conversion: no images, and either
+    some extracted text or no content at all.
+    """
+    reader = pypdf.PdfReader(input_path)
+    if reader.is_encrypted:
+        reader.decrypt('')
 
-    if not content.startswith(PDF_MAGIC_BYTES):
-        raise HTTPException(status_code=400, detail="Invalid PDF file")
+    texts, faithful = [], 0
+    for page in reader.pages:
+        text = page.extract_text() or ''
+        texts.append(text)
+        if page_has_images(page.get('/Resources')):
+            continue
+        contents = page.get_contents()
+        if len(text.strip()) >= NATIVE_MIN_PAGE_CHARS or contents is None or len(contents.get_data().strip()) == 0:
+            faithful += 1
+    return texts, faithful / max(1, len(texts))
 
-    temp_dir = tempfile.mkdtemp()
-    input_path = os.path.join(temp_dir, 'input.pdf')
-    output_path = os.path.join(temp_dir, 'output.pdf')
 
-    try:
-        with open(input_path, 'wb') as f:
-            f.write(content)
+async def convert_pdf_to_docx_native(input_path: str, output_path: str, min_fidelity: float) -> tuple[bool, str, float]:
+    """Convert PDF to DOCX with pypdf text extraction, without external tools.
 
-        gs_command = [
-            gs_cmd,
-            '-sDEVICE=pdfwrite',
-            '-dCompatibilityLevel=1.4',
-            f'-dPDFSETTINGS={quality_settings[quality]}',
-            '-dNOPAUSE',
-            '-dQUIET',
-            '-dBATCH',
-            f'-sOutputFile={output_path}',
-            input_path
-        ]
+    Much faster than Calibre but text-only, so the result is only written
+    when the estimated fidelity reaches min_fidelity.
 
-        result = subprocess.run(gs_command, capture_output=True, text=True, timeout=120)
+    Returns (success, engine_used or error, fidelity)
+    """
+    if pypdf is None:
+        return False, "pypdf_not_installed", 0.0
 
-        if result.returncode != 0:
-            raise HTTPException(status_code=500, detail=f"Compression failed: {result.stderr}")
+    try:
+        async with admission.slot('pypdf'):
+            texts, fidelity = await asyncio.to_thread(extract_pdf_text, input_path)
+            if fidelity < min_fidelity:
+                return False, f"low_fidelity: {fidelity:.2f}", fidelity
+            await asyncio.to_thread(write_docx, texts, output_path)
+        return True, "native", fidelity
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning(f"Native PDF to DOCX failed: {e}")
+        return False, str(e)[:200], 0.0
 
-        with open(output_path, 'rb') as f:
-            compressed_content = f.read()
 
-        output_filename = file.filename.rsplit('.', 1)[0] + '-compressed.pdf'
+QUALITY_SETTINGS = {
+    "low": "/screen",
+    "medium": "/ebook",
+    "high": "/printer",
+    "maximum": "/prepress"
+}
 
-        return Response(
-            content=compressed_content,
-            media_type='application/pdf',
-            headers={
-                'Content-Disposition': f'attachment; filename="{output_filename}"',
-                'X-Original-Size': str(len(content)),
-                'X-Compressed-Size': str(len(compressed_content)),
-            }
-        )
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="Compression timed out")
 
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+@dataclass
+class OperationResult:
+    """Output of one operation: a file in the work dir plus response metadata."""
+    path: str
+    media_type: str
+    suffix: str
+    headers: dict = field(default_factory=dict)
+    usage: ResourceUsage = None
 
 
-@app.post("/api/lock")
-async def lock_pdf(
-    file: UploadFile = File(...),
-    password: str = Form(...),
-    owner_password: str = Form(None),
-    allow_printing: bool = Form(True),
-    allow_copying: bool = Form(True),
-):
-    """Password protect a PDF file using Ghostscript.
+@dataclass
+class Operation:
+    """An operation that can be run on an uploaded file.
 
-    Args:
-        file: The PDF file to protect
-        password: User password (required to open the PDF)
-        owner_password: Owner password (for changing permissions). If not provided, uses user password.
-        allow_printing: Whether to allow printing (default: True)
-        allow_copying: Whether to allow copying text/images (default: True)
+    check validates the parameters (and tool availability) up front and raises
+    HTTPException; run does the work and returns an OperationResult.
     """
+    run: Callable[..., Awaitable[OperationResult]]
+    check: Callable[..., None]
+    extensions: tuple[str, ...]
+    file_error: str
+    magic: bytes = None
+    cacheable: bool = False
+    secret_params: tuple[str, ...] = ()
+    tool: str = 'ghostscript'
+    # Pass the input's sha256 to run as digest=, for operations with their own caching
+    takes_digest: bool = False
+    # Server settings that change the output, for the result cache key
+    settings: Callable[[], dict] = None
+
+
+def require_ghostscript(purpose: str) -> str:
     gs_cmd = get_ghostscript_command()
     if not gs_cmd:
         raise HTTPException(
             status_code=500,
-            detail="Ghostscript is not installed. PDF encryption requires Ghostscript."
+            detail=f"Ghostscript is not installed. {purpose} requires Ghostscript."
         )
+    return gs_cmd
 
-    if not file.filename or not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="File must be a PDF document")
-
-    if not password or len(password) < 1:
-        raise HTTPException(status_code=400, detail="Password is required")
 
-    content = await file.read()
+def check_pages(pages: str = None):
+    if pages is not None:
+        parse_page_ranges(pages)
 
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
 
-    if not content.startswith(PDF_MAGIC_BYTES):
-        raise HTTPException(status_code=400, detail="Invalid PDF file")
+def check_compress(
+    quality: str = "medium",
+    target_size: int = None,
+    pages: str = None,
+    linearize: bool = False,
+    engine: str = 'ghostscript',
+):
+    if engine not in COMPRESS_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Invalid engine. Choose from: {list(COMPRESS_ENGINES)}")
+    if engine == 'images':
+        if not images_engine_available():
+            raise HTTPException(
+                status_code=500,
+                detail="pypdf or Pillow is not installed. The images compression engine requires both."
+            )
+        if quality == 'auto' or target_size is not None:
+            raise HTTPException(status_code=400, detail="target_size needs the ghostscript engine")
+    else:
+        require_ghostscript("PDF compression")
+    check_pages(pages)
+    if quality != 'auto' and quality not in QUALITY_SETTINGS:
+        raise HTTPException(status_code=400, detail=f"Invalid quality. Choose from: {list(QUALITY_SETTINGS.keys()) + ['auto']}")
+    if quality == 'auto' and target_size is None:
+        raise HTTPException(status_code=400, detail="target_size is required for auto quality")
+    if target_size is not None and (not isinstance(target_size, int) or target_size <= 0):
+        raise HTTPException(status_code=400, detail="target_size must be a positive number of bytes")
+
+
+# Large documents are compressed as page ranges on several Ghostscript
+# processes and stitched back together. Only inputs above both thresholds
+# are page-counted, so small uploads never pay for the extra probe.
+PARALLEL_COMPRESS_MIN_BYTES = int(os.environ.get('PARALLEL_COMPRESS_MIN_BYTES', 5 * 1024 * 1024))
+PARALLEL_COMPRESS_MIN_PAGES = int(os.environ.get('PARALLEL_COMPRESS_MIN_PAGES', 32))
+PARALLEL_COMPRESS_CHUNK_PAGES = int(os.environ.get('PARALLEL_COMPRESS_CHUNK_PAGES', 16))
+PARALLEL_COMPRESS_MAX_CHUNKS = int(os.environ.get('PARALLEL_COMPRESS_MAX_CHUNKS', TOOL_CONCURRENCY['ghostscript']))
+# Most Ghostscript runs one request may have going at once, for page ranges
+# or auto compression candidates, so a single request can't take every slot
+COMPRESS_MAX_FANOUT = int(os.environ.get('COMPRESS_MAX_FANOUT', max(1, TOOL_CONCURRENCY['ghostscript'] // 2)))
+# Parallel output is checked against the input on the pages around each
+# page range boundary: their extracted text must be at least this similar,
+# otherwise the document is compressed again in a single pass
+PARALLEL_COMPRESS_MIN_TEXT_MATCH = float(os.environ.get('PARALLEL_COMPRESS_MIN_TEXT_MATCH', 0.9))
+PARALLEL_COMPRESS_SAMPLE_PAGES = 8
+PARALLEL_COMPRESS_SAMPLE_CHARS = 2000
+
+
+def compress_command(
+    gs_cmd: str,
+    input_path: str,
+    output_path: str,
+    quality: str,
+    page_range: tuple[int, int] = None,
+    resolution: int = None,
+    page_list: str = None,
+    linearize: bool = False,
+) -> list[str]:
+    """Build the Ghostscript pdfwrite command for one compression pass."""
+    command = [
+        gs_cmd,
+        '-sDEVICE=pdfwrite',
+        '-dCompatibilityLevel=1.4',
+        f'-dPDFSETTINGS={QUALITY_SETTINGS[quality]}',
+        '-dNOPAUSE',
+        '-dQUIET',
+        '-dBATCH',
+    ]
+    if resolution:
+        command += [
+            '-dDownsampleColorImages=true',
+            '-dDownsampleGrayImages=true',
+            f'-dColorImageResolution={resolution}',
+            f'-dGrayImageResolution={resolution}',
+        ]
+    if page_range:
+        command += [f'-dFirstPage={page_range[0]}', f'-dLastPage={page_range[1]}']
+    if page_list:
+        command.append(f'-sPageList={page_list}')
+    if linearize:
+        command.append('-dFastWebView=true')
+    return command + [f'-sOutputFile={output_path}', input_path]
 
-    temp_dir = tempfile.mkdtemp()
-    input_path = os.path.join(temp_dir, 'input.pdf')
-    output_path = os.path.join(temp_dir, 'output.pdf')
 
+async def count_pdf_pages(path: str) -> int | None:
+    """Count the pages of a PDF with Ghostscript, or None if it can't be read."""
+    gs_cmd = get_ghostscript_command()
+    if not gs_cmd:
+        return None
+    ps_path = path.replace('\\', '/').replace('(', '\\(').replace(')', '\\)')
+    command = [
+        gs_cmd, '-q', '-dNODISPLAY', '-dSAFER', f'--permit-file-read={path}',
+        '-c', f'({ps_path}) (r) file runpdfbegin pdfpagecount = quit',
+    ]
     try:
-        with open(input_path, 'wb') as f:
-            f.write(content)
+        result = await run_tool('ghostscript', command, timeout=30)
+    except subprocess.TimeoutExpired:
+        return None
+    lines = result.stdout.split()
+    if result.returncode != 0 or not lines or not lines[-1].isdigit():
+        return None
+    return int(lines[-1])
 
-        # Calculate permissions value
-        # Base permissions: -64 allows nothing
-        # Add 4 for printing, add 16 for copying
-        # Ghostscript uses negative values for restrictions
-        permissions = -64
-        if allow_printing:
-            permissions += 4
-        if allow_copying:
-            permissions += 16
 
-        owner_pwd = owner_password if owner_password else password
+async def select_pages(input_path: str, pages: str) -> tuple[str, list[int] | None]:
+    """Check a pages parameter against the document and normalize it.
 
-        gs_command = [
-            gs_cmd,
-            '-dNOPAUSE',
-            '-dBATCH',
-            '-dQUIET',
-            '-sDEVICE=pdfwrite',
-            '-dCompatibilityLevel=1.4',
-            '-dEncryptionR=3',
-            '-dKeyLength=128',
-            f'-sOwnerPassword={owner_pwd}',
-            f'-sUserPassword={password}',
-            f'-dPermissions={permissions}',
-            f'-sOutputFile={output_path}',
-            input_path
-        ]
+    Returns (page_list, numbers): sorted, merged ranges for Ghostscript's
+    -sPageList, and the selected page numbers. When the page count can't be
+    read, the ranges are passed through as given and numbers is None.
+    """
+    ranges = parse_page_ranges(pages)
+    count = await count_pdf_pages(input_path)
+    if count is None:
+        return pages.replace(' ', ''), None
+    numbers = expand_page_ranges(ranges, count)
+    return format_page_list(numbers), numbers
 
-        logger.info(f"Lock PDF: Encrypting with permissions={permissions}")
-        result = subprocess.run(gs_command, capture_output=True, text=True, timeout=120)
 
-        if result.returncode != 0:
-            logger.error(f"Lock PDF failed: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"Encryption failed: {result.stderr}")
+def compress_fanout() -> int:
+    """Ghostscript runs a request may start at once: at most COMPRESS_MAX_FANOUT, and no more than are free."""
+    return max(1, min(COMPRESS_MAX_FANOUT, admission.available('ghostscript')))
 
-        if not os.path.exists(output_path):
-            raise HTTPException(status_code=500, detail="Encryption failed: output file not created")
 
-        with open(output_path, 'rb') as f:
-            locked_content = f.read()
+def parallel_chunk_count(size: int, pages: int | None) -> int:
+    """How many page ranges to compress concurrently; 1 means single pass."""
+    if not pages or size < PARALLEL_COMPRESS_MIN_BYTES or pages < PARALLEL_COMPRESS_MIN_PAGES:
+        return 1
+    return max(1, min(PARALLEL_COMPRESS_MAX_CHUNKS, pages // max(1, PARALLEL_COMPRESS_CHUNK_PAGES)))
 
-        output_filename = file.filename.rsplit('.', 1)[0] + '-locked.pdf'
 
-        return Response(
-            content=locked_content,
-            media_type='application/pdf',
-            headers={
-                'Content-Disposition': f'attachment; filename="{output_filename}"',
-            }
-        )
+async def merge_pdfs(inputs: list[str], output_path: str, linearize: bool = False) -> bool:
+    """Concatenate PDFs in order, with qpdf when installed, else Ghostscript.
+
+    qpdf copies the already-compressed pages without re-encoding them, so
+    the merge costs a fraction of a compression pass.
+    """
+    qpdf_cmd = tool_registry.path('qpdf')
+    if qpdf_cmd:
+        command = [qpdf_cmd, '--empty', '--object-streams=generate', '--pages', *inputs, '--', output_path]
+        if linearize:
+            command.insert(1, '--linearize')
+        tool = 'qpdf'
+    else:
+        command = [
+            get_ghostscript_command(), '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+            '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sOutputFile={output_path}', *inputs,
+        ]
+        if linearize:
+            command.insert(-len(inputs), '-dFastWebView=true')
+        tool = 'ghostscript'
+    try:
+        result = await run_tool(tool, command, timeout=120)
+    except subprocess.TimeoutExpired:
+        return False
+    # qpdf exits with 3 for warnings that still produce a valid file
+    return result.returncode in (0, 3) and os.path.exists(output_path)
+
+
+def extract_pages_pypdf(input_path: str, output_path: str, page_list: str):
+    """Copy the pages page_list selects into a new PDF with pypdf. Blocking; run via asyncio.to_thread."""
+    reader = pypdf.PdfReader(input_path)
+    if reader.is_encrypted:
+        reader.decrypt('')
+    writer = pypdf.PdfWriter()
+    for number in expand_page_ranges(parse_page_ranges(page_list), len(reader.pages)):
+        writer.add_page(reader.pages[number - 1])
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+
+async def extract_pages(input_path: str, output_path: str, page_list: str) -> bool:
+    """Copy the selected pages into a new PDF, with qpdf when installed, else Ghostscript, else pypdf."""
+    qpdf_cmd = tool_registry.path('qpdf')
+    gs_cmd = get_ghostscript_command()
+    if qpdf_cmd:
+        # qpdf spells "to the end" as z
+        ranges = ','.join(part + 'z' if part.endswith('-') else part for part in page_list.split(','))
+        command = [qpdf_cmd, input_path, '--pages', '.', ranges, '--', output_path]
+        tool = 'qpdf'
+    elif not gs_cmd:
+        if pypdf is None:
+            return False
+        try:
+            async with admission.slot('pypdf'):
+                await asyncio.to_thread(extract_pages_pypdf, input_path, output_path, page_list)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.warning(f"Page extraction with pypdf failed: {e}")
+            return False
+        return True
+    else:
+        command = [
+            gs_cmd, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4',
+            '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sPageList={page_list}', f'-sOutputFile={output_path}', input_path,
+        ]
+        tool = 'ghostscript'
+    try:
+        result = await run_tool(tool, command, timeout=120)
+    except subprocess.TimeoutExpired:
+        return False
+    return result.returncode in (0, 3) and os.path.exists(output_path)
+
+
+# A linearized file starts with a dictionary like
+# << /Linearized 1 /L 123456 /H [...] /O 12 /E 3456 /N 10 /T 123000 >>
+# whose /L must match the file's length, or viewers ignore it
+LINEARIZED_RE = re.compile(rb'/Linearized\s+[\d.]+[^>]*?/L\s+(\d+)')
+
+
+def is_linearized(path: str) -> bool:
+    """Whether path is a linearized ("fast web view") PDF."""
+    with open(path, 'rb') as f:
+        match = LINEARIZED_RE.search(f.read(1024))
+    return bool(match) and int(match.group(1)) == os.path.getsize(path)
+
+
+async def linearize_pdf(path: str) -> bool:
+    """Make path a linearized PDF in place, unless it already is one.
+
+    qpdf rewrites the file without touching page content; without it the
+    file goes through one more Ghostscript pdfwrite pass. Returns whether
+    path is linearized afterwards; on failure it is left unchanged.
+    """
+    if await asyncio.to_thread(is_linearized, path):
+        return True
+
+    output_path = path + '.linearized'
+    qpdf_cmd = tool_registry.path('qpdf')
+    if qpdf_cmd:
+        command = [qpdf_cmd, '--linearize', path, output_path]
+        tool = 'qpdf'
+    elif get_ghostscript_command():
+        command = [
+            get_ghostscript_command(), '-sDEVICE=pdfwrite', '-dFastWebView=true',
+            '-dNOPAUSE', '-dQUIET', '-dBATCH', f'-sOutputFile={output_path}', path,
+        ]
+        tool = 'ghostscript'
+    else:
+        logger.warning("Linearize: neither qpdf nor Ghostscript is installed, returning the file as is")
+        return False
+    try:
+        result = await run_tool(tool, command, timeout=120)
+    except subprocess.TimeoutExpired:
+        result = None
+    if result is None or result.returncode not in (0, 3) or not os.path.exists(output_path):
+        logger.warning(f"Linearize: {tool} failed, returning the file as is")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return False
+
+    os.replace(output_path, path)
+    return await asyncio.to_thread(is_linearized, path)
 
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="Encryption timed out")
 
+def page_text_similarity(input_path: str, output_path: str, pairs: list[tuple[int, int]]) -> float:
+    """The lowest text similarity over (input page, output page) pairs, 1-based.
+
+    Whitespace is ignored, since Ghostscript may lay out the same text
+    with different spacing, and only the first PARALLEL_COMPRESS_SAMPLE_CHARS
+    characters of a page are compared. Pages without text on either side
+    match.
+    """
+    def page_text(reader, number: int) -> str:
+        text = ''.join((reader.pages[number - 1].extract_text() or '').split())
+        return text[:PARALLEL_COMPRESS_SAMPLE_CHARS]
+
+    originals, outputs = pypdf.PdfReader(input_path), pypdf.PdfReader(output_path)
+    for reader in (originals, outputs):
+        if reader.is_encrypted:
+            reader.decrypt('')
+    lowest = 1.0
+    for original, output in pairs:
+        expected, actual = page_text(originals, original), page_text(outputs, output)
+        if expected or actual:
+            lowest = min(lowest, difflib.SequenceMatcher(None, expected, actual, autojunk=False).ratio())
+    return lowest
+
+
+async def compress_in_parallel(
+    gs_cmd: str,
+    input_path: str,
+    output_path: str,
+    work_dir: str,
+    quality: str,
+    page_numbers: list[int],
+    chunks: int,
+    linearize: bool = False,
+) -> bool:
+    """Compress page ranges concurrently and merge them into output_path.
+
+    The merged file must have one page per entry of page_numbers, and the
+    pages at each range boundary must have the input's text (when pypdf is
+    installed), otherwise it is discarded and False is returned so the
+    caller can fall back to a single pass. The same goes when a page range
+    is turned away by admission control.
+    """
+    chunk_dir = os.path.join(work_dir, 'chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+    commands = []
+    ranges = split_page_ranges(len(page_numbers), chunks)
+    for index, (first, last) in enumerate(ranges):
+        numbers = page_numbers[first - 1:last]
+        chunk_path = os.path.join(chunk_dir, f'{index:03d}.pdf')
+        if numbers[-1] - numbers[0] == len(numbers) - 1:
+            command = compress_command(gs_cmd, input_path, chunk_path, quality, page_range=(numbers[0], numbers[-1]))
+        else:
+            command = compress_command(gs_cmd, input_path, chunk_path, quality, page_list=format_page_list(numbers))
+        commands.append((chunk_path, command))
+    chunk_paths = [chunk_path for chunk_path, _ in commands]
+
+    tasks = [
+        asyncio.create_task(run_tool('ghostscript', command, timeout=120))
+        for _, command in commands
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+        if any(r.returncode != 0 for r in results) or not all(os.path.exists(p) for p in chunk_paths):
+            logger.warning("Parallel compression: a page range failed")
+            return False
+        if not await merge_pdfs(chunk_paths, output_path, linearize):
+            logger.warning("Parallel compression: merge failed")
+            return False
+    except subprocess.TimeoutExpired:
+        logger.warning("Parallel compression: timed out")
+        return False
+    except HTTPException as e:
+        logger.warning(f"Parallel compression: a page range was turned away ({e.status_code})")
+        return False
     finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    merged_pages = await count_pdf_pages(output_path)
+    if merged_pages != len(page_numbers):
+        logger.warning(f"Parallel compression: merged output has {merged_pages} pages, expected {len(page_numbers)}")
+        os.remove(output_path)
+        return False
+
+    if pypdf is not None:
+        samples = boundary_pages(ranges, PARALLEL_COMPRESS_SAMPLE_PAGES)
+        pairs = [(page_numbers[index - 1], index) for index in samples]
+        try:
+            async with admission.slot('pypdf'):
+                similarity = await asyncio.to_thread(page_text_similarity, input_path, output_path, pairs)
+        except Exception as e:
+            logger.warning(f"Parallel compression: could not compare page text ({e})")
+            similarity = 0.0
+        if similarity < PARALLEL_COMPRESS_MIN_TEXT_MATCH:
+            logger.warning(f"Parallel compression: page text differs from the input (similarity {similarity:.2f})")
+            os.remove(output_path)
+            return False
+    return True
+
+
+# Candidates tried by auto compression, best quality first, as
+# (label, quality preset, image resolution override)
+AUTO_COMPRESS_CANDIDATES = [
+    ('maximum', 'maximum', None),
+    ('high', 'high', None),
+    ('medium', 'medium', None),
+    ('medium-100dpi', 'medium', 100),
+    ('low', 'low', None),
+    ('low-50dpi', 'low', 50),
+]
+
+
+async def compress_to_target(
+    gs_cmd: str, input_path: str, work_dir: str, target_size: int, page_list: str = None
+) -> tuple[str, str, bool]:
+    """Find the best-quality candidate output that fits in target_size bytes.
+
+    Candidates run best quality first, up to compress_fanout() at a time,
+    and the lower-quality ones are cancelled as soon as a better one fits.
+    One that fails or is turned away by admission control just has no
+    output. Returns (path, label, fits); when nothing fits the smallest
+    output is returned, and path is None if every candidate failed, unless
+    some were turned away, when that error (with its Retry-After) is raised.
+    """
+    fanout = asyncio.Semaphore(compress_fanout())
+    turned_away = []
+
+    async def attempt(label: str, quality: str, resolution: int) -> str | None:
+        output_path = os.path.join(work_dir, f'auto-{label}.pdf')
+        command = compress_command(gs_cmd, input_path, output_path, quality, resolution=resolution, page_list=page_list)
+        try:
+            async with fanout:
+                result = await run_tool('ghostscript', command, timeout=120)
+        except subprocess.TimeoutExpired:
+            return None
+        except HTTPException as e:
+            turned_away.append(e)
+            return None
+        if result.returncode != 0 or not os.path.exists(output_path):
+            return None
+        return output_path
+
+    tasks = [asyncio.create_task(attempt(*candidate)) for candidate in AUTO_COMPRESS_CANDIDATES]
+    smallest = (None, None)
+    try:
+        for (label, _, _), task in zip(AUTO_COMPRESS_CANDIDATES, tasks):
+            path = await task
+            if not path:
+                continue
+            if os.path.getsize(path) <= target_size:
+                return path, label, True
+            if smallest[0] is None or os.path.getsize(path) < os.path.getsize(smallest[0]):
+                smallest = (path, label)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if smallest[0] is None and turned_away:
+        raise turned_away[0]
+    return smallest[0], smallest[1], False
+
+
+COMPRESS_ENGINES = ('ghostscript', 'images')
+
+
+async def compress_file(
+    input_path: str,
+    work_dir: str,
+    quality: str = "medium",
+    target_size: int = None,
+    pages: str = None,
+    linearize: bool = False,
+    engine: str = 'ghostscript',
+) -> OperationResult:
+    """Compress a PDF file using Ghostscript.
+
+    With quality 'auto' (or a target_size) the best preset that fits in
+    target_size bytes is picked, unless the input already fits. pages (e.g. '1-3,5') keeps only those
+    pages. The original file is returned unchanged when recompressing the
+    whole document would not make it smaller. linearize makes the output
+    a linearized ("fast web view") PDF, which adds a little to its size.
+    engine 'images' re-encodes the images instead (see compress_images).
+    """
+    output_path = os.path.join(work_dir, 'output.pdf')
+    original_size = os.path.getsize(input_path)
+    headers = {'X-Compression-Engine': engine}
+
+    gs_cmd, page_list, page_numbers = None, None, None
+    if engine == 'ghostscript':
+        gs_cmd = require_ghostscript("PDF compression")
+        if pages:
+            page_list, page_numbers = await select_pages(input_path, pages)
+            headers['X-Pages'] = page_list
+
+    chunks = 1
+    if engine == 'images':
+        label = quality
+        headers.update(await compress_images(input_path, output_path, quality, admission, pages))
+    elif (quality == 'auto' or target_size is not None) and not pages and original_size <= target_size:
+        logger.info(f"Compression: input already fits in {target_size} bytes, returning original")
+        shutil.copyfile(input_path, output_path)
+        label = 'original'
+    elif quality == 'auto' or target_size is not None:
+        path, label, _ = await compress_to_target(gs_cmd, input_path, work_dir, target_size, page_list)
+        if not path:
+            raise HTTPException(status_code=500, detail="Compression failed: no quality setting produced an output")
+        os.replace(path, output_path)
+    else:
+        label = quality
+        if original_size >= PARALLEL_COMPRESS_MIN_BYTES and (page_numbers or not pages):
+            if page_numbers is None:
+                count = await count_pdf_pages(input_path)
+                page_numbers = list(range(1, count + 1)) if count else None
+            chunks = parallel_chunk_count(original_size, len(page_numbers) if page_numbers else None)
+            chunks = min(chunks, compress_fanout())
+            if chunks > 1 and not await compress_in_parallel(
+                gs_cmd, input_path, output_path, work_dir, quality, page_numbers, chunks, linearize
+            ):
+                chunks = 1
+
+        if chunks == 1:
+            command = compress_command(gs_cmd, input_path, output_path, quality, page_list=page_list, linearize=linearize)
+            try:
+                result = await run_tool('ghostscript', command, timeout=120)
+            except subprocess.TimeoutExpired:
+                raise HTTPException(status_code=500, detail="Compression timed out")
+
+            if result.returncode != 0:
+                raise HTTPException(status_code=500, detail=f"Compression failed: {result.stderr}")
+
+            if not os.path.exists(output_path):
+                raise HTTPException(status_code=500, detail="Compression failed: output file not created")
+
+    if not pages and label != 'original' and os.path.getsize(output_path) >= original_size:
+        logger.info(f"Compression: output not smaller than input ({original_size} bytes), returning original")
+        shutil.copyfile(input_path, output_path)
+        label = 'original'
+
+    if linearize:
+        headers['X-Linearized'] = 'true' if await linearize_pdf(output_path) else 'false'
+
+    compressed_size = os.path.getsize(output_path)
+    if original_size:
+        COMPRESSION_RATIO.labels('auto' if target_size is not None else quality).observe(compressed_size / original_size)
+    if target_size is not None:
+        headers['X-Target-Size'] = str(target_size)
+        headers['X-Target-Met'] = 'true' if compressed_size <= target_size else 'false'
+
+    return OperationResult(
+        output_path,
+        'application/pdf',
+        '-compressed.pdf',
+        {
+            'X-Original-Size': str(original_size),
+            'X-Compressed-Size': str(compressed_size),
+            'X-Compression-Chunks': str(chunks),
+            'X-Compression-Quality': label,
+            **headers,
+        },
+    )
+
+
+def check_lock(password: str = None, owner_password: str = None, allow_printing: bool = True, allow_copying: bool = True):
+    require_ghostscript("PDF encryption")
+    if not password or len(password) < 1:
+        raise HTTPException(status_code=400, detail="Password is required")
 
 
-@app.post("/api/unlock")
-async def unlock_pdf(
-    file: UploadFile = File(...),
-    password: str = Form(...),
-):
+def lock_options(
+    password: str,
+    owner_password: str = None,
+    allow_printing: bool = True,
+    allow_copying: bool = True,
+) -> list[str]:
+    """Ghostscript pdfwrite options that encrypt the output."""
+    # Calculate permissions value
+    # Base permissions: -64 allows nothing
+    # Add 4 for printing, add 16 for copying
+    # Ghostscript uses negative values for restrictions
+    permissions = -64
+    if allow_printing:
+        permissions += 4
+    if allow_copying:
+        permissions += 16
+
+    owner_pwd = owner_password if owner_password else password
+
+    return [
+        '-dEncryptionR=3',
+        '-dKeyLength=128',
+        f'-sOwnerPassword={owner_pwd}',
+        f'-sUserPassword={password}',
+        f'-dPermissions={permissions}',
+    ]
+
+
+async def lock_file(
+    input_path: str,
+    work_dir: str,
+    password: str,
+    owner_password: str = None,
+    allow_printing: bool = True,
+    allow_copying: bool = True,
+) -> OperationResult:
+    """Password protect a PDF file using Ghostscript."""
+    gs_cmd = require_ghostscript("PDF encryption")
+    output_path = os.path.join(work_dir, 'output.pdf')
+    options = lock_options(password, owner_password, allow_printing, allow_copying)
+
+    gs_command = [
+        gs_cmd,
+        '-dNOPAUSE',
+        '-dBATCH',
+        '-dQUIET',
+        '-sDEVICE=pdfwrite',
+        '-dCompatibilityLevel=1.4',
+        *options,
+        f'-sOutputFile={output_path}',
+        input_path
+    ]
+
+    logger.info(f"Lock PDF: Encrypting with {options[-1]}")
+    try:
+        result = await run_tool('ghostscript', gs_command, timeout=120)
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=500, detail="Encryption timed out")
+
+    if result.returncode != 0:
+        logger.error(f"Lock PDF failed: {result.stderr}")
+        raise HTTPException(status_code=500, detail=f"Encryption failed: {result.stderr}")
+
+    if not os.path.exists(output_path):
+        raise HTTPException(status_code=500, detail="Encryption failed: output file not created")
+
+    return OperationResult(output_path, 'application/pdf', '-locked.pdf')
+
+
+def check_unlock(password: str = None, linearize: bool = False):
+    require_ghostscript("PDF decryption")
+    if not password:
+        raise HTTPException(status_code=400, detail="Password is required")
+
+
+async def unlock_file(input_path: str, work_dir: str, password: str, linearize: bool = False) -> OperationResult:
     """Remove password protection from a PDF file using Ghostscript.
 
-    Args:
-        file: The password-protected PDF file
-        password: The password to unlock the PDF
+    linearize makes the output a linearized ("fast web view") PDF.
     """
-    gs_cmd = get_ghostscript_command()
-    if not gs_cmd:
+    gs_cmd = require_ghostscript("PDF decryption")
+    output_path = os.path.join(work_dir, 'output.pdf')
+
+    gs_command = [
+        gs_cmd,
+        '-dNOPAUSE',
+        '-dBATCH',
+        '-dQUIET',
+        '-sDEVICE=pdfwrite',
+        '-dCompatibilityLevel=1.4',
+        f'-sPDFPassword={password}',
+        *(['-dFastWebView=true'] if linearize else []),
+        f'-sOutputFile={output_path}',
+        input_path
+    ]
+
+    logger.info("Unlock PDF: Removing password protection")
+    try:
+        result = await run_tool('ghostscript', gs_command, timeout=120)
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=500, detail="Decryption timed out")
+
+    if result.returncode != 0:
+        error_msg = result.stderr.lower()
+        if 'password' in error_msg or 'encrypt' in error_msg:
+            raise HTTPException(status_code=401, detail="Incorrect password")
+        logger.error(f"Unlock PDF failed: {result.stderr}")
+        raise HTTPException(status_code=500, detail=f"Decryption failed: {result.stderr}")
+
+    if not os.path.exists(output_path):
+        raise HTTPException(status_code=500, detail="Decryption failed: output file not created")
+
+    headers = {}
+    if linearize:
+        headers['X-Linearized'] = 'true' if await linearize_pdf(output_path) else 'false'
+    return OperationResult(output_path, 'application/pdf', '-unlocked.pdf', headers)
+
+
+def check_docx_to_pdf(linearize: bool = False):
+    if not get_libreoffice_command():
         raise HTTPException(
             status_code=500,
-            detail="Ghostscript is not installed. PDF decryption requires Ghostscript."
+            detail="LibreOffice is not installed. DOCX to PDF conversion requires LibreOffice."
         )
 
-    if not file.filename or not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="File must be a PDF document")
 
-    if not password:
-        raise HTTPException(status_code=400, detail="Password is required")
+async def docx_to_pdf_file(input_path: str, work_dir: str, linearize: bool = False) -> OperationResult:
+    """Convert a DOCX file to PDF using LibreOffice.
+
+    LibreOffice can't write linearized PDFs, so with linearize the output
+    is linearized afterwards.
+    """
+    check_docx_to_pdf()
+
+    try:
+        async with admission.slot('libreoffice'), libreoffice_pool.acquire() as instance:
+            result, output_path = await instance.convert_to_pdf(input_path, work_dir, timeout=120)
+    except subprocess.TimeoutExpired:
+        raise HTTPException(status_code=500, detail="Conversion timed out")
 
-    content = await file.read()
+    if result.returncode != 0:
+        raise HTTPException(status_code=500, detail=f"Conversion failed: {result.stderr}")
 
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
+    if not os.path.exists(output_path):
+        raise HTTPException(status_code=500, detail="Conversion failed: output PDF not created")
 
-    if not content.startswith(PDF_MAGIC_BYTES):
-        raise HTTPException(status_code=400, detail="Invalid PDF file")
+    headers = {}
+    if linearize:
+        headers['X-Linearized'] = 'true' if await linearize_pdf(output_path) else 'false'
+    return OperationResult(output_path, 'application/pdf', '.pdf', headers)
+
+
+PDF_TO_DOCX_ENGINES = ('auto', 'native', 'calibre')
 
-    temp_dir = tempfile.mkdtemp()
-    input_path = os.path.join(temp_dir, 'input.pdf')
-    output_path = os.path.join(temp_dir, 'output.pdf')
 
+def check_pdf_to_docx(engine: str = 'auto', pages: str = None):
+    check_pages(pages)
+    if engine not in PDF_TO_DOCX_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Invalid engine. Choose from: {list(PDF_TO_DOCX_ENGINES)}")
+    if engine == 'native':
+        if pypdf is None:
+            raise HTTPException(
+                status_code=500,
+                detail="pypdf is not installed. The native PDF to DOCX engine requires pypdf."
+            )
+        return
+    if engine == 'auto' and pypdf is not None:
+        # Calibre is only needed for documents the native engine can't
+        # convert faithfully, which pdf_to_docx_file finds out
+        return
+    if not get_calibre_command():
+        raise HTTPException(
+            status_code=500,
+            detail="Calibre is not installed. PDF to DOCX conversion requires Calibre."
+        )
+    require_ghostscript("PDF flattening")
+
+
+async def pdf_to_docx_file(input_path: str, work_dir: str, engine: str = 'auto', pages: str = None) -> OperationResult:
+    """Convert a PDF file to DOCX.
+
+    The PDF is first flattened using Ghostscript to remove annotations,
+    form fields, and interactive elements for better conversion results,
+    unless a scan shows it has none. With engine 'auto' the native text
+    engine is used when it can convert the document faithfully, and
+    Calibre's ebook-convert otherwise. pages (e.g. '1-3,5') converts only
+    those pages.
+    """
+    check_pdf_to_docx(engine, pages)
+    flattened_path = os.path.join(work_dir, 'flattened.pdf')
+    output_path = os.path.join(work_dir, 'output.docx')
+
+    start_time = time.time()
+    logger.info(f"PDF to DOCX: Processing {os.path.getsize(input_path)} bytes")
+
+    page_list = None
+    if pages:
+        page_list, _ = await select_pages(input_path, pages)
+
+    # Step 1: Flatten the PDF using Ghostscript, if there is anything to flatten
+    report_progress(5, 'scan')
+    with stage_timer('pdf-to-docx', 'scan'):
+        scan = await asyncio.to_thread(scan_pdf, input_path)
+
+    flatten_success = False
+    pdf_to_convert = input_path
+    if not scan.flatten_reasons:
+        logger.info("PDF to DOCX: Nothing to flatten, skipping Ghostscript")
+    else:
+        logger.info(f"PDF to DOCX: Flattening PDF with Ghostscript ({', '.join(scan.flatten_reasons)})...")
+        report_progress(10, 'flatten')
+        with stage_timer('pdf-to-docx', 'flatten'):
+            flatten_success, flatten_error = await flatten_pdf_with_ghostscript(input_path, flattened_path, page_list)
+
+        if flatten_success:
+            logger.info("PDF to DOCX: Flattening successful")
+            pdf_to_convert = flattened_path
+        else:
+            # If flattening fails, proceed with original PDF
+            logger.warning(f"PDF to DOCX: Flattening failed ({flatten_error}), using original PDF")
+
+    if page_list and not flatten_success:
+        # Flattening already kept only the selected pages; otherwise cut them out
+        selected_path = os.path.join(work_dir, 'selected.pdf')
+        with stage_timer('pdf-to-docx', 'select_pages'):
+            if not await extract_pages(input_path, selected_path, page_list):
+                raise HTTPException(status_code=500, detail="Conversion failed: could not extract the selected pages")
+        pdf_to_convert = selected_path
+
+    # Step 2: Convert to DOCX, natively if that is faithful enough, else with Calibre
+    report_progress(40, 'convert')
+    success, fidelity = False, None
+    if engine == 'native' or (engine == 'auto' and pypdf is not None):
+        with stage_timer('pdf-to-docx', 'convert_native'):
+            success, result, fidelity = await convert_pdf_to_docx_native(
+                pdf_to_convert, output_path, 0.0 if engine == 'native' else PDF_TO_DOCX_NATIVE_MIN_FIDELITY
+            )
+        if not success:
+            logger.info(f"PDF to DOCX: Native engine not used ({result})")
+        if not success and engine == 'native':
+            raise HTTPException(status_code=500, detail=f"Conversion failed: {result}")
+
+    if not success:
+        if not get_calibre_command():
+            raise HTTPException(
+                status_code=500,
+                detail=f"Calibre is not installed, and the native engine can't convert this document faithfully ({result})."
+            )
+        with stage_timer('pdf-to-docx', 'convert'):
+            success, result = await convert_pdf_to_docx_calibre(pdf_to_convert, output_path)
+
+    if not success:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Conversion failed: {result}"
+        )
+
+    total_time = time.time() - start_time
+    engine_info = f"{result}+flatten" if flatten_success else result
+    logger.info(f"PDF to DOCX: Completed in {total_time:.2f}s using {engine_info}")
+
+    headers = {'X-Conversion-Engine': engine_info}
+    if page_list:
+        headers['X-Pages'] = page_list
+    if fidelity is not None:
+        headers['X-Conversion-Fidelity'] = f"{fidelity:.2f}"
+    return OperationResult(output_path, DOCX_MEDIA_TYPE, '.docx', headers)
+
+
+RENDER_FORMATS = {
+    # format: (Ghostscript device, media type, file extension)
+    'png': ('png16m', 'image/png', '.png'),
+    'jpeg': ('jpeg', 'image/jpeg', '.jpg'),
+}
+RENDER_MIN_DPI = 10
+RENDER_MAX_DPI = int(os.environ.get('RENDER_MAX_DPI', 300))
+RENDER_MAX_PAGES = int(os.environ.get('RENDER_MAX_PAGES', 100))
+# Pages per Ghostscript process; longer ranges are split and run in parallel
+RENDER_CHUNK_PAGES = 8
+
+
+def check_render(pages: str = "1", dpi: int = 96, image_format: str = "png"):
+    require_ghostscript("page rendering")
+    check_pages(pages)
+    if image_format not in RENDER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Choose from: {list(RENDER_FORMATS.keys())}")
+    if not isinstance(dpi, int) or not RENDER_MIN_DPI <= dpi <= RENDER_MAX_DPI:
+        raise HTTPException(status_code=400, detail=f"dpi must be between {RENDER_MIN_DPI} and {RENDER_MAX_DPI}")
+
+
+def render_chunks(numbers: list[int]) -> list[tuple[int, int]]:
+    """Group page numbers into contiguous (first, last) runs of at most RENDER_CHUNK_PAGES."""
+    chunks = []
+    for number in numbers:
+        if chunks and number == chunks[-1][1] + 1 and number - chunks[-1][0] < RENDER_CHUNK_PAGES:
+            chunks[-1] = (chunks[-1][0], number)
+        else:
+            chunks.append((number, number))
+    return chunks
+
+
+async def render_pages(gs_cmd: str, input_path: str, work_dir: str, numbers: list[int], dpi: int, image_format: str) -> dict:
+    """Render pages with Ghostscript, one process per chunk, all chunks in parallel.
+
+    Returns {page number: image path}.
+    """
+    device, _, extension = RENDER_FORMATS[image_format]
+
+    async def render_chunk(first: int, last: int) -> dict:
+        pattern = os.path.join(work_dir, f'render-{first}-%04d{extension}')
+        command = [
+            gs_cmd,
+            f'-sDEVICE={device}',
+            f'-r{dpi}',
+            '-dTextAlphaBits=4',
+            '-dGraphicsAlphaBits=4',
+            *(['-dJPEGQ=85'] if image_format == 'jpeg' else []),
+            f'-dFirstPage={first}',
+            f'-dLastPage={last}',
+            '-dNOPAUSE',
+            '-dQUIET',
+            '-dBATCH',
+            f'-sOutputFile={pattern}',
+            input_path,
+        ]
+        try:
+            result = await run_tool('ghostscript', command, timeout=120)
+        except subprocess.TimeoutExpired:
+            raise HTTPException(status_code=500, detail="Rendering timed out")
+        if result.returncode != 0:
+            raise HTTPException(status_code=500, detail=f"Rendering failed: {result.stderr}")
+
+        # Ghostscript numbers the files of each run from 1
+        paths = {number: pattern % (number - first + 1) for number in range(first, last + 1)}
+        if not all(os.path.exists(path) for path in paths.values()):
+            raise HTTPException(status_code=500, detail="Rendering failed: output image not created")
+        return paths
+
+    tasks = [asyncio.create_task(render_chunk(first, last)) for first, last in render_chunks(numbers)]
     try:
-        with open(input_path, 'wb') as f:
-            f.write(content)
+        rendered = {}
+        for paths in await asyncio.gather(*tasks):
+            rendered.update(paths)
+        return rendered
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def render_file(
+    input_path: str,
+    work_dir: str,
+    digest: str,
+    pages: str = "1",
+    dpi: int = 96,
+    image_format: str = "png",
+) -> OperationResult:
+    """Render PDF pages to images.
+
+    Each page is cached on its own, keyed by document hash, page, DPI and
+    format, so only pages not rendered before hit Ghostscript. One page is
+    returned as an image, several as a ZIP of page-NNNN images.
+    """
+    gs_cmd = require_ghostscript("page rendering")
+    page_list, numbers = await select_pages(input_path, pages)
+    if numbers is None:
+        raise HTTPException(status_code=400, detail="Could not read the document's pages")
+    if len(numbers) > RENDER_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"Too many pages. Maximum is {RENDER_MAX_PAGES} per request")
+
+    _, media_type, extension = RENDER_FORMATS[image_format]
+    versions = engine_versions('ghostscript', 'libgs')
+    keys = {number: render_cache.key(digest, 'render', versions, page=number, dpi=dpi, format=image_format) for number in numbers}
+    paths = {number: os.path.join(work_dir, f'page-{number:04d}{extension}') for number in numbers}
+
+    with stage_timer('render', 'cache_lookup'):
+        hits = await asyncio.gather(*(render_cache.get(keys[number], paths[number]) for number in numbers))
+    missing = [number for number, hit in zip(numbers, hits) if hit is None]
+
+    if missing:
+        report_progress(10, 'render')
+        with stage_timer('render', 'render'):
+            rendered = await render_pages(gs_cmd, input_path, work_dir, missing, dpi, image_format)
+        for number, path in rendered.items():
+            os.replace(path, paths[number])
+        await render_cache.put_many([(keys[number], paths[number], {}) for number in missing])
+
+    headers = {
+        'X-Pages': page_list,
+        'X-Render-Cached': f'{len(numbers) - len(missing)}/{len(numbers)}',
+        'X-Cache': 'MISS' if missing else 'HIT',
+    }
+    if len(numbers) == 1:
+        return OperationResult(paths[numbers[0]], media_type, f'-page-{numbers[0]}{extension}', headers)
+
+    zip_path = os.path.join(work_dir, 'pages.zip')
+
+    def write_zip():
+        # Images are already compressed; storing is much faster
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+            for number in numbers:
+                zf.write(paths[number], os.path.basename(paths[number]))
+
+    await asyncio.to_thread(write_zip)
+    return OperationResult(zip_path, 'application/zip', '-pages.zip', headers)
+
+
+PIPELINE_MAX_STEPS = 10
 
+
+def check_pipeline(steps: list = None):
+    if not isinstance(steps, list) or not steps:
+        raise HTTPException(status_code=400, detail="steps must be a non-empty JSON list")
+    if len(steps) > PIPELINE_MAX_STEPS:
+        raise HTTPException(status_code=400, detail=f"A pipeline can have at most {PIPELINE_MAX_STEPS} steps")
+
+    checks = {
+        'flatten': lambda: require_ghostscript("PDF flattening"),
+        'compress': check_compress,
+        'lock': check_lock,
+        'unlock': check_unlock,
+    }
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get('operation') not in checks:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Each step needs an operation from: {list(checks.keys())}"
+            )
+        if step['operation'] == 'lock' and index < len(steps) - 1:
+            # Ghostscript can't open the encrypted result in a later pass
+            raise HTTPException(status_code=400, detail="lock must be the last step of a pipeline")
+        params = {k: v for k, v in step.items() if k != 'operation'}
+        if step['operation'] == 'compress' and (params.get('quality') == 'auto' or 'target_size' in params):
+            raise HTTPException(status_code=400, detail="Pipeline compress steps need a fixed quality")
+        unsupported = sorted(params.keys() & {'pages', 'linearize', 'engine'})
+        if unsupported:
+            raise HTTPException(status_code=400, detail=f"Pipeline steps don't support {', '.join(unsupported)}")
+        try:
+            checks[step['operation']](**params)
+        except TypeError:
+            raise HTTPException(status_code=400, detail=f"Invalid parameters for {step['operation']}")
+
+
+def plan_ghostscript_passes(steps: list[dict]) -> list[list[dict]]:
+    """Group pipeline steps into as few Ghostscript pdfwrite passes as possible.
+
+    One pass can decrypt its input (unlock) only as its first step and
+    apply one compression preset. check_pipeline keeps lock, which
+    encrypts the output, to the last step.
+    """
+    passes = []
+    current = []
+    for step in steps:
+        operations = [s['operation'] for s in current]
+        if current and (
+            step['operation'] == 'unlock'
+            or (step['operation'] == 'compress' and 'compress' in operations)
+        ):
+            passes.append(current)
+            current = []
+        current.append(step)
+    passes.append(current)
+    return passes
+
+
+def ghostscript_pass_options(steps: list[dict]) -> list[str]:
+    options = []
+    preset = None
+    for step in steps:
+        if step['operation'] == 'unlock':
+            options.append(f"-sPDFPassword={step['password']}")
+        elif step['operation'] == 'flatten':
+            options.extend(FLATTEN_OPTIONS)
+            preset = preset or '/prepress'
+        elif step['operation'] == 'compress':
+            preset = QUALITY_SETTINGS[step.get('quality', 'medium')]
+        elif step['operation'] == 'lock':
+            params = {k: v for k, v in step.items() if k != 'operation'}
+            options.extend(lock_options(**params))
+    if preset:
+        options.append(f'-dPDFSETTINGS={preset}')
+    return options
+
+
+async def pipeline_file(input_path: str, work_dir: str, steps: list) -> OperationResult:
+    """Apply flatten/compress/lock/unlock steps in order, fusing them into as few Ghostscript runs as possible."""
+    gs_cmd = require_ghostscript("PDF processing")
+    passes = plan_ghostscript_passes(steps)
+    current_path = input_path
+
+    for index, gs_pass in enumerate(passes):
+        output_path = os.path.join(work_dir, f'pass-{index}.pdf')
         gs_command = [
             gs_cmd,
             '-dNOPAUSE',
@@ -426,197 +2664,1066 @@ async def unlock_pdf(
             '-dQUIET',
             '-sDEVICE=pdfwrite',
             '-dCompatibilityLevel=1.4',
-            f'-sPDFPassword={password}',
+            *ghostscript_pass_options(gs_pass),
             f'-sOutputFile={output_path}',
-            input_path
+            current_path
         ]
 
-        logger.info("Unlock PDF: Removing password protection")
-        result = subprocess.run(gs_command, capture_output=True, text=True, timeout=120)
+        logger.info(f"Pipeline: Pass {index + 1}/{len(passes)}: {[s['operation'] for s in gs_pass]}")
+        report_progress(5 + 90 * index // len(passes), f'pass-{index + 1}')
+        try:
+            result = await run_tool('ghostscript', gs_command, timeout=120)
+        except subprocess.TimeoutExpired:
+            raise HTTPException(status_code=500, detail="Pipeline timed out")
 
         if result.returncode != 0:
             error_msg = result.stderr.lower()
-            if 'password' in error_msg or 'encrypt' in error_msg:
+            if gs_pass[0]['operation'] == 'unlock' and ('password' in error_msg or 'encrypt' in error_msg):
                 raise HTTPException(status_code=401, detail="Incorrect password")
-            logger.error(f"Unlock PDF failed: {result.stderr}")
-            raise HTTPException(status_code=500, detail=f"Decryption failed: {result.stderr}")
+            logger.error(f"Pipeline failed: {result.stderr}")
+            raise HTTPException(status_code=500, detail=f"Pipeline failed: {result.stderr}")
 
         if not os.path.exists(output_path):
-            raise HTTPException(status_code=500, detail="Decryption failed: output file not created")
+            raise HTTPException(status_code=500, detail="Pipeline failed: output file not created")
+
+        current_path = output_path
+
+    return OperationResult(
+        current_path,
+        'application/pdf',
+        '-processed.pdf',
+        {
+            'X-Original-Size': str(os.path.getsize(input_path)),
+            'X-Compressed-Size': str(os.path.getsize(current_path)),
+            'X-Ghostscript-Passes': str(len(passes)),
+        },
+    )
+
+
+OPERATIONS = {
+    'compress': Operation(
+        run=compress_file,
+        check=check_compress,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        cacheable=True,
+    ),
+    'lock': Operation(
+        run=lock_file,
+        check=check_lock,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        secret_params=('password', 'owner_password'),
+    ),
+    'unlock': Operation(
+        run=unlock_file,
+        check=check_unlock,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        secret_params=('password',),
+    ),
+    'docx-to-pdf': Operation(
+        run=docx_to_pdf_file,
+        check=check_docx_to_pdf,
+        extensions=('.docx', '.doc'),
+        file_error="File must be a Word document (.doc or .docx)",
+        cacheable=True,
+        tool='libreoffice',
+    ),
+    'pdf-to-docx': Operation(
+        run=pdf_to_docx_file,
+        check=check_pdf_to_docx,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        cacheable=True,
+        tool='calibre',
+        settings=lambda: {'native_min_fidelity': PDF_TO_DOCX_NATIVE_MIN_FIDELITY},
+    ),
+    'render': Operation(
+        run=render_file,
+        check=check_render,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        takes_digest=True,
+    ),
+    'pipeline': Operation(
+        run=pipeline_file,
+        check=check_pipeline,
+        extensions=('.pdf',),
+        file_error="File must be a PDF document",
+        magic=PDF_MAGIC_BYTES,
+        secret_params=('steps',),
+    ),
+}
+
+
+def check_operation(name: str, filename: str, params: dict) -> Operation:
+    """Validate an operation request before any upload is written to disk."""
+    op = OPERATIONS.get(name)
+    if op is None:
+        raise HTTPException(status_code=400, detail=f"Unknown operation. Choose from: {list(OPERATIONS.keys())}")
+
+    if not filename or not filename.lower().endswith(op.extensions):
+        raise HTTPException(status_code=400, detail=op.file_error)
 
-        with open(output_path, 'rb') as f:
-            unlocked_content = f.read()
+    try:
+        op.check(**params)
+    except TypeError:
+        raise HTTPException(status_code=400, detail=f"Invalid parameters for {name}")
 
-        output_filename = file.filename.rsplit('.', 1)[0] + '-unlocked.pdf'
+    return op
 
-        return Response(
-            content=unlocked_content,
-            media_type='application/pdf',
-            headers={
-                'Content-Disposition': f'attachment; filename="{output_filename}"',
-            }
-        )
 
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="Decryption timed out")
+# Lock files that make identical requests in other worker processes wait
+# for the one in flight and then take its result from the cache
+FLIGHT_LOCK_DIR = os.path.join(RUNTIME_DIR, 'flights') if WEB_CONCURRENCY > 1 else None
+
+single_flight = SingleFlight(scratch)
+
+
+def operation_cache_key(name: str, digest: str, params: dict) -> str:
+    """The result cache key for an operation, with parameter defaults, tool versions and settings in it."""
+    op = OPERATIONS[name]
+    params = call_params(op.run, params, skip=('input_path', 'work_dir', 'digest'))
+    return result_cache.key(digest, name, engine_versions(), op.settings() if op.settings else None, **params)
 
+
+async def execute_operation(name: str, input_path: str, digest: str, work_dir: str, params: dict) -> OperationResult:
+    """Run an operation, recording its resource usage, and store its result in the cache."""
+    op = OPERATIONS[name]
+
+    usage = ResourceUsage()
+    token = operation_usage.set(usage)
+    try:
+        with stage_timer(name, 'process'):
+            if op.takes_digest:
+                result = await op.run(input_path, work_dir, digest=digest, **params)
+            else:
+                result = await op.run(input_path, work_dir, **params)
     finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        operation_usage.reset(token)
+        if usage.tool_runs:
+            OPERATION_CPU.labels(name).observe(usage.cpu_seconds)
+            OPERATION_PEAK_RSS.labels(name).observe(usage.peak_rss_bytes)
+    result.usage = usage
+
+    if op.cacheable:
+        await result_cache.put(operation_cache_key(name, digest, params), result.path, {
+            'media_type': result.media_type,
+            'suffix': result.suffix,
+            'headers': result.headers,
+        })
+        result.headers['X-Cache'] = 'MISS'
+
+    return result
+
+
+async def run_operation(name: str, input_path: str, digest: str, work_dir: str, params: dict) -> OperationResult:
+    """Run an operation on a file already on disk, going through the result cache.
+
+    Identical cacheable operations (same input, operation and parameters)
+    that arrive while one is running share its result instead of repeating
+    it, as long as they wait for tool slots the same way: requests that may
+    be shed never share with background jobs, which never are. With the
+    cache disabled every request runs on its own.
+    """
+    op = OPERATIONS[name]
+    if not op.cacheable or not result_cache.enabled:
+        return await execute_operation(name, input_path, digest, work_dir, params)
 
+    cache_key = operation_cache_key(name, digest, params)
+    cached_path = os.path.join(work_dir, 'cached')
+    with stage_timer(name, 'cache_lookup'):
+        cached = await result_cache.get(cache_key, cached_path)
+    if cached is not None:
+        return cached_result(cached_path, cached)
 
-@app.post("/api/docx-to-pdf")
-async def convert_docx_to_pdf(file: UploadFile = File(...)):
-    """Convert a DOCX file to PDF using LibreOffice."""
-    lo_cmd = get_libreoffice_command()
-    if not lo_cmd:
-        raise HTTPException(
-            status_code=500,
-            detail="LibreOffice is not installed. DOCX to PDF conversion requires LibreOffice."
-        )
+    async def work(flight_dir: str) -> OperationResult:
+        async with flight_lock(cache_key, FLIGHT_LOCK_DIR) as waited:
+            if waited:
+                # Another worker process just ran it
+                cached = await result_cache.get(cache_key, cached_path)
+                if cached is not None:
+                    return cached_result(cached_path, cached)
+            return await execute_operation(name, input_path, digest, flight_dir, params)
 
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided")
+    # The flight runs with the context of the caller that starts it, wait policy included
+    flight_key = f'{cache_key}:{admission_max_wait.get()}'
+    result, shared = await single_flight.run(flight_key, work_dir, work)
+    if shared:
+        SINGLE_FLIGHT_SHARED.labels(name).inc()
+        result.headers['X-Cache'] = 'SHARED'
+        result.usage = None
+    return result
 
-    if not file.filename.lower().endswith(('.docx', '.doc')):
-        raise HTTPException(status_code=400, detail="File must be a Word document (.doc or .docx)")
 
-    content = await file.read()
+def cached_result(path: str, cached: dict) -> OperationResult:
+    return OperationResult(path, cached['media_type'], cached['suffix'], {**cached['headers'], 'X-Cache': 'HIT'})
 
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
 
-    temp_dir = tempfile.mkdtemp()
-    input_path = os.path.join(temp_dir, 'input.docx')
+def output_filename(filename: str, suffix: str) -> str:
+    return filename.rsplit('.', 1)[0] + suffix
 
-    try:
-        with open(input_path, 'wb') as f:
-            f.write(content)
-
-        lo_command = [
-            lo_cmd,
-            '--headless',
-            '--convert-to', 'pdf',
-            '--outdir', temp_dir,
-            input_path
-        ]
 
-        result = subprocess.run(lo_command, capture_output=True, text=True, timeout=120)
+# Writes an operation's input to the given path and returns its sha256
+SaveInput = Callable[[str, Operation], Awaitable[str]]
 
-        if result.returncode != 0:
-            raise HTTPException(status_code=500, detail=f"Conversion failed: {result.stderr}")
 
-        output_path = os.path.join(temp_dir, 'input.pdf')
+def upload_saver(file: UploadFile) -> SaveInput:
+    async def save(path: str, op: Operation) -> str:
+        _, digest = await save_upload(file, path, op.magic)
+        return digest
+    return save
 
-        if not os.path.exists(output_path):
-            raise HTTPException(status_code=500, detail="Conversion failed: output PDF not created")
 
-        with open(output_path, 'rb') as f:
-            pdf_content = f.read()
+async def process_upload(name: str, file: UploadFile, **params) -> FileResponse:
+    """Run an operation on an uploaded file and stream back the result."""
+    return await process_input(name, file.filename, file.size or 0, upload_saver(file), params)
+
+
+async def process_input(name: str, filename: str, size_hint: int, save: SaveInput, params: dict) -> FileResponse:
+    """Run an operation on an input that save() writes to disk and stream back the result."""
+    op = check_operation(name, filename, params)
+    admission.check(op.tool)
+
+    with scratch_dir(size_hint) as temp_dir:
+        input_path = os.path.join(temp_dir, 'input' + os.path.splitext(filename)[1].lower())
+        with stage_timer(name, 'write_temp'):
+            digest = await save(input_path, op)
+
+        result = await run_operation(name, input_path, digest, temp_dir, params)
+
+        return file_response(
+            result.path,
+            result.media_type,
+            output_filename(filename, result.suffix),
+            temp_dir,
+            headers=result.headers,
+            operation=name,
+        )
+
+
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 50))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', os.cpu_count() or 2))
+
+
+def unique_name(name: str, taken: set) -> str:
+    base, ext = os.path.splitext(name)
+    candidate = name
+    counter = 1
+    while candidate in taken:
+        candidate = f"{base} ({counter}){ext}"
+        counter += 1
+    taken.add(candidate)
+    return candidate
+
 
-        output_filename = file.filename.rsplit('.', 1)[0] + '.pdf'
+def write_batch_zip(zip_path: str, entries: list[dict], manifest: list[dict]):
+    # Outputs are PDFs/DOCX, which are already compressed; storing is much faster
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zf:
+        for entry in entries:
+            zf.write(entry['path'], entry['name'])
+        zf.writestr('manifest.json', json.dumps(manifest, indent=2))
 
-        return Response(
-            content=pdf_content,
-            media_type='application/pdf',
+
+async def process_batch(name: str, files: list[UploadFile], **params) -> FileResponse:
+    """Run an operation on many uploaded files in parallel and stream back a ZIP.
+
+    A file that fails is reported in manifest.json inside the ZIP instead of
+    failing the whole batch.
+    """
+    if not files:
+        raise HTTPException(status_code=400, detail="No files provided")
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Too many files. Maximum is {BATCH_MAX_FILES} per batch")
+
+    op = OPERATIONS[name]
+    op.check(**params)
+    admission.check(op.tool)
+    semaphore = asyncio.Semaphore(max(1, BATCH_CONCURRENCY))
+
+    async def process_one(file: UploadFile, work_dir: str) -> dict:
+        entry = {'filename': file.filename}
+        async with semaphore:
+            try:
+                check_operation(name, file.filename, params)
+                os.makedirs(work_dir)
+                input_path = os.path.join(work_dir, 'input' + os.path.splitext(file.filename)[1].lower())
+                _, digest = await save_upload(file, input_path, op.magic)
+                result = await run_operation(name, input_path, digest, work_dir, params)
+            except HTTPException as e:
+                entry.update(status='error', status_code=e.status_code, error=str(e.detail))
+            except Exception as e:
+                logger.exception(f"Batch {name}: {file.filename} failed")
+                entry.update(status='error', status_code=500, error=str(e))
+            else:
+                entry.update(
+                    status='ok',
+                    path=result.path,
+                    output=output_filename(file.filename, result.suffix),
+                    headers=result.headers,
+                )
+        return entry
+
+    with scratch_dir(sum(file.size or 0 for file in files)) as temp_dir:
+        start_time = time.time()
+        entries = await asyncio.gather(*(
+            process_one(file, os.path.join(temp_dir, str(i))) for i, file in enumerate(files)
+        ))
+
+        taken = {'manifest.json'}
+        outputs = []
+        for entry in entries:
+            if entry['status'] == 'ok':
+                entry['output'] = unique_name(entry['output'], taken)
+                outputs.append({'path': entry.pop('path'), 'name': entry['output']})
+
+        succeeded = len(outputs)
+        logger.info(
+            f"Batch {name}: {succeeded}/{len(entries)} files succeeded in {time.time() - start_time:.2f}s"
+        )
+
+        zip_path = os.path.join(temp_dir, 'batch.zip')
+        await asyncio.to_thread(write_batch_zip, zip_path, outputs, entries)
+
+        return file_response(
+            zip_path,
+            'application/zip',
+            f'pdf2-{name}.zip',
+            temp_dir,
             headers={
-                'Content-Disposition': f'attachment; filename="{output_filename}"',
-            }
+                'X-Batch-Succeeded': str(succeeded),
+                'X-Batch-Failed': str(len(entries) - succeeded),
+            },
+            operation=f'batch-{name}',
         )
 
-    except subprocess.TimeoutExpired:
-        raise HTTPException(status_code=500, detail="Conversion timed out")
 
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+@app.post("/api/compress")
+async def compress_pdf(
+    file: UploadFile = File(...),
+    quality: str = Form("medium"),
+    target_size: int = Form(None),
+    pages: str = Form(None),
+    linearize: bool = Form(False),
+    engine: str = Form("ghostscript"),
+):
+    """Compress a PDF file using Ghostscript.
+
+    Pass quality=auto with target_size (bytes) to get the best quality that fits,
+    pages (e.g. 1-3,5) to keep only those pages, and linearize=true for a
+    linearized ("fast web view") PDF that viewers can show before it has
+    fully downloaded. engine=images stores repeated images once and
+    re-encodes each image to suit it (best for scans and slide decks); the
+    savings per image are reported in X-Image-Report.
+    """
+    return await process_upload(
+        'compress', file, quality=quality, target_size=target_size, pages=pages, linearize=linearize, engine=engine
+    )
+
+
+@app.post("/api/lock")
+async def lock_pdf(
+    file: UploadFile = File(...),
+    password: str = Form(...),
+    owner_password: str = Form(None),
+    allow_printing: bool = Form(True),
+    allow_copying: bool = Form(True),
+):
+    """Password protect a PDF file using Ghostscript.
+
+    Args:
+        file: The PDF file to protect
+        password: User password (required to open the PDF)
+        owner_password: Owner password (for changing permissions). If not provided, uses user password.
+        allow_printing: Whether to allow printing (default: True)
+        allow_copying: Whether to allow copying text/images (default: True)
+    """
+    return await process_upload(
+        'lock',
+        file,
+        password=password,
+        owner_password=owner_password,
+        allow_printing=allow_printing,
+        allow_copying=allow_copying,
+    )
+
+
+@app.post("/api/unlock")
+async def unlock_pdf(
+    file: UploadFile = File(...),
+    password: str = Form(...),
+    linearize: bool = Form(False),
+):
+    """Remove password protection from a PDF file using Ghostscript.
+
+    Args:
+        file: The password-protected PDF file
+        password: The password to unlock the PDF
+        linearize: Return a linearized ("fast web view") PDF (default: False)
+    """
+    return await process_upload('unlock', file, password=password, linearize=linearize)
+
+
+@app.post("/api/docx-to-pdf")
+async def convert_docx_to_pdf(file: UploadFile = File(...), linearize: bool = Form(False)):
+    """Convert a DOCX file to PDF using LibreOffice; linearize=true for a linearized PDF."""
+    return await process_upload('docx-to-pdf', file, linearize=linearize)
 
 
 @app.post("/api/pdf-to-docx")
-async def pdf_to_docx_endpoint(file: UploadFile = File(...)):
-    """Convert a PDF file to DOCX using Calibre's ebook-convert.
+async def pdf_to_docx_endpoint(
+    file: UploadFile = File(...),
+    engine: str = Form("auto"),
+    pages: str = Form(None)
+):
+    """Convert a PDF file to DOCX.
 
-    The PDF is first flattened using Ghostscript to remove annotations,
-    form fields, and interactive elements for better conversion results.
+    The PDF is first flattened using Ghostscript when it has annotations,
+    form fields or optional content. engine is 'auto' (default), 'native'
+    (fast, text only) or 'calibre'; the engine used is returned in
+    X-Conversion-Engine. pages (e.g. 1-3,5) converts only those pages.
     """
-    calibre_cmd = get_calibre_command()
-    if not calibre_cmd:
-        raise HTTPException(
-            status_code=500,
-            detail="Calibre is not installed. PDF to DOCX conversion requires Calibre."
-        )
+    return await process_upload('pdf-to-docx', file, engine=engine, pages=pages)
+
+
+# Background job queue. Jobs are persisted in SQLite next to their files so
+# queued work survives a restart; passwords are only ever held in memory.
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'pdf2-jobs'))
+JOB_WORKERS = worker_share(int(os.environ.get('JOB_WORKERS', os.cpu_count() or 2)))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 60 * 60))  # 1 hour
+JOB_MAX_QUEUED_PER_CLIENT = int(os.environ.get('JOB_MAX_QUEUED_PER_CLIENT', 20))
+JOB_MAX_PRIORITY = 9
+
+
+class JobQueue:
+    """Runs queued operations on a pool of asyncio worker tasks."""
+
+    def __init__(self, directory: str, workers: int):
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.store = JobStore(os.path.join(directory, 'jobs.db'))
+        self._secrets = {}
+        self._wakeup = None
+        self._draining = False
+        self._workers = []
+        self._tasks = []
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    async def start(self):
+        await asyncio.to_thread(self.store.init)
+        # Nothing has been claimed yet, so jobs under our pid are left over
+        # from an earlier process that had the same one
+        await self._recover_orphaned({os.getpid()})
+        self._wakeup = asyncio.Event()
+        self._draining = False
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks = [*self._workers, asyncio.create_task(self._sweeper())]
+
+    async def stop(self, drain_timeout: float = 0):
+        """Stop taking jobs, give running ones drain_timeout seconds to finish, then cancel the rest.
+
+        Cancelled jobs stay marked running and are requeued by the next process to start.
+        """
+        self._draining = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._workers and drain_timeout > 0:
+            _, pending = await asyncio.wait(self._workers, timeout=drain_timeout)
+            if pending:
+                logger.warning(f"Jobs: {len(pending)} job(s) still running after {drain_timeout:g}s, stopping them")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._workers = []
+        self._tasks = []
+
+    async def _recover_orphaned(self, stale_pids: set[int] = frozenset()):
+        requeued, failed = await asyncio.to_thread(self.store.recover_orphaned, stale_pids)
+        for job in requeued:
+            logger.info(f"Jobs: Requeued interrupted job {job['id']}")
+        for job in failed:
+            JOBS_FINISHED.labels(job['operation'], 'failed').inc()
+            logger.info(f"Jobs: Job {job['id']} failed, its process is gone")
+
+    async def submit(self, client: str, operation: str, file: UploadFile, params: dict, priority: int) -> dict:
+        return await self.enqueue(client, operation, file.filename, upload_saver(file), params, priority)
+
+    async def enqueue(
+        self, client: str, operation: str, filename: str, save: SaveInput, params: dict, priority: int
+    ) -> dict:
+        """Queue an operation on an input that save() writes into the job's directory."""
+        op = check_operation(operation, filename, params)
+
+        if await asyncio.to_thread(self.store.count_queued, client) >= JOB_MAX_QUEUED_PER_CLIENT:
+            raise HTTPException(status_code=429, detail="Too many queued jobs. Try again later.")
+
+        job_id = uuid.uuid4().hex
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir)
+        try:
+            input_path = os.path.join(job_dir, 'input' + os.path.splitext(filename)[1].lower())
+            digest = await save(input_path, op)
+        except BaseException:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+
+        secrets = {name: params.pop(name) for name in op.secret_params if name in params}
+        if secrets:
+            # Only this process has the secrets, so only it may run the job
+            self._secrets[job_id] = secrets
+
+        job = {
+            'id': job_id,
+            'client': client,
+            'operation': operation,
+            'params': json.dumps(params),
+            'filename': filename,
+            'input_path': input_path,
+            'digest': digest,
+            'priority': priority,
+            'status': 'queued',
+            'created_at': time.time(),
+            'owner_pid': os.getpid() if secrets else None,
+        }
+        await asyncio.to_thread(self.store.insert, job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def cancel(self, job_id: str) -> bool:
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            return False
+        if job['status'] == 'running':
+            raise HTTPException(status_code=409, detail="Job is already running")
+        await asyncio.to_thread(self.store.delete, job_id)
+        self._secrets.pop(job_id, None)
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        return True
+
+    async def _worker(self):
+        while not self._draining:
+            try:
+                job = await asyncio.to_thread(self.store.claim_next, os.getpid())
+            except sqlite3.Error as e:
+                logger.error(f"Jobs: Failed to claim a job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    # Also poll, since other processes may enqueue into the same store
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: dict):
+        job_id = job['id']
+        op = OPERATIONS[job['operation']]
+        params = json.loads(job['params'])
+
+        if op.secret_params:
+            secrets = self._secrets.pop(job_id, None)
+            if secrets is None:
+                await self._finish(job_id, 'failed', error="Job was interrupted by a server restart", status_code=503)
+                return
+            params.update(secrets)
+
+        admission_max_wait.set(None)
+        try:
+            async with ProgressWriter(self.store, job_id):
+                result = await run_operation(
+                    job['operation'], job['input_path'], job['digest'], self.job_dir(job_id), params
+                )
+        except HTTPException as e:
+            await self._finish(job_id, 'failed', error=str(e.detail), status_code=e.status_code)
+        except Exception as e:
+            logger.exception(f"Jobs: Job {job_id} crashed")
+            await self._finish(job_id, 'failed', error=str(e), status_code=500)
+        else:
+            await self._finish(
+                job_id,
+                'done',
+                result_path=result.path,
+                media_type=result.media_type,
+                result_filename=output_filename(job['filename'], result.suffix),
+                headers=json.dumps(result.headers),
+                progress=100,
+                cpu_seconds=result.usage.cpu_seconds if result.usage else None,
+                peak_rss_bytes=result.usage.peak_rss_bytes if result.usage else None,
+            )
 
-    gs_cmd = get_ghostscript_command()
-    if not gs_cmd:
-        raise HTTPException(
-            status_code=500,
-            detail="Ghostscript is not installed. PDF flattening requires Ghostscript."
+    async def _finish(self, job_id: str, status: str, **fields):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job:
+            JOBS_FINISHED.labels(job['operation'], status).inc()
+        await asyncio.to_thread(
+            self.store.update, job_id, status=status, stage=status, finished_at=time.time(), **fields
         )
+        logger.info(f"Jobs: Job {job_id} {status}")
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                # Pick up jobs of a worker process that crashed
+                await self._recover_orphaned()
+                for job in await asyncio.to_thread(self.store.expired, time.time() - JOB_RESULT_TTL):
+                    await asyncio.to_thread(self.store.delete, job['id'])
+                    shutil.rmtree(self.job_dir(job['id']), ignore_errors=True)
+            except Exception as e:
+                logger.warning(f"Jobs: Cleanup failed: {e}")
+
+
+job_queue = JobQueue(JOBS_DIR, JOB_WORKERS)
+
+
+# Resumable uploads (/api/uploads): a file sent as numbered chunks that can be
+# retried or resumed after a dropped connection, then processed in one go
+UPLOADS_DIR = os.environ.get('UPLOADS_DIR', os.path.join(SCRATCH_DISK_DIR, 'pdf2-uploads'))
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get('UPLOAD_SESSION_CHUNK_SIZE', 5 * 1024 * 1024))  # 5MB
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+UPLOAD_SESSION_IDLE_TTL = int(os.environ.get('UPLOAD_SESSION_IDLE_TTL', 60 * 60))
+UPLOAD_MAX_SESSIONS = int(os.environ.get('UPLOAD_MAX_SESSIONS', 200))
+UPLOAD_MAX_SESSIONS_PER_CLIENT = int(os.environ.get('UPLOAD_MAX_SESSIONS_PER_CLIENT', 10))
+
+uploads = UploadSessions(
+    UPLOADS_DIR, UPLOAD_SESSION_CHUNK_SIZE, UPLOAD_SESSION_TTL, UPLOAD_SESSION_IDLE_TTL,
+    UPLOAD_MAX_SESSIONS, UPLOAD_MAX_SESSIONS_PER_CLIENT,
+)
+# Whole-file analyses started when an upload completes
+_upload_analyses = set()
+
+
+def upload_status(session: dict) -> dict:
+    received = set(session['received'])
+    return {
+        'id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunks': session['chunks'],
+        'missing': [index for index in range(session['chunks']) if index not in received],
+        'complete': len(received) == session['chunks'],
+        'expires_at': uploads.expires_at(session),
+        'analysis': session['analysis'],
+        'upload_url': f"/api/uploads/{session['id']}/chunks/{{index}}",
+        'finalize_url': f"/api/uploads/{session['id']}/finalize",
+    }
 
-    if not file.filename or not file.filename.lower().endswith('.pdf'):
-        raise HTTPException(status_code=400, detail="File must be a PDF document")
 
-    start_time = time.time()
-    content = await file.read()
+async def analyze_upload(session: dict):
+    """Analyze the parts of an upload that have arrived: its ends first, then the whole file."""
+    upload_id = session['id']
+    analysis = session['analysis'] or {}
+    is_pdf = session['filename'].lower().endswith('.pdf')
+    complete = len(session['received']) == session['chunks']
 
-    if len(content) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail="File too large. Maximum size is 50MB")
+    if is_pdf and 'version' not in analysis and uploads.ends_received(session):
+        head = await asyncio.to_thread(uploads.read, upload_id, 0, PDF_HEAD_BYTES)
+        tail_start = max(0, session['size'] - PDF_TAIL_BYTES)
+        tail = await asyncio.to_thread(uploads.read, upload_id, tail_start, session['size'] - tail_start)
+        analysis.update(analyze_pdf_ends(head, tail, session['size']))
+        await asyncio.to_thread(uploads.save_analysis, upload_id, analysis)
 
-    if not content.startswith(PDF_MAGIC_BYTES):
-        raise HTTPException(status_code=400, detail="Invalid PDF file")
+    if is_pdf and complete and 'structure' not in analysis:
+        # Runs on the assembled file while the client moves on to finalize
+        task = asyncio.create_task(analyze_complete_upload(upload_id, analysis))
+        _upload_analyses.add(task)
+        task.add_done_callback(_upload_analyses.discard)
+
+
+async def analyze_complete_upload(upload_id: str, analysis: dict):
+    data_path = uploads.data_path(upload_id)
+    try:
+        scan = await asyncio.to_thread(scan_pdf, data_path)
+        if analysis.get('pages') is None:
+            analysis['pages'] = await count_pdf_pages(data_path)
+        analysis['structure'] = {
+            'encrypted': scan.encrypted,
+            'form_fields': scan.acroform,
+            'optional_content': scan.optional_content,
+            'annotations': sorted(scan.annotations),
+            'images': scan.images,
+        }
+        await asyncio.to_thread(uploads.save_analysis, upload_id, analysis)
+    except (OSError, ValueError, HTTPException) as e:
+        # Finalized (and deleted) already, or no tool slot free; analysis is advisory
+        logger.debug(f"Uploads: Analysis of {upload_id} skipped: {e}")
+
+
+def upload_assembler(upload_id: str) -> SaveInput:
+    async def save(path: str, op: Operation) -> str:
+        return await asyncio.to_thread(uploads.assemble, upload_id, path)
+    return save
+
+
+def client_address(request: Request) -> str:
+    """The caller's IP address, for limits a client must not be able to dodge.
+
+    The backend is only reachable through nginx, which sets X-Real-IP to the
+    connecting address in place of any the client sent.
+    """
+    return request.headers.get('x-real-ip') or (request.client.host if request.client else 'unknown')
+
+
+def client_id(request: Request) -> str:
+    """Identify the caller for per-client queue fairness."""
+    return request.headers.get('x-client-id') or client_address(request)
+
+
+def job_status(job: dict) -> dict:
+    status = {
+        'id': job['id'],
+        'operation': job['operation'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'stage': job['stage'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'status_url': f"/api/jobs/{job['id']}",
+    }
+    if job['status'] == 'queued':
+        status['position'] = job_queue.store.queue_position(job)
+    if job['status'] == 'failed':
+        status['error'] = job['error']
+    if job['status'] == 'done':
+        status['result_url'] = f"/api/jobs/{job['id']}/result"
+        if job['cpu_seconds'] is not None:
+            status['usage'] = {'cpu_seconds': job['cpu_seconds'], 'peak_rss_bytes': job['peak_rss_bytes']}
+    return status
+
+
+@app.post("/api/batch/compress")
+async def batch_compress_pdf(
+    files: list[UploadFile] = File(...),
+    quality: str = Form("medium"),
+    target_size: int = Form(None),
+    pages: str = Form(None),
+    linearize: bool = Form(False),
+    engine: str = Form("ghostscript"),
+):
+    """Compress many PDF files; returns a ZIP of results plus manifest.json."""
+    return await process_batch(
+        'compress', files, quality=quality, target_size=target_size, pages=pages, linearize=linearize, engine=engine
+    )
+
+
+@app.post("/api/batch/docx-to-pdf")
+async def batch_convert_docx_to_pdf(files: list[UploadFile] = File(...), linearize: bool = Form(False)):
+    """Convert many DOCX files to PDF; returns a ZIP of results plus manifest.json."""
+    return await process_batch('docx-to-pdf', files, linearize=linearize)
 
-    logger.info(f"PDF to DOCX: Processing {len(content)} bytes")
 
-    temp_dir = tempfile.mkdtemp()
-    input_path = os.path.join(temp_dir, 'input.pdf')
-    flattened_path = os.path.join(temp_dir, 'flattened.pdf')
-    output_path = os.path.join(temp_dir, 'output.docx')
+@app.post("/api/batch/pdf-to-docx")
+async def batch_pdf_to_docx(
+    files: list[UploadFile] = File(...),
+    engine: str = Form("auto"),
+    pages: str = Form(None)
+):
+    """Convert many PDF files to DOCX; returns a ZIP of results plus manifest.json."""
+    return await process_batch('pdf-to-docx', files, engine=engine, pages=pages)
+
+
+@app.post("/api/render")
+async def render_pdf(
+    file: UploadFile = File(...),
+    pages: str = Form("1"),
+    dpi: int = Form(96),
+    image_format: str = Form("png", alias="format"),
+):
+    """Render PDF pages to PNG or JPEG images with Ghostscript.
+
+    Args:
+        file: The PDF file to render
+        pages: Pages to render, e.g. 1-3,5 (default: the first page)
+        dpi: Resolution, 10-300 by default
+        format: png or jpeg
+
+    Returns one image for a single page, or a ZIP of page-NNNN images.
+    Rendered pages are cached, so repeated previews and thumbnails are fast.
+    """
+    return await process_upload('render', file, pages=pages, dpi=dpi, image_format=image_format)
+
 
+@app.post("/api/pipeline")
+async def pipeline_pdf(
+    file: UploadFile = File(...),
+    steps: str = Form(...),
+):
+    """Run several PDF operations server-side in one request.
+
+    Args:
+        file: The PDF file to process
+        steps: JSON list of steps applied in order, each an object with an
+            "operation" (flatten, compress, lock, unlock) and that operation's
+            form fields, e.g. [{"operation": "compress", "quality": "low"},
+            {"operation": "lock", "password": "secret"}]. lock can only be
+            the last step.
+    """
     try:
-        with open(input_path, 'wb') as f:
-            f.write(content)
+        steps = json.loads(steps)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="steps must be a non-empty JSON list")
 
-        # Step 1: Flatten the PDF using Ghostscript
-        logger.info("PDF to DOCX: Flattening PDF with Ghostscript...")
-        flatten_success, flatten_error = flatten_pdf_with_ghostscript(input_path, flattened_path)
+    return await process_upload('pipeline', file, steps=steps)
 
-        if flatten_success:
-            logger.info("PDF to DOCX: Flattening successful")
-            pdf_to_convert = flattened_path
-        else:
-            # If flattening fails, proceed with original PDF
-            logger.warning(f"PDF to DOCX: Flattening failed ({flatten_error}), using original PDF")
-            pdf_to_convert = input_path
 
-        # Step 2: Convert to DOCX using Calibre
-        success, engine = convert_pdf_to_docx_calibre(pdf_to_convert, output_path)
+@app.post("/api/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    file: UploadFile = File(...),
+    operation: str = Form(...),
+    params: str = Form("{}"),
+    priority: int = Form(0),
+):
+    """Queue an operation to run in the background.
 
-        if not success:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Conversion failed: {engine}"
-            )
+    Args:
+        file: The file to process
+        operation: One of the /api operations (compress, lock, unlock, docx-to-pdf, pdf-to-docx, pipeline)
+        params: JSON object with the operation's form fields, e.g. {"quality": "low"}
+        priority: 0-9, higher runs first
+    """
+    try:
+        params = json.loads(params)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
 
-        with open(output_path, 'rb') as f:
-            docx_content = f.read()
+    if not 0 <= priority <= JOB_MAX_PRIORITY:
+        raise HTTPException(status_code=400, detail=f"priority must be between 0 and {JOB_MAX_PRIORITY}")
 
-        total_time = time.time() - start_time
-        engine_info = f"{engine}+flatten" if flatten_success else engine
-        logger.info(f"PDF to DOCX: Completed in {total_time:.2f}s using {engine_info}")
+    job = await job_queue.submit(client_id(request), operation, file, params, priority)
+    return await asyncio.to_thread(job_status, {
+        **job, 'progress': 0, 'stage': None, 'started_at': None, 'finished_at': None,
+    })
 
-        output_filename = file.filename.rsplit('.', 1)[0] + '.docx'
 
-        return Response(
-            content=docx_content,
-            media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            headers={
-                'Content-Disposition': f'attachment; filename="{output_filename}"',
-                'X-Conversion-Engine': engine_info,
-            }
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await asyncio.to_thread(job_status, job)
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Download a finished job's result.
+
+    Range requests are supported, so a viewer can fetch a linearized PDF's
+    first page without downloading the rest.
+    """
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if job['status'] == 'failed':
+        raise HTTPException(status_code=job['status_code'] or 500, detail=job['error'])
+
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail="Job is not finished yet")
+
+    return FileResponse(
+        job['result_path'],
+        media_type=job['media_type'],
+        headers={
+            'Content-Disposition': f'attachment; filename="{job["result_filename"]}"',
+            **json.loads(job['headers'] or '{}'),
+        },
+    )
+
+
+@app.delete("/api/jobs/{job_id}", status_code=204)
+async def delete_job(job_id: str):
+    if not await job_queue.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+
+@app.post("/api/uploads", status_code=201)
+async def create_upload(request: Request, filename: str = Form(...), size: int = Form(...)):
+    """Start a resumable upload.
+
+    Send the file as the returned number of chunks with
+    PUT /api/uploads/{id}/chunks/{index}, then process it with
+    POST /api/uploads/{id}/finalize. Chunks can be sent in any order, in
+    parallel and again after a failure; GET /api/uploads/{id} lists the
+    ones still missing.
+    """
+    if not filename or not filename.lower().endswith(tuple(ext for op in OPERATIONS.values() for ext in op.extensions)):
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="File is empty")
+    if size > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024 * 1024)}MB"
         )
+    session = await asyncio.to_thread(uploads.create, filename, size, client_address(request))
+    return upload_status({**session, 'received': [], 'analysis': None})
 
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    return upload_status(await asyncio.to_thread(uploads.get, upload_id))
+
+
+@app.put("/api/uploads/{upload_id}/chunks/{index}")
+async def put_upload_chunk(upload_id: str, index: int, request: Request):
+    """Store one chunk of a resumable upload.
+
+    The body is the chunk's bytes and the X-Chunk-SHA256 header their hex
+    sha256; a chunk that doesn't match is rejected and can be sent again.
+    """
+    checksum = request.headers.get('x-chunk-sha256', '').lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', checksum):
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header with the chunk's hex sha256 is required")
+
+    session = await asyncio.to_thread(uploads.get, upload_id)
+    offset, length = uploads.chunk_span(session, index)
+    # A resent chunk counts as missing until it has arrived intact again
+    await asyncio.to_thread(uploads.unmark, upload_id, index)
+
+    size = 0
+    digest = hashlib.sha256()
+    with open(uploads.data_path(upload_id), 'r+b') as f:
+        f.seek(offset)
+        async for chunk in request.stream():
+            if size == 0 and offset == 0 and session['filename'].lower().endswith('.pdf') \
+                    and chunk and not chunk.startswith(PDF_MAGIC_BYTES):
+                # Reject a file that isn't a PDF before the rest of it is sent
+                await asyncio.to_thread(uploads.delete, upload_id)
+                raise HTTPException(status_code=400, detail="Invalid PDF file")
+            size += len(chunk)
+            if size > length:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} must be {length} bytes")
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+
+    if size != length:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {length} bytes")
+    if digest.hexdigest() != checksum:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} checksum mismatch")
+
+    session = await asyncio.to_thread(uploads.mark_received, upload_id, index, checksum)
+    await analyze_upload(session)
+    return upload_status(await asyncio.to_thread(uploads.get, upload_id))
+
+
+@app.post("/api/uploads/{upload_id}/finalize")
+async def finalize_upload(
+    upload_id: str,
+    request: Request,
+    operation: str = Form(...),
+    params: str = Form("{}"),
+    background: bool = Form(False),
+    priority: int = Form(0),
+):
+    """Run an operation on a completed upload.
+
+    The upload session ends once the operation succeeds, or the job is
+    queued; after a failure, finalize can be called again.
+
+    Args:
+        operation: One of the /api operations (compress, lock, unlock, docx-to-pdf, pdf-to-docx, render, pipeline)
+        params: JSON object with the operation's form fields, e.g. {"quality": "low"}
+        background: Queue it as a job (see /api/jobs) instead of waiting for the result
+        priority: 0-9, for background jobs
+    """
+    try:
+        params = json.loads(params)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    if not isinstance(params, dict):
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+
+    session = await asyncio.to_thread(uploads.get, upload_id)
+    save = upload_assembler(upload_id)
+
+    if not background:
+        response = await process_input(operation, session['filename'], session['size'], save, params)
+        await asyncio.to_thread(uploads.delete, upload_id)
+        return response
+
+    if not 0 <= priority <= JOB_MAX_PRIORITY:
+        raise HTTPException(status_code=400, detail=f"priority must be between 0 and {JOB_MAX_PRIORITY}")
+    job = await job_queue.enqueue(client_id(request), operation, session['filename'], save, params, priority)
+    await asyncio.to_thread(uploads.delete, upload_id)
+    return JSONResponse(status_code=202, content=await asyncio.to_thread(job_status, {
+        **job, 'progress': 0, 'stage': None, 'started_at': None, 'finished_at': None,
+    }))
+
+
+@app.delete("/api/uploads/{upload_id}", status_code=204)
+async def delete_upload(upload_id: str):
+    await asyncio.to_thread(uploads.get, upload_id)
+    await asyncio.to_thread(uploads.delete, upload_id)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics."""
+    try:
+        JOBS_QUEUED.set(await asyncio.to_thread(job_queue.store.count_all_queued))
+    except sqlite3.Error:
+        pass
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Several worker processes: report the sum of all of them
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
+
+
+@app.get("/queue")
+async def queue_stats():
+    """Report tool slots in use, requests waiting for them, scratch space and background jobs."""
+    stats = admission.stats()
+    stats['ghostscript_engine'] = 'libgs' if ghostscript_pool.enabled else 'cli'
+    stats['scratch'] = scratch.stats()
+    stats['jobs_queued'] = await asyncio.to_thread(job_queue.store.count_all_queued)
+    return stats
+
+
+@app.get("/ready")
+async def readiness_check():
+    """Report whether the external tools are installed and working."""
+    if TOOL_SNAPSHOT:
+        # Pick up a refresh done by another worker
+        await asyncio.to_thread(tool_registry.load, TOOL_SNAPSHOT)
+    tools = tool_registry.status()
+    ready = all(tools[name]['available'] for name in REQUIRED_TOOLS)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else "degraded",
+            "refreshed_at": tool_registry.refreshed_at,
+            "tools": tools,
+        },
+    )
+
+
+@app.post("/ready/refresh")
+async def refresh_tools():
+    """Re-detect external tools, e.g. after installing one, without a restart."""
+    if tool_registry.refreshed_at and time.time() - tool_registry.refreshed_at < TOOL_REFRESH_INTERVAL:
+        raise HTTPException(status_code=429, detail="Tools were refreshed recently. Try again later.")
+    await asyncio.to_thread(tool_registry.refresh, TOOL_SNAPSHOT)
+    return await readiness_check()
@@ -0,0 +1,104 @@
+"""Prometheus metrics, served on /metrics, and per-operation resource accounting."""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from prometheus_client import Counter, Gauge, Histogram
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUESTS = Counter('pdf2_requests_total', 'HTTP requests', ['endpoint', 'method', 'status'])
+REQUEST_DURATION = Histogram(
+    'pdf2_request_duration_seconds', 'HTTP request latency', ['endpoint'], buckets=DURATION_BUCKETS
+)
+REQUEST_BYTES = Counter('pdf2_request_bytes_total', 'Request body bytes received', ['endpoint'])
+RESPONSE_BYTES = Counter('pdf2_response_bytes_total', 'Response body bytes sent', ['endpoint'])
+STAGE_DURATION = Histogram(
+    'pdf2_stage_duration_seconds', 'Time spent per processing stage', ['operation', 'stage'],
+    buckets=DURATION_BUCKETS,
+)
+COMPRESSION_RATIO = Histogram(
+    'pdf2_compression_ratio', 'Compressed size / original size', ['quality'],
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25, 1.5, 2.0),
+)
+TOOL_DURATION = Histogram(
+    'pdf2_tool_duration_seconds', 'External tool wall time', ['tool'], buckets=DURATION_BUCKETS
+)
+TOOL_CPU = Counter('pdf2_tool_cpu_seconds_total', 'External tool CPU time (user + system)', ['tool'])
+OPERATION_CPU = Histogram(
+    'pdf2_operation_cpu_seconds', 'CPU time of all tool processes in one operation', ['operation'],
+    buckets=DURATION_BUCKETS,
+)
+OPERATION_PEAK_RSS = Histogram(
+    'pdf2_operation_peak_rss_bytes', 'Largest tool process peak RSS in one operation', ['operation'],
+    buckets=(16e6, 64e6, 128e6, 256e6, 512e6, 1e9, 2e9, 4e9),
+)
+TOOL_MAX_RSS = Histogram(
+    'pdf2_tool_max_rss_bytes', 'External tool peak resident memory', ['tool'],
+    buckets=tuple(mb * 1024 * 1024 for mb in (16, 32, 64, 128, 256, 512, 1024, 2048)),
+)
+TOOL_TIMEOUTS = Counter('pdf2_tool_timeouts_total', 'External tool runs killed on timeout', ['tool'])
+TOOL_RUNNING = Gauge(
+    'pdf2_tool_running', 'External tool processes running', ['tool'], multiprocess_mode='livesum'
+)
+TOOL_WAITING = Gauge(
+    'pdf2_tool_waiting', 'Requests waiting for a tool slot', ['tool'], multiprocess_mode='livesum'
+)
+ADMISSION_WAIT = Histogram('pdf2_admission_wait_seconds', 'Time spent waiting for a tool slot', ['tool'])
+ADMISSION_REJECTED = Counter('pdf2_admission_rejected_total', 'Tool runs shed by admission control', ['tool', 'reason'])
+SCRATCH_DIRS = Gauge(
+    'pdf2_scratch_dirs', 'Scratch directories in use', ['location'], multiprocess_mode='livesum'
+)
+SCRATCH_RAM_RESERVED = Gauge(
+    'pdf2_scratch_ram_reserved_bytes', 'RAM-backed scratch space reserved', multiprocess_mode='livesum'
+)
+SCRATCH_USAGE = Histogram(
+    'pdf2_scratch_usage_bytes', 'Scratch space used by one request', ['location'],
+    buckets=(1e5, 1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9),
+)
+SCRATCH_SWEPT = Counter('pdf2_scratch_swept_total', 'Stale scratch directories removed')
+IMAGE_BYTES_SAVED = Counter(
+    'pdf2_image_bytes_saved_total', 'Bytes saved on images by the images compression engine', ['codec']
+)
+SINGLE_FLIGHT_SHARED = Counter(
+    'pdf2_single_flight_shared_total', 'Requests served by an identical operation already in flight', ['operation']
+)
+JOBS_QUEUED = Gauge('pdf2_jobs_queued', 'Background jobs waiting to run', multiprocess_mode='mostrecent')
+JOBS_FINISHED = Counter('pdf2_jobs_finished_total', 'Background jobs finished', ['operation', 'status'])
+
+
+@dataclass
+class ResourceUsage:
+    """Resources used by the tool processes of one operation."""
+    tool_runs: int = 0
+    cpu_seconds: float = 0.0
+    peak_rss_bytes: int = 0
+
+
+# Usage of the operation currently running, shared with the tasks it spawns
+operation_usage: ContextVar[ResourceUsage | None] = ContextVar('operation_usage', default=None)
+
+
+def record_tool_usage(tool: str, result):
+    TOOL_DURATION.labels(tool).observe(result.wall_time)
+    if result.cpu_time is not None:
+        TOOL_CPU.labels(tool).inc(result.cpu_time)
+    if result.max_rss is not None:
+        TOOL_MAX_RSS.labels(tool).observe(result.max_rss)
+
+    usage = operation_usage.get()
+    if usage is not None:
+        usage.tool_runs += 1
+        usage.cpu_seconds += result.cpu_time or 0
+        usage.peak_rss_bytes = max(usage.peak_rss_bytes, result.max_rss or 0)
+
+
+@contextmanager
+def stage_timer(operation: str, stage: str):
+    """Record how long a block takes as one processing stage of an operation."""
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(operation, stage).observe(time.monotonic() - start_time)
@@ -0,0 +1,72 @@
+"""Page range parameters: parsing '1-3,5,8-' and turning it into page numbers."""
+import re
+
+from fastapi import HTTPException
+
+PAGE_RANGES_RE = re.compile(r'^\d+(-\d*)?(,\d+(-\d*)?)*$')
+
+
+def parse_page_ranges(pages: str) -> list[tuple[int, int | None]]:
+    """Parse '1-3,5,8-' into [(1, 3), (5, 5), (8, None)]; raise 400 if malformed."""
+    pages = pages.replace(' ', '') if isinstance(pages, str) else ''
+    if not PAGE_RANGES_RE.match(pages):
+        raise HTTPException(status_code=400, detail="pages must look like 1-3,5,8- (1-based, inclusive)")
+    ranges = []
+    for part in pages.split(','):
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = (int(last) if last else None) if '-' in part else first
+        if first < 1 or (last is not None and last < first):
+            raise HTTPException(status_code=400, detail=f"Invalid page range: {part}")
+        ranges.append((first, last))
+    return ranges
+
+
+def format_page_list(numbers: list[int]) -> str:
+    """Format sorted page numbers as compact ranges, e.g. [1, 2, 3, 5] -> '1-3,5'."""
+    parts = []
+    start = previous = numbers[0]
+    for number in numbers[1:] + [None]:
+        if number == previous + 1:
+            previous = number
+            continue
+        parts.append(str(start) if start == previous else f'{start}-{previous}')
+        start = previous = number
+    return ','.join(parts)
+
+
+def expand_page_ranges(ranges: list[tuple[int, int | None]], count: int) -> list[int]:
+    """The sorted page numbers ranges select in a count-page document; raise 400 if one starts past the end."""
+    if any(first > count for first, _ in ranges):
+        raise HTTPException(status_code=400, detail=f"pages must be between 1 and {count}")
+    return sorted({
+        number for first, last in ranges for number in range(first, min(last or count, count) + 1)
+    })
+
+
+def split_page_ranges(pages: int, chunks: int) -> list[tuple[int, int]]:
+    """Split 1..pages into `chunks` contiguous, near-equal (first, last) ranges."""
+    size, extra = divmod(pages, chunks)
+    ranges = []
+    first = 1
+    for index in range(chunks):
+        last = first + size - 1 + (1 if index < extra else 0)
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+
+def boundary_pages(ranges: list[tuple[int, int]], limit: int) -> list[int]:
+    """The first and last page of each (first, last) range, sorted, at most limit of them.
+
+    When there are more, the document's first and last pages are kept and
+    the rest are spread evenly over the boundaries in between.
+    """
+    pages = sorted({page for first, last in ranges for page in (first, last)})
+    if len(pages) <= limit:
+        return pages
+    if limit < 2:
+        return pages[:limit]
+    inner = pages[1:-1]
+    step = len(inner) / (limit - 2)
+    return [pages[0]] + [inner[int(index * step)] for index in range(limit - 2)] + [pages[-1]]
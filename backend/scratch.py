@@ -0,0 +1,182 @@
+"""Per-request scratch directories, in RAM while there's quota, and a sweeper for leftovers."""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .metrics import SCRATCH_DIRS, SCRATCH_RAM_RESERVED, SCRATCH_SWEPT, SCRATCH_USAGE
+
+logger = logging.getLogger(__name__)
+
+# Directories older than this are removed even if their process is alive
+SCRATCH_STALE_AGE = int(os.environ.get('SCRATCH_STALE_AGE', 2 * 3600))
+SCRATCH_SWEEP_INTERVAL = 600
+# Scratch bytes reserved per uploaded byte: input, output and intermediates
+SCRATCH_SIZE_FACTOR = 3
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchManager:
+    """Hands out per-request scratch directories, in RAM while there's quota.
+
+    Each request reserves SCRATCH_SIZE_FACTOR times its upload size. It gets
+    a RAM-backed directory when that fits in both the quota and the free
+    space of the RAM filesystem (which other workers share), and a disk
+    directory otherwise. Directories are named <pid>-<random> so the
+    sweeper can remove those left behind by a crashed process. A directory
+    can be held by others than the request that created it, and is removed
+    once all of them have released it.
+    """
+
+    def __init__(self, ram_dir: str, ram_quota: int, disk_dir: str):
+        self.ram_root = os.path.join(ram_dir, 'pdf2-scratch') if ram_dir and ram_quota > 0 else None
+        self.disk_root = os.path.join(disk_dir, 'pdf2-scratch')
+        self.ram_quota = ram_quota
+        self.ram_reserved = 0
+        self._dirs = {}
+        # References beyond the creator's, for directories that have any
+        self._holds = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def _ram_fits(self, estimate: int) -> bool:
+        if self.ram_reserved + estimate > self.ram_quota:
+            return False
+        try:
+            stat = os.statvfs(self.ram_root)
+        except OSError:
+            return False
+        # Leave headroom for whatever else lives in shared memory
+        return estimate <= stat.f_bavail * stat.f_frsize * 0.8
+
+    def create(self, size_hint: int = 0) -> str:
+        estimate = size_hint * SCRATCH_SIZE_FACTOR
+        with self._lock:
+            location, reserved = 'disk', 0
+            if self.ram_root:
+                try:
+                    os.makedirs(self.ram_root, exist_ok=True)
+                    if self._ram_fits(estimate):
+                        location, reserved = 'ram', estimate
+                except OSError as e:
+                    logger.warning(f"Scratch: RAM directory unusable ({e}), using disk")
+                    self.ram_root = None
+
+            root = self.ram_root if location == 'ram' else self.disk_root
+            os.makedirs(root, exist_ok=True)
+            path = tempfile.mkdtemp(prefix=f'{os.getpid()}-', dir=root)
+            self._dirs[path] = (location, reserved)
+            self.ram_reserved += reserved
+        SCRATCH_DIRS.labels(location).inc()
+        SCRATCH_RAM_RESERVED.set(self.ram_reserved)
+        return path
+
+    def hold(self, path: str) -> bool:
+        """Keep path until one more release(). Returns False, holding nothing, if path isn't a scratch directory."""
+        with self._lock:
+            if path not in self._dirs:
+                return False
+            self._holds[path] = self._holds.get(path, 0) + 1
+        return True
+
+    def release(self, path: str):
+        """Drop a reference to a directory; with the last one, record how much space it used and remove it."""
+        with self._lock:
+            holds = self._holds.pop(path, 0)
+            if holds:
+                if holds > 1:
+                    self._holds[path] = holds - 1
+                return
+            location, reserved = self._dirs.pop(path, ('disk', 0))
+        used = directory_size(path)
+        SCRATCH_USAGE.labels(location).observe(used)
+        if reserved and used > reserved:
+            logger.info(f"Scratch: Request used {used} bytes of RAM, {reserved} reserved")
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self.ram_reserved -= reserved
+        SCRATCH_DIRS.labels(location).dec()
+        SCRATCH_RAM_RESERVED.set(self.ram_reserved)
+
+    def sweep(self, max_age: float = SCRATCH_STALE_AGE) -> int:
+        """Remove directories whose process is gone, or that are older than max_age."""
+        removed = 0
+        now = time.time()
+        for root in (self.ram_root, self.disk_root):
+            if not root or not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                pid = entry.name.split('-', 1)[0]
+                with self._lock:
+                    if entry.path in self._dirs:
+                        continue
+                try:
+                    age = now - entry.stat().st_mtime
+                except OSError:
+                    continue
+                if not pid.isdigit() or not process_alive(int(pid)):
+                    stale = True
+                elif int(pid) == os.getpid():
+                    # Ours but untracked: leaked, or from a previous run with the same PID
+                    stale = age > 60
+                else:
+                    stale = age > max_age
+                if stale:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        if removed:
+            SCRATCH_SWEPT.inc(removed)
+            logger.info(f"Scratch: Removed {removed} stale directories")
+        return removed
+
+    async def start(self):
+        await asyncio.to_thread(self.sweep)
+        self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(SCRATCH_SWEEP_INTERVAL)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.warning(f"Scratch: Sweep failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            locations = [location for location, _ in self._dirs.values()]
+        return {
+            'ram_dir': self.ram_root,
+            'disk_dir': self.disk_root,
+            'ram_quota': self.ram_quota if self.ram_root else 0,
+            'ram_reserved': self.ram_reserved,
+            'dirs': {'ram': locations.count('ram'), 'disk': locations.count('disk')},
+        }
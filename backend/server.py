@@ -0,0 +1,72 @@
+"""Production entry point: serves the API from several worker processes.
+
+    python -m backend.server
+
+Settings come from the environment:
+    WEB_CONCURRENCY   worker processes (default: one per CPU core)
+    HOST, PORT        address to listen on (default 0.0.0.0:8000)
+    GRACEFUL_TIMEOUT  seconds in-flight requests, and then background jobs,
+                      get to finish after SIGTERM (default 120)
+    FORWARDED_ALLOW_IPS  proxies trusted for X-Forwarded-* (default 127.0.0.1)
+
+The workers share state through the local filesystem: the job queue is one
+SQLite database, results are cached on disk, tools are probed once here and
+the results handed to the workers, and metrics are collected from all of
+them. Tool concurrency limits hold for the whole machine: the workers take
+tool slots from lock files in RUNTIME_DIR, and the LibreOffice and libgs
+daemons are divided between them. The memory and CPU budgets and the wait
+queue are split evenly instead, each worker keeping to its own share of at
+least one, so they are exceeded when set below the number of workers.
+"""
+import logging
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('pdf2.server')
+
+
+def main():
+    runtime_dir = os.environ.setdefault('RUNTIME_DIR', os.path.join(tempfile.gettempdir(), 'pdf2-runtime'))
+
+    # Read by the app at import time, so set before importing any of it here
+    # and inherited by the workers
+    metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(runtime_dir, 'metrics'))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    snapshot = os.environ.setdefault('TOOL_SNAPSHOT', os.path.join(runtime_dir, 'tools.json'))
+
+    from backend.admission import detect_cpu_count
+
+    workers = max(1, int(os.environ.get('WEB_CONCURRENCY') or detect_cpu_count()))
+    os.environ['WEB_CONCURRENCY'] = str(workers)
+
+    from backend.main import GRACEFUL_TIMEOUT, SPLIT_BUDGETS, tool_registry
+
+    for name, total in SPLIT_BUDGETS.items():
+        if total < workers:
+            logger.warning(
+                f"{name}={total} is below the {workers} workers, each of which keeps to a share of at "
+                f"least 1, so up to {workers} may be used; lower WEB_CONCURRENCY or raise {name}"
+            )
+
+    # Probe the external tools once, which also pulls them into the page
+    # cache, instead of once per worker
+    tool_registry.refresh(snapshot)
+
+    logger.info(f"Starting {workers} worker(s)")
+    uvicorn.run(
+        'backend.main:app',
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', 8000)),
+        workers=workers,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        forwarded_allow_ips=os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1'),
+    )
+
+
+if __name__ == '__main__':
+    main()
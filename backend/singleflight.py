@@ -0,0 +1,128 @@
+"""Single flight: concurrent identical operations run once and share the result."""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .cache import link_or_copy
+from .scratch import ScratchManager
+
+logger = logging.getLogger(__name__)
+
+FLIGHT_LOCK_POLL = 0.1
+
+
+@asynccontextmanager
+async def flight_lock(key: str, directory: str | None):
+    """Hold a lock on key shared with the other worker processes, through a file in directory.
+
+    Yields whether another process held it first. Without a directory
+    there are no other processes to share with and nothing is locked.
+    """
+    if fcntl is None or directory is None:
+        yield False
+        return
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{key}.lock')
+    waited = False
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(FLIGHT_LOCK_POLL)
+            try:
+                current = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                current = False
+        except BaseException:
+            os.close(fd)
+            raise
+        if current:
+            break
+        # The holder removed the file on release; lock the one that replaced it
+        os.close(fd)
+    try:
+        yield waited
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.close(fd)
+
+
+@dataclass
+class Flight:
+    task: asyncio.Task
+    # The work dir of the caller that started it, while the flight holds it
+    work_dir: str | None
+    callers: int = 0
+
+
+class SingleFlight:
+    """Runs concurrent identical operations once.
+
+    The first caller for a key starts the work in its own work dir, on the
+    input already there; callers arriving while it runs attach to it. The
+    others get a hard link of the result in their own work dirs. The work
+    is never cancelled by a caller leaving, since its result still lands in
+    the cache, so a scratch work dir is held until the work is done and
+    every caller has its result.
+    """
+
+    def __init__(self, scratch: ScratchManager):
+        self.scratch = scratch
+        self._flights = {}
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: str, work_dir: str, work: Callable[[str], Awaitable]) -> tuple:
+        """Run work(work_dir) unless it is already running for key. Returns (result, shared).
+
+        The result is a dataclass with the path of the output file and a
+        headers dict, which each caller gets its own copy of.
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            held = self.scratch.hold(work_dir)
+            flight = Flight(asyncio.ensure_future(work(work_dir)), work_dir if held else None)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._finished(key, flight))
+
+        flight.callers += 1
+        try:
+            result = await asyncio.shield(flight.task)
+            path = result.path
+            if os.path.dirname(path) != work_dir:
+                path = os.path.join(work_dir, 'result' + os.path.splitext(result.path)[1])
+                await asyncio.to_thread(link_or_copy, result.path, path)
+        finally:
+            flight.callers -= 1
+            self._release(flight)
+        return replace(result, path=path, headers=dict(result.headers)), shared
+
+    def _finished(self, key: str, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled() and flight.task.exception() is not None and flight.callers == 0:
+            logger.warning(f"Single flight: Abandoned operation failed: {flight.task.exception()}")
+        self._release(flight)
+
+    def _release(self, flight: Flight):
+        if flight.callers == 0 and flight.task.done() and flight.work_dir:
+            self.scratch.release(flight.work_dir)
+            flight.work_dir = None
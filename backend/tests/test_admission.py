@@ -0,0 +1,276 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.admission import AdmissionController, MachineSlots, admission_max_wait
+
+
+def make_controller(limits=None, memory_mb=None, memory_budget_mb=10_000, cpu_budget=8, max_queue=8, machine=None):
+    limits = limits or {'ghostscript': 1, 'libreoffice': 1}
+    memory_mb = memory_mb or dict.fromkeys(limits, 100)
+    return AdmissionController(limits, memory_mb, memory_budget_mb, cpu_budget, max_queue, machine)
+
+
+async def hold(controller, tool, started, release, order=None):
+    async with controller.slot(tool):
+        if order is not None:
+            order.append(tool)
+        started.set()
+        await release.wait()
+
+
+def test_grants_up_to_the_tool_limit():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 2})
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert controller.running['ghostscript'] == 2
+        assert controller.waiting('ghostscript') == 1
+        release.set()
+        await asyncio.gather(*tasks)
+        assert controller.running['ghostscript'] == 0
+        assert controller.admitted['ghostscript'] == 3
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_served_in_arrival_order():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1})
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        waiters = []
+        for name in ('a', 'b', 'c'):
+            async def run(name=name):
+                async with controller.slot('ghostscript'):
+                    order.append(name)
+            waiters.append(asyncio.create_task(run()))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiters)
+        assert order == ['a', 'b', 'c']
+
+    asyncio.run(scenario())
+
+
+def test_memory_budget_limits_concurrent_tools():
+    async def scenario():
+        controller = make_controller(
+            limits={'ghostscript': 4, 'libreoffice': 4}, memory_mb={'ghostscript': 300, 'libreoffice': 600},
+            memory_budget_mb=800,
+        )
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, tool, asyncio.Event(), release))
+                 for tool in ('ghostscript', 'libreoffice', 'ghostscript')]
+        await asyncio.sleep(0)
+        assert controller.memory_used_mb == 300
+        assert controller.waiting() == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert controller.memory_used_mb == 0
+
+    asyncio.run(scenario())
+
+
+def test_one_process_runs_even_over_budget():
+    async def scenario():
+        controller = make_controller(limits={'libreoffice': 1}, memory_mb={'libreoffice': 600}, memory_budget_mb=100)
+        async with controller.slot('libreoffice'):
+            assert controller.running['libreoffice'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1}, max_queue=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            async with controller.slot('ghostscript'):
+                pass
+        assert error.value.status_code == 429
+        assert int(error.value.headers['Retry-After']) >= 1
+        release.set()
+        await asyncio.gather(*tasks)
+        assert controller.rejected['ghostscript'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_wait_timeout_is_rejected_with_503():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1})
+        release = asyncio.Event()
+        task = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        admission_max_wait.set(0.01)
+        with pytest.raises(HTTPException) as error:
+            async with controller.slot('ghostscript'):
+                pass
+        assert error.value.status_code == 503
+        assert controller.waiting() == 0
+        release.set()
+        await task
+
+    asyncio.run(scenario())
+
+
+def test_background_callers_wait_instead_of_shedding():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1}, max_queue=0)
+        release = asyncio.Event()
+        task = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+
+        async def background():
+            admission_max_wait.set(None)
+            async with controller.slot('ghostscript'):
+                return True
+
+        waiter = asyncio.create_task(background())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        release.set()
+        assert await waiter
+        await task
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1})
+        release = asyncio.Event()
+        task = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        assert controller.waiting() == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.waiting() == 0
+        release.set()
+        await task
+        assert controller.running['ghostscript'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_caller_for_a_free_tool_is_not_held_behind_another_tool():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 1, 'libreoffice': 1})
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        assert controller.waiting('ghostscript') == 1
+        started = asyncio.Event()
+        other = asyncio.create_task(hold(controller, 'libreoffice', started, release))
+        await asyncio.wait_for(started.wait(), 1)
+        assert controller.running['libreoffice'] == 1
+        release.set()
+        await asyncio.gather(running, queued, other)
+
+    asyncio.run(scenario())
+
+
+def test_small_callers_do_not_overtake_one_waiting_for_memory():
+    async def scenario():
+        controller = make_controller(
+            limits={'ghostscript': 4, 'libreoffice': 4, 'pypdf': 4},
+            memory_mb={'ghostscript': 300, 'libreoffice': 600, 'pypdf': 100},
+            memory_budget_mb=800,
+        )
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        large = asyncio.create_task(hold(controller, 'libreoffice', asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        small = asyncio.create_task(hold(controller, 'pypdf', asyncio.Event(), release, order))
+        await asyncio.sleep(0)
+        assert order == ['ghostscript']
+        assert controller.waiting() == 2
+        release.set()
+        await asyncio.gather(first, large, small)
+        assert order == ['ghostscript', 'libreoffice', 'pypdf']
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_waiter_lets_those_behind_it_start():
+    async def scenario():
+        controller = make_controller(
+            limits={'ghostscript': 4, 'libreoffice': 4, 'pypdf': 4},
+            memory_mb={'ghostscript': 300, 'libreoffice': 600, 'pypdf': 100},
+            memory_budget_mb=800,
+        )
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+
+        async def large():
+            admission_max_wait.set(0.01)
+            async with controller.slot('libreoffice'):
+                pass
+
+        timed_out = asyncio.create_task(large())
+        await asyncio.sleep(0)
+        started = asyncio.Event()
+        small = asyncio.create_task(hold(controller, 'pypdf', started, release))
+        await asyncio.wait_for(started.wait(), 1)
+        with pytest.raises(HTTPException):
+            await timed_out
+        release.set()
+        await asyncio.gather(first, small)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not MachineSlots.supported(), reason='needs fcntl')
+def test_machine_slots_are_shared_between_controllers(tmp_path):
+    async def scenario():
+        # As in two worker processes: separate controllers, one slot directory
+        limits = {'ghostscript': 1}
+        first, second = (
+            make_controller(limits=limits, machine=MachineSlots(str(tmp_path), limits)) for _ in range(2)
+        )
+        release = asyncio.Event()
+        running = asyncio.create_task(hold(first, 'ghostscript', asyncio.Event(), release))
+        await asyncio.sleep(0)
+        started = asyncio.Event()
+        waiting = asyncio.create_task(hold(second, 'ghostscript', started, asyncio.Event()))
+        await asyncio.sleep(0.15)
+        assert not started.is_set()
+        assert second.waiting('ghostscript') == 1
+        release.set()
+        await running
+        await asyncio.wait_for(started.wait(), 1)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert second.running['ghostscript'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_available_counts_running_and_waiting_callers():
+    async def scenario():
+        controller = make_controller(limits={'ghostscript': 3})
+        assert controller.available('ghostscript') == 3
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, 'ghostscript', asyncio.Event(), release)) for _ in range(4)]
+        await asyncio.sleep(0)
+        assert controller.available('ghostscript') == 0
+        release.set()
+        await asyncio.gather(*tasks)
+        assert controller.available('ghostscript') == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+
+from backend.cache import ResultCache, call_params
+
+
+def write(path, data: bytes) -> str:
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 1024 * 1024, 60)
+    key = cache.key('digest', 'compress', quality='low')
+    source = write(tmp_path / 'result.pdf', b'result')
+
+    async def scenario():
+        assert await cache.get(key, str(tmp_path / 'miss.pdf')) is None
+        await cache.put(key, source, {'quality': 'low'})
+        assert await cache.get(key, str(tmp_path / 'hit.pdf')) == {'quality': 'low'}
+
+    asyncio.run(scenario())
+    with open(tmp_path / 'hit.pdf', 'rb') as f:
+        assert f.read() == b'result'
+
+
+def test_key_depends_on_every_part():
+    keys = {
+        ResultCache.key('a', 'compress', quality='low'),
+        ResultCache.key('b', 'compress', quality='low'),
+        ResultCache.key('a', 'docx-to-pdf', quality='low'),
+        ResultCache.key('a', 'compress', quality='high'),
+    }
+    assert len(keys) == 4
+    assert ResultCache.key('a', 'compress', x=1, y=2) == ResultCache.key('a', 'compress', y=2, x=1)
+
+
+def test_expired_entries_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 1024 * 1024, 60)
+    cache._put('key', write(tmp_path / 'result.pdf', b'result'), {})
+    data_path, meta_path = cache._paths('key')
+    with open(meta_path, 'w') as f:
+        f.write('{"created": %f, "result": {}}' % (time.time() - 120))
+    assert cache._get('key', str(tmp_path / 'out.pdf')) is None
+    assert not os.path.exists(data_path)
+
+
+def test_evicts_least_recently_used_over_the_size_limit(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 10, 60)
+    source = write(tmp_path / 'result.pdf', b'123456')
+    cache._put('old', source, {})
+    os.utime(cache._paths('old')[0], (time.time() - 10, time.time() - 10))
+    cache._put('new', source, {})
+    assert not os.path.exists(cache._paths('old')[0])
+    assert os.path.exists(cache._paths('new')[0])
+
+
+def test_disabled_cache_never_stores(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), 0, 60)
+    source = write(tmp_path / 'result.pdf', b'result')
+
+    async def scenario():
+        await cache.put('key', source, {})
+        return await cache.get('key', str(tmp_path / 'out.pdf'))
+
+    assert asyncio.run(scenario()) is None
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_key_fills_in_defaults():
+    def run(input_path, work_dir, quality='medium', pages=None):
+        pass
+
+    implicit = call_params(run, {}, skip=('input_path', 'work_dir'))
+    assert implicit == {'quality': 'medium', 'pages': None}
+    assert ResultCache.key('a', 'compress', **implicit) == ResultCache.key(
+        'a', 'compress', **call_params(run, {'quality': 'medium'}, skip=('input_path', 'work_dir'))
+    )
+
+
+def test_key_depends_on_tool_versions():
+    assert ResultCache.key('a', 'compress', {'ghostscript': '10.02'}, quality='low') != ResultCache.key(
+        'a', 'compress', {'ghostscript': '10.03'}, quality='low'
+    )
+
+
+def test_key_depends_on_settings():
+    assert ResultCache.key('a', 'pdf-to-docx', None, {'native_min_fidelity': 0.95}) != ResultCache.key(
+        'a', 'pdf-to-docx', None, {'native_min_fidelity': 0.8}
+    )
+
+
+def test_keeps_a_running_total_instead_of_rescanning(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / 'cache'), 20, 60)
+    source = write(tmp_path / 'result.pdf', b'123456')
+    cache._put('first', source, {})
+    scans = []
+    real_scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: scans.append(path) or real_scandir(path))
+    cache._put('second', source, {})
+    cache._put('second', source, {})
+    assert scans == [] and cache._total == 12
+    cache._put('third', write(tmp_path / 'large.pdf', b'x' * 10), {})
+    # Over the limit: scanned, and the least recently used entry removed
+    assert len(scans) == 1 and cache._total <= 20
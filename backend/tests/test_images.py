@@ -0,0 +1,182 @@
+import asyncio
+import io
+import json
+import random
+import zlib
+
+import pytest
+
+pypdf = pytest.importorskip('pypdf')
+Image = pytest.importorskip('PIL.Image')
+ImageDraw = pytest.importorskip('PIL.ImageDraw')
+
+from backend.admission import AdmissionController  # noqa: E402
+from backend.images import IMAGE_PRESETS, compress_images, recompress_image  # noqa: E402
+
+
+def build_pdf(pages: list[list[tuple[bytes, bytes, tuple]]]) -> bytes:
+    """A PDF whose pages draw the given (image dictionary entries, data, cm matrix) images."""
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    def stream(entries: bytes, data: bytes) -> bytes:
+        return b'<<%s /Length %d>>\nstream\n%s\nendstream' % (entries, len(data), data)
+
+    page_specs = []
+    for images in pages:
+        resources, content = [], b''
+        for number, (entries, data, matrix) in enumerate(images):
+            image_id = add(stream(b'/Type /XObject /Subtype /Image ' + entries, data))
+            resources.append(b'/Im%d %d 0 R' % (number, image_id))
+            content += b'q %s cm /Im%d Do Q\n' % (' '.join(str(value) for value in matrix).encode(), number)
+        page_specs.append((add(stream(b'', content)), b' '.join(resources)))
+
+    pages_id = len(objects) + len(page_specs) + 1
+    page_ids = [
+        add(b'<</Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources <</XObject <<%s>>>> '
+            b'/Contents %d 0 R>>' % (pages_id, resources, content_id))
+        for content_id, resources in page_specs
+    ]
+    add(b'<</Type /Pages /Kids [%s] /Count %d>>' % (b' '.join(b'%d 0 R' % i for i in page_ids), len(page_ids)))
+    root = add(b'<</Type /Catalog /Pages %d 0 R>>' % pages_id)
+
+    out = io.BytesIO()
+    out.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+    xref = out.tell()
+    out.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b'%010d 00000 n \n' % offset)
+    out.write(b'trailer\n<</Size %d /Root %d 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, root, xref))
+    return out.getvalue()
+
+
+def raw_image(picture) -> tuple[bytes, bytes]:
+    color_space = b'/DeviceGray' if picture.mode == 'L' else b'/DeviceRGB'
+    entries = b'/Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /FlateDecode' % (
+        picture.width, picture.height, color_space,
+    )
+    return entries, zlib.compress(picture.tobytes())
+
+
+def photo(mode: str = 'RGB', size=(400, 300)):
+    noise = Image.effect_noise(size, 40)
+    gradient = Image.linear_gradient('L').resize(size)
+    if mode == 'L':
+        return Image.blend(gradient, noise, 0.3)
+    return Image.merge('RGB', [gradient, noise, Image.radial_gradient('L').resize(size)])
+
+
+def chart():
+    picture = Image.new('RGB', (400, 300), (255, 255, 255))
+    draw = ImageDraw.Draw(picture)
+    for index, color in enumerate([(200, 30, 30), (30, 200, 30), (30, 30, 200)]):
+        draw.rectangle((50 + index * 110, 300 - 80 * (index + 1), 140 + index * 110, 290), fill=color)
+    return picture
+
+
+def first_image(pdf_path: str):
+    reader = pypdf.PdfReader(pdf_path)
+    xobjects = reader.pages[0]['/Resources']['/XObject']
+    return xobjects[next(iter(xobjects))].get_object()
+
+
+def compress(tmp_path, pdf: bytes, quality: str = 'medium') -> tuple[dict, int]:
+    input_path, output_path = tmp_path / 'input.pdf', tmp_path / 'output.pdf'
+    input_path.write_bytes(pdf)
+    admission = AdmissionController({'images': 2, 'pypdf': 1}, {'images': 1, 'pypdf': 1}, 1000, 4, 8)
+    headers = asyncio.run(compress_images(str(input_path), str(output_path), quality, admission))
+    return headers, output_path.stat().st_size
+
+
+def test_color_photo_becomes_jpeg(tmp_path):
+    entries, data = raw_image(photo())
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (400, 0, 0, 300, 100, 300))]]))
+    result = recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 72)
+    assert result is not None
+    stream, codec = result
+    assert codec == 'jpeg'
+    assert stream['/Filter'] == '/DCTDecode'
+    assert len(stream.get_data()) < len(data)
+
+
+def test_gray_photo_becomes_jpeg(tmp_path):
+    entries, data = raw_image(photo('L'))
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (400, 0, 0, 300, 100, 300))]]))
+    stream, codec = recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 72)
+    assert codec == 'jpeg'
+    assert stream['/ColorSpace'] == '/DeviceGray'
+    assert len(stream.get_data()) < len(data)
+
+
+def test_noisy_scan_with_few_grays_becomes_jpeg(tmp_path):
+    # Like the benchmark's scanned pages: noise over a few dozen gray levels
+    noise = random.Random(1)
+    picture = Image.frombytes('L', (400, 300), bytes(220 + noise.randint(-40, 15) for _ in range(400 * 300)))
+    assert len(picture.getcolors(256)) < 64
+    entries, data = raw_image(picture)
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (400, 0, 0, 300, 100, 300))]]))
+    stream, codec = recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 72)
+    assert codec == 'jpeg'
+    assert len(stream.get_data()) < len(data)
+
+
+def test_few_colours_stay_lossless(tmp_path):
+    entries, data = raw_image(chart())
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (400, 0, 0, 300, 100, 300))]]))
+    stream, codec = recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 72)
+    assert codec == 'indexed'
+    assert stream['/ColorSpace'][0] == '/Indexed'
+
+
+def test_black_and_white_gets_one_bit(tmp_path):
+    picture = Image.new('L', (800, 600), 255)
+    draw = ImageDraw.Draw(picture)
+    # Irregular marks, like a line art scan
+    marks = random.Random(1)
+    for _ in range(3000):
+        x, y = marks.randrange(800), marks.randrange(600)
+        draw.rectangle((x, y, x + marks.randrange(1, 8), y + marks.randrange(1, 8)), fill=0)
+    entries, data = raw_image(picture)
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (612, 0, 0, 459, 0, 0))]]))
+    stream, codec = recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 94)
+    assert codec in ('ccitt', 'flate')
+    assert stream['/BitsPerComponent'] == 1
+
+
+def test_small_images_are_left_alone(tmp_path):
+    entries, data = raw_image(Image.new('RGB', (8, 8), (255, 0, 0)))
+    input_path = tmp_path / 'input.pdf'
+    input_path.write_bytes(build_pdf([[(entries, data, (8, 0, 0, 8, 0, 0))]]))
+    assert recompress_image(first_image(str(input_path)), IMAGE_PRESETS['medium'], 72) is None
+
+
+def test_identical_images_are_stored_once(tmp_path):
+    entries, data = raw_image(photo(size=(200, 100)))
+    pdf = build_pdf([[(entries, data, (100, 0, 0, 50, 20, 730))] for _ in range(4)])
+    headers, size = compress(tmp_path, pdf)
+    assert headers['X-Images'] == '4'
+    assert headers['X-Images-Unique'] == '1'
+    assert size < len(pdf)
+    report = json.loads(headers['X-Image-Report'])
+    assert report[0]['copies'] == 4 and report[0]['pages'] == 4
+
+
+def test_downsamples_images_drawn_above_the_target_resolution(tmp_path):
+    entries, data = raw_image(photo(size=(1200, 900)))
+    # 1200 pixels over 2 inches is 600 dpi, well above medium's 150
+    pdf = build_pdf([[(entries, data, (144, 0, 0, 108, 100, 300))]])
+    compress(tmp_path, pdf)
+    image = first_image(str(tmp_path / 'output.pdf'))
+    assert (image['/Width'], image['/Height']) == (300, 225)
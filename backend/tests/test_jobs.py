@@ -0,0 +1,141 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from backend.jobs import JobStore, ProgressWriter, job_progress, report_progress
+
+# PIDs are capped well below this, so no process can own it
+DEAD_PID = 99999999
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs' / 'jobs.db'))
+    store.init()
+    return store
+
+
+def add_job(store, job_id, client='client', priority=0, created_at=None, **fields):
+    job = {
+        'id': job_id,
+        'client': client,
+        'operation': 'compress',
+        'params': '{}',
+        'filename': 'a.pdf',
+        'input_path': f'/tmp/{job_id}.pdf',
+        'digest': 'digest',
+        'priority': priority,
+        'status': 'queued',
+        'created_at': created_at if created_at is not None else time.time(),
+        **fields,
+    }
+    store.insert(job)
+    return job
+
+
+def test_insert_get_update(store):
+    add_job(store, 'a')
+    store.update('a', progress=40, stage='compress')
+    job = store.get('a')
+    assert (job['status'], job['progress'], job['stage']) == ('queued', 40, 'compress')
+    assert store.get('missing') is None
+    store.delete('a')
+    assert store.get('a') is None
+
+
+def test_claims_by_priority_then_age(store):
+    add_job(store, 'old', created_at=1)
+    add_job(store, 'new', created_at=2)
+    add_job(store, 'urgent', priority=5, created_at=3)
+    assert store.queue_position(store.get('new')) == 2
+
+    claimed = [store.claim_next(os.getpid())['id'] for _ in range(3)]
+    assert claimed == ['urgent', 'old', 'new']
+    assert store.claim_next(os.getpid()) is None
+    assert store.get('old')['status'] == 'running'
+
+
+def test_clients_with_fewer_running_jobs_go_first(store):
+    add_job(store, 'busy-1', client='busy', created_at=1)
+    add_job(store, 'busy-2', client='busy', created_at=2)
+    add_job(store, 'quiet-1', client='quiet', created_at=3)
+    assert store.claim_next(os.getpid())['id'] == 'busy-1'
+    assert store.claim_next(os.getpid())['id'] == 'quiet-1'
+
+
+def test_jobs_owned_by_another_process_are_left_to_it(store):
+    add_job(store, 'secret', owner_pid=os.getppid())
+    assert store.claim_next(os.getpid()) is None
+    assert store.claim_next(os.getppid())['id'] == 'secret'
+
+
+def test_recovers_jobs_of_dead_processes(store):
+    add_job(store, 'running')
+    add_job(store, 'secret', owner_pid=DEAD_PID)
+    store.update('running', status='running', worker_pid=DEAD_PID)
+
+    requeued, failed = store.recover_orphaned()
+    assert [job['id'] for job in requeued] == ['running']
+    assert [job['id'] for job in failed] == ['secret']
+    assert store.get('running')['status'] == 'queued'
+    assert (store.get('secret')['status'], store.get('secret')['status_code']) == ('failed', 503)
+
+
+def test_expired_returns_old_finished_jobs(store):
+    add_job(store, 'done', status='done', finished_at=10)
+    add_job(store, 'fresh', status='done', finished_at=time.time())
+    add_job(store, 'queued')
+    assert [job['id'] for job in store.expired(100)] == ['done']
+
+
+def test_report_progress_goes_to_the_current_job():
+    calls = []
+    report_progress(10, 'ignored')
+    token = job_progress.set(lambda percent, stage: calls.append((percent, stage)))
+    try:
+        report_progress(50, 'compress')
+    finally:
+        job_progress.reset(token)
+    assert calls == [(50, 'compress')]
+
+
+class CountingStore:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.updates = []
+
+    def update(self, job_id, **fields):
+        time.sleep(self.delay)
+        self.updates.append(fields)
+
+
+def test_progress_writes_are_throttled():
+    store = CountingStore()
+
+    async def scenario():
+        async with ProgressWriter(store, 'a', interval=0.05):
+            for page in range(1000):
+                report_progress(page // 10, 'pages')
+            await asyncio.sleep(0.2)
+            report_progress(100, 'write')
+            await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert len(store.updates) <= 3
+    assert store.updates[-1] == {'progress': 100, 'stage': 'write'}
+    assert job_progress.get() is None
+
+
+def test_progress_writes_finish_before_the_writer_closes():
+    store = CountingStore(delay=0.1)
+
+    async def scenario():
+        async with ProgressWriter(store, 'a'):
+            report_progress(50, 'compress')
+            await asyncio.sleep(0.01)
+        # The job's final state is written next, so no progress write may follow
+        return len(store.updates)
+
+    assert asyncio.run(scenario()) == 1
@@ -0,0 +1,38 @@
+import pytest
+from fastapi import HTTPException
+
+from backend.pages import boundary_pages, expand_page_ranges, format_page_list, parse_page_ranges, split_page_ranges
+
+
+def test_parse_page_ranges():
+    assert parse_page_ranges('1-3, 5,8-') == [(1, 3), (5, 5), (8, None)]
+    for pages in ('', '0', '3-1', 'a', '1,,2', None):
+        with pytest.raises(HTTPException) as error:
+            parse_page_ranges(pages)
+        assert error.value.status_code == 400
+
+
+def test_expand_page_ranges():
+    assert expand_page_ranges([(8, None), (1, 3), (2, 4)], 9) == [1, 2, 3, 4, 8, 9]
+    assert expand_page_ranges([(1, 100)], 3) == [1, 2, 3]
+    with pytest.raises(HTTPException):
+        expand_page_ranges([(5, None)], 4)
+
+
+def test_format_page_list():
+    assert format_page_list([1, 2, 3, 5, 7, 8]) == '1-3,5,7-8'
+    assert format_page_list([4]) == '4'
+
+
+def test_split_page_ranges():
+    assert split_page_ranges(10, 3) == [(1, 4), (5, 7), (8, 10)]
+    assert split_page_ranges(2, 2) == [(1, 1), (2, 2)]
+
+
+def test_boundary_pages():
+    assert boundary_pages([(1, 4), (5, 7), (8, 10)], 8) == [1, 4, 5, 7, 8, 10]
+    assert boundary_pages([(1, 1), (2, 2)], 8) == [1, 2]
+    sampled = boundary_pages(split_page_ranges(100, 10), 8)
+    assert len(sampled) == 8
+    assert sampled[0] == 1 and sampled[-1] == 100
+    assert sampled == sorted(set(sampled))
@@ -0,0 +1,55 @@
+import os
+
+from backend.scratch import SCRATCH_SIZE_FACTOR, ScratchManager
+
+
+def test_uses_ram_while_the_quota_allows(tmp_path):
+    manager = ScratchManager(str(tmp_path / 'ram'), 10 * SCRATCH_SIZE_FACTOR, str(tmp_path / 'disk'))
+    first = manager.create(10)
+    second = manager.create(10)
+    assert first.startswith(manager.ram_root)
+    assert second.startswith(manager.disk_root)
+    assert manager.ram_reserved == 10 * SCRATCH_SIZE_FACTOR
+    assert manager.stats()['dirs'] == {'ram': 1, 'disk': 1}
+
+    manager.release(first)
+    manager.release(second)
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert manager.ram_reserved == 0
+
+
+def test_without_a_ram_dir_everything_goes_to_disk(tmp_path):
+    manager = ScratchManager('', 1024, str(tmp_path))
+    path = manager.create(1)
+    assert manager.ram_root is None
+    assert path.startswith(manager.disk_root)
+    manager.release(path)
+
+
+def test_held_directories_outlive_their_creators_release(tmp_path):
+    manager = ScratchManager('', 0, str(tmp_path))
+    path = manager.create()
+    assert manager.hold(path)
+    manager.release(path)
+    assert os.path.exists(path)
+    manager.release(path)
+    assert not os.path.exists(path)
+    assert not manager.hold(str(tmp_path / 'not-scratch'))
+
+
+def test_sweep_removes_directories_of_dead_processes(tmp_path):
+    manager = ScratchManager('', 0, str(tmp_path))
+    ours = manager.create()
+    os.makedirs(manager.disk_root, exist_ok=True)
+    # PIDs are capped well below this, so no process can own it
+    orphan = os.path.join(manager.disk_root, '99999999-abc')
+    os.makedirs(orphan)
+    alive = os.path.join(manager.disk_root, f'{os.getppid()}-abc')
+    os.makedirs(alive)
+
+    assert manager.sweep() == 1
+    assert not os.path.exists(orphan)
+    assert os.path.exists(ours) and os.path.exists(alive)
+    assert manager.sweep(max_age=-1) == 1
+    assert not os.path.exists(alive)
+    manager.release(ours)
@@ -0,0 +1,157 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+
+import pytest
+
+from backend.scratch import ScratchManager
+from backend.singleflight import SingleFlight, flight_lock
+
+
+@dataclass
+class Result:
+    path: str
+    headers: dict = field(default_factory=dict)
+
+
+@pytest.fixture
+def scratch(tmp_path):
+    return ScratchManager('', 0, str(tmp_path / 'scratch'))
+
+
+def caller_dir(scratch):
+    return scratch.create()
+
+
+def test_identical_calls_run_once(scratch):
+    runs = []
+    release = asyncio.Event()
+
+    async def work(flight_dir):
+        runs.append(flight_dir)
+        await release.wait()
+        path = os.path.join(flight_dir, 'out.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'result')
+        return Result(path, {'X-Test': '1'})
+
+    async def scenario():
+        flights = SingleFlight(scratch)
+        dirs = [caller_dir(scratch) for _ in range(3)]
+        calls = [asyncio.create_task(flights.run('key', work_dir, work)) for work_dir in dirs]
+        await asyncio.sleep(0.01)
+        assert flights.in_flight() == 1
+        release.set()
+        results = await asyncio.gather(*calls)
+        assert flights.in_flight() == 0
+        return dirs, results
+
+    dirs, results = asyncio.run(scenario())
+    # In the first caller's directory, on the input already there
+    assert runs == dirs[:1]
+    assert [shared for _, shared in results] == [False, True, True]
+    for work_dir, (result, _) in zip(dirs, results):
+        assert os.path.dirname(result.path) == work_dir
+        with open(result.path, 'rb') as f:
+            assert f.read() == b'result'
+    # Each caller may change its headers without affecting the others
+    assert results[0][0].headers is not results[1][0].headers
+    # The callers' directories are theirs to release
+    assert all(os.path.exists(work_dir) for work_dir in dirs)
+
+
+def test_first_callers_directory_is_kept_until_the_others_have_the_result(scratch):
+    release = asyncio.Event()
+
+    async def work(flight_dir):
+        await release.wait()
+        path = os.path.join(flight_dir, 'out.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'result')
+        return Result(path)
+
+    async def scenario():
+        flights = SingleFlight(scratch)
+        first_dir = caller_dir(scratch)
+        first = asyncio.create_task(flights.run('key', first_dir, work))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flights.run('key', caller_dir(scratch), work))
+        await asyncio.sleep(0.01)
+        # The first caller goes away and releases its directory, as a dropped request does
+        first.cancel()
+        scratch.release(first_dir)
+        assert os.path.exists(first_dir)
+        release.set()
+        result, shared = await follower
+        with open(result.path, 'rb') as f:
+            assert f.read() == b'result'
+        assert not os.path.exists(first_dir)
+
+    asyncio.run(scenario())
+
+
+def test_work_survives_the_caller_that_started_it(scratch):
+    finished = []
+    release = asyncio.Event()
+
+    async def work(flight_dir):
+        await release.wait()
+        path = os.path.join(flight_dir, 'out.pdf')
+        with open(path, 'wb') as f:
+            f.write(b'result')
+        finished.append(path)
+        return Result(path)
+
+    async def scenario():
+        flights = SingleFlight(scratch)
+        leader = asyncio.create_task(flights.run('key', caller_dir(scratch), work))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flights.run('key', caller_dir(scratch), work))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        result, shared = await follower
+        assert shared
+        assert leader.cancelled()
+
+    asyncio.run(scenario())
+    assert len(finished) == 1
+
+
+def test_failures_reach_every_caller(scratch):
+    async def work(flight_dir):
+        await asyncio.sleep(0.01)
+        raise ValueError('broken')
+
+    async def scenario():
+        flights = SingleFlight(scratch)
+        calls = [asyncio.create_task(flights.run('key', caller_dir(scratch), work)) for _ in range(2)]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(scenario())] == [ValueError, ValueError]
+
+
+def test_flight_lock_makes_the_second_holder_wait(tmp_path):
+    order = []
+
+    async def hold(name, delay):
+        await asyncio.sleep(delay)
+        async with flight_lock('key', str(tmp_path)) as waited:
+            order.append((name, waited))
+            await asyncio.sleep(0.2)
+
+    async def scenario():
+        await asyncio.gather(hold('first', 0), hold('second', 0.05))
+
+    asyncio.run(scenario())
+    assert order == [('first', False), ('second', True)]
+    assert os.listdir(tmp_path) == []
+
+
+def test_flight_lock_without_a_directory_never_waits():
+    async def scenario():
+        async with flight_lock('key', None) as waited:
+            return waited
+
+    assert asyncio.run(scenario()) is False
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from backend.uploads import UploadSessions, analyze_pdf_ends
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    return UploadSessions(
+        str(tmp_path / 'uploads'), chunk_size=4, ttl=3600, idle_ttl=600, max_sessions=3, max_per_client=2
+    )
+
+
+def upload(sessions, data: bytes, filename='a.pdf') -> dict:
+    session = sessions.create(filename, len(data), 'client')
+    for index in range(session['chunks']):
+        offset, length = sessions.chunk_span(session, index)
+        with open(sessions.data_path(session['id']), 'r+b') as f:
+            f.seek(offset)
+            f.write(data[offset:offset + length])
+        sessions.mark_received(session['id'], index, 'checksum')
+    return sessions.get(session['id'])
+
+
+def test_chunks_cover_the_file(sessions):
+    session = sessions.create('a.pdf', 10, 'client')
+    assert session['chunks'] == 3
+    assert [sessions.chunk_span(session, index) for index in range(3)] == [(0, 4), (4, 4), (8, 2)]
+    with pytest.raises(HTTPException) as error:
+        sessions.chunk_span(session, 3)
+    assert error.value.status_code == 400
+
+
+def test_tracks_received_chunks(tmp_path):
+    sessions = UploadSessions(
+        str(tmp_path / 'uploads'), chunk_size=1024, ttl=3600, idle_ttl=600, max_sessions=3, max_per_client=2
+    )
+    session = sessions.create('a.pdf', 4096, 'client')
+    for index in (3, 2):
+        session = sessions.mark_received(session['id'], index, 'checksum')
+    assert session['received'] == [2, 3]
+    assert not sessions.ends_received(session)
+    session = sessions.mark_received(session['id'], 0, 'checksum')
+    # The head and the last 2KB are enough to analyze a PDF
+    assert sessions.ends_received(session)
+    sessions.unmark(session['id'], 0)
+    assert sessions.get(session['id'])['received'] == [2, 3]
+
+
+def test_assembles_a_complete_upload(sessions, tmp_path):
+    data = b'%PDF-1.7 data'
+    session = upload(sessions, data)
+    dest = str(tmp_path / 'input.pdf')
+    assert sessions.assemble(session['id'], dest) == hashlib.sha256(data).hexdigest()
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    # The session outlives assembly so a failed finalize can be retried
+    assert sessions.assemble(session['id'], str(tmp_path / 'retry.pdf')) == hashlib.sha256(data).hexdigest()
+
+
+def test_incomplete_upload_is_not_assembled(sessions, tmp_path):
+    session = sessions.create('a.pdf', 10, 'client')
+    sessions.mark_received(session['id'], 0, 'checksum')
+    with pytest.raises(HTTPException) as error:
+        sessions.assemble(session['id'], str(tmp_path / 'input.pdf'))
+    assert error.value.status_code == 409
+
+
+def test_unknown_and_malformed_ids_are_not_found(sessions):
+    for upload_id in ('0' * 32, '../../etc'):
+        with pytest.raises(HTTPException) as error:
+            sessions.get(upload_id)
+        assert error.value.status_code == 404
+
+
+def test_limits_sessions_in_progress(sessions):
+    for client in ('a', 'b', 'c'):
+        sessions.create('a.pdf', 10, client)
+    with pytest.raises(HTTPException) as error:
+        sessions.create('a.pdf', 10, 'd')
+    assert error.value.status_code == 429
+
+
+def test_limits_sessions_per_client(sessions):
+    for _ in range(2):
+        sessions.create('a.pdf', 10, 'busy')
+    with pytest.raises(HTTPException) as error:
+        sessions.create('a.pdf', 10, 'busy')
+    assert error.value.status_code == 429
+    sessions.create('a.pdf', 10, 'other')
+
+
+def test_expired_sessions_are_gone(sessions):
+    session = sessions.create('a.pdf', 10, 'client')
+    sessions.ttl = -1
+    with pytest.raises(HTTPException):
+        sessions.get(session['id'])
+    assert not os.path.exists(os.path.join(sessions.directory, session['id']))
+
+
+def test_idle_sessions_expire(sessions):
+    idle = sessions.create('a.pdf', 10, 'client')
+    active = sessions.create('a.pdf', 10, 'client')
+    sessions.mark_received(active['id'], 0, 'checksum')
+    an_hour_ago = time.time() - 3600
+    for name in ('data', 'chunks'):
+        os.utime(os.path.join(sessions.directory, idle['id'], name), (an_hour_ago, an_hour_ago))
+    # Expired sessions don't count against the client's limit
+    sessions.create('a.pdf', 10, 'client')
+    sessions.sweep()
+    assert not os.path.exists(os.path.join(sessions.directory, idle['id']))
+    assert sessions.get(active['id'])['received'] == [0]
+
+
+def test_analyze_pdf_ends():
+    head = b'%PDF-1.7\n1 0 obj << /Linearized 1 /L 5000 /N 12 >> endobj'
+    tail = b'trailer << /Root 1 0 R >>\nstartxref\n4000\n%%EOF\n'
+    assert analyze_pdf_ends(head, tail, 5000) == {
+        'version': '1.7',
+        'linearized': True,
+        'pages': 12,
+        'xref_offset': 4000,
+        'xref_valid': True,
+        'encrypted': False,
+    }
+    assert analyze_pdf_ends(b'%PDF-1.4', b'startxref\n9000\n%%EOF', 5000)['xref_valid'] is False
@@ -0,0 +1,236 @@
+"""Resumable uploads: files sent as numbered chunks and assembled in place on disk."""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from .scratch import SCRATCH_STALE_AGE, SCRATCH_SWEEP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# Enough of each end of a PDF to hold the header, linearization dictionary and trailer
+PDF_HEAD_BYTES = 1024
+PDF_TAIL_BYTES = 2048
+# Block size for hashing an assembled file
+READ_SIZE = 1024 * 1024
+
+
+def analyze_pdf_ends(head: bytes, tail: bytes, size: int) -> dict:
+    """What the header and trailer of a PDF tell about it before the middle arrives.
+
+    Linearized PDFs give their page count in the first object.
+    """
+    version = re.match(rb'%PDF-(\d\.\d)', head)
+    linearized = re.search(rb'/Linearized\s', head) is not None
+    pages = re.search(rb'/N\s+(\d+)', head) if linearized else None
+    startxref = re.findall(rb'startxref\s+(\d+)', tail)
+    xref_offset = int(startxref[-1]) if startxref else None
+    return {
+        'version': version.group(1).decode() if version else None,
+        'linearized': linearized,
+        'pages': int(pages.group(1)) if pages else None,
+        'xref_offset': xref_offset,
+        'xref_valid': xref_offset is not None and xref_offset < size,
+        'encrypted': b'/Encrypt' in tail,
+    }
+
+
+class UploadSessions:
+    """Files uploaded as numbered chunks, assembled in place on disk.
+
+    Each session is a directory holding the file being assembled (every chunk
+    is written straight to its offset), session.json and one marker per
+    received chunk. Nothing is kept in memory, so the chunks of one upload can
+    land on different worker processes. A session expires ttl seconds after
+    it starts, or idle_ttl seconds after a chunk last arrived. All methods
+    are blocking; call via asyncio.to_thread.
+    """
+
+    def __init__(
+        self, directory: str, chunk_size: int, ttl: int, idle_ttl: int, max_sessions: int, max_per_client: int
+    ):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_per_client = max_per_client
+
+    def _dir(self, upload_id: str) -> str:
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise HTTPException(status_code=404, detail="Upload not found")
+        return os.path.join(self.directory, upload_id)
+
+    def _active_at(self, session_dir: str) -> float:
+        """When a session last changed: a chunk written, or marked received."""
+        return max(os.stat(os.path.join(session_dir, name)).st_mtime for name in ('data', 'chunks'))
+
+    def expires_at(self, session: dict) -> float:
+        return min(session['created_at'] + self.ttl, session['active_at'] + self.idle_ttl)
+
+    def _load(self, session_dir: str) -> dict:
+        with open(os.path.join(session_dir, 'session.json')) as f:
+            session = json.load(f)
+        session['active_at'] = self._active_at(session_dir)
+        return session
+
+    def _live_sessions(self) -> list[dict]:
+        sessions = []
+        for entry in os.scandir(self.directory):
+            try:
+                session = self._load(entry.path)
+            except (OSError, ValueError):
+                continue
+            if time.time() < self.expires_at(session):
+                sessions.append(session)
+        return sessions
+
+    def create(self, filename: str, size: int, client: str) -> dict:
+        """Start a session for client, the caller's address, within the overall and per-client limits."""
+        os.makedirs(self.directory, exist_ok=True)
+        sessions = self._live_sessions()
+        if len(sessions) >= self.max_sessions:
+            raise HTTPException(status_code=429, detail="Too many uploads in progress. Try again later.")
+        if sum(1 for session in sessions if session.get('client') == client) >= self.max_per_client:
+            raise HTTPException(
+                status_code=429, detail="Too many uploads in progress. Finish or delete one before starting another."
+            )
+
+        session = {
+            'id': uuid.uuid4().hex,
+            'filename': filename,
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'chunks': max(1, -(-size // self.chunk_size)),
+            'client': client,
+            'created_at': time.time(),
+        }
+        session_dir = os.path.join(self.directory, session['id'])
+        os.makedirs(os.path.join(session_dir, 'chunks'))
+        with open(os.path.join(session_dir, 'data'), 'wb') as f:
+            f.truncate(size)
+        with open(os.path.join(session_dir, 'session.json'), 'w') as f:
+            json.dump(session, f)
+        return {**session, 'active_at': session['created_at']}
+
+    def get(self, upload_id: str) -> dict:
+        session_dir = self._dir(upload_id)
+        try:
+            session = self._load(session_dir)
+            session['received'] = sorted(int(name) for name in os.listdir(os.path.join(session_dir, 'chunks')))
+        except (OSError, ValueError):
+            raise HTTPException(status_code=404, detail="Upload not found")
+        if time.time() >= self.expires_at(session):
+            self.delete(upload_id)
+            raise HTTPException(status_code=404, detail="Upload not found")
+        try:
+            with open(os.path.join(session_dir, 'analysis.json')) as f:
+                session['analysis'] = json.load(f)
+        except (OSError, ValueError):
+            session['analysis'] = None
+        return session
+
+    def delete(self, upload_id: str):
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+
+    def chunk_span(self, session: dict, index: int) -> tuple[int, int]:
+        """Returns (offset, length) of a chunk."""
+        if not 0 <= index < session['chunks']:
+            raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {session['chunks'] - 1}")
+        offset = index * session['chunk_size']
+        return offset, min(session['chunk_size'], session['size'] - offset)
+
+    def data_path(self, upload_id: str) -> str:
+        return os.path.join(self._dir(upload_id), 'data')
+
+    def mark_received(self, upload_id: str, index: int, checksum: str) -> dict:
+        with open(os.path.join(self._dir(upload_id), 'chunks', str(index)), 'w') as f:
+            f.write(checksum)
+        return self.get(upload_id)
+
+    def unmark(self, upload_id: str, index: int):
+        try:
+            os.remove(os.path.join(self._dir(upload_id), 'chunks', str(index)))
+        except FileNotFoundError:
+            pass
+
+    def read(self, upload_id: str, offset: int, length: int) -> bytes:
+        with open(self.data_path(upload_id), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def save_analysis(self, upload_id: str, analysis: dict):
+        path = os.path.join(self._dir(upload_id), 'analysis.json')
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(analysis, f)
+        os.replace(tmp_path, path)
+
+    def ends_received(self, session: dict) -> bool:
+        """Whether the chunks holding the head and tail of the file have arrived."""
+        received = set(session['received'])
+        tail_start = max(0, session['size'] - PDF_TAIL_BYTES) // session['chunk_size']
+        return 0 in received and received.issuperset(range(tail_start, session['chunks']))
+
+    def assemble(self, upload_id: str, dest_path: str) -> str:
+        """Copy a complete upload to dest_path. Returns its sha256.
+
+        The session stays until deleted, so a finalize whose operation fails
+        can be retried. The data is copied rather than linked so a chunk
+        resent meanwhile can't change an operation's input under it.
+        """
+        session = self.get(upload_id)
+        missing = session['chunks'] - len(session['received'])
+        if missing:
+            raise HTTPException(status_code=409, detail=f"Upload is missing {missing} chunk(s)")
+
+        try:
+            source = open(self.data_path(upload_id), 'rb')
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        digest = hashlib.sha256()
+        with source, open(dest_path, 'wb') as dest:
+            while chunk := source.read(READ_SIZE):
+                digest.update(chunk)
+                dest.write(chunk)
+        return digest.hexdigest()
+
+    def sweep(self):
+        """Remove expired sessions, and directories left half-created."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                try:
+                    expired = time.time() >= self.expires_at(self._load(entry.path))
+                except (OSError, ValueError):
+                    expired = time.time() - entry.stat().st_mtime > SCRATCH_STALE_AGE
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    async def start(self):
+        self._sweeper_task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        self._sweeper_task.cancel()
+        await asyncio.gather(self._sweeper_task, return_exceptions=True)
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(SCRATCH_SWEEP_INTERVAL)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.warning(f"Uploads: Sweep failed: {e}")
@@ -5,7 +5,7 @@ import { useTranslations } from 'next-intl';
 import type { WorkflowStep, WorkflowProgress } from '@/lib/workflow-engine';
 import { executeWorkflow } from '@/lib/workflow-engine';
 import { stepRegistry } from '@/lib/workflow-steps';
-import { createStepExecutors } from '@/lib/workflow-steps';
+import { createStepExecutors, createPipelineExecutor } from '@/lib/workflow-steps';
 import { downloadPDF } from '@/lib/pdf-operations';
 import { usePDFPreview } from '@/hooks/usePDFPreview';
 import { PDFPreviewModal } from '@/components/PDFPreviewModal';
@@ -150,9 +150,15 @@ export function WorkflowExecutionWizard({ workflowName, initialSteps, onBack }:
       const pdfData = new Uint8Array(arrayBuffer);
       const executors = createStepExecutors();
 
-      const result = await executeWorkflow(pdfData, steps, executors, (p) => {
-        setProgress({ ...p });
-      });
+      const result = await executeWorkflow(
+        pdfData,
+        steps,
+        executors,
+        (p) => {
+          setProgress({ ...p });
+        },
+        createPipelineExecutor()
+      );
 
       setResultData(result);
       setPhase('done');
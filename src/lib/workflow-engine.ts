@@ -50,11 +50,18 @@ export interface StepExecutor {
   execute: (pdfData: Uint8Array, config: Record<string, string | number | boolean>) => Promise<Uint8Array>;
 }
 
+// Runs a run of consecutive steps in one call (e.g. one backend request)
+export interface PipelineExecutor {
+  canRun: (type: StepType) => boolean;
+  execute: (pdfData: Uint8Array, steps: WorkflowStep[]) => Promise<Uint8Array>;
+}
+
 export async function executeWorkflow(
   pdfData: Uint8Array,
   steps: WorkflowStep[],
   executors: Record<StepType, StepExecutor>,
-  onProgress: ProgressCallback
+  onProgress: ProgressCallback,
+  pipeline?: PipelineExecutor
 ): Promise<Uint8Array> {
   const progress: WorkflowProgress = {
     currentStepIndex: 0,
@@ -66,27 +73,49 @@ export async function executeWorkflow(
 
   let currentData = pdfData;
 
-  for (let i = 0; i < steps.length; i++) {
-    const step = steps[i];
+  let i = 0;
+  while (i < steps.length) {
+    // Group consecutive steps the pipeline can run so they share one round trip
+    let end = i + 1;
+    if (pipeline && pipeline.canRun(steps[i].type)) {
+      while (end < steps.length && pipeline.canRun(steps[end].type)) {
+        end++;
+      }
+    }
+    const group = steps.slice(i, end);
+
     progress.currentStepIndex = i;
-    progress.steps[i] = { stepId: step.id, status: 'running' };
+    for (let j = i; j < end; j++) {
+      progress.steps[j] = { stepId: steps[j].id, status: 'running' };
+    }
     onProgress({ ...progress, steps: [...progress.steps] });
 
     try {
-      const executor = executors[step.type];
-      if (!executor) {
-        throw new Error(`No executor found for step type: ${step.type}`);
+      if (group.length > 1 && pipeline) {
+        currentData = await pipeline.execute(currentData, group);
+      } else {
+        const step = steps[i];
+        const executor = executors[step.type];
+        if (!executor) {
+          throw new Error(`No executor found for step type: ${step.type}`);
+        }
+        currentData = await executor.execute(currentData, step.config);
+      }
+      for (let j = i; j < end; j++) {
+        progress.steps[j] = { stepId: steps[j].id, status: 'completed' };
       }
-      currentData = await executor.execute(currentData, step.config);
-      progress.steps[i] = { stepId: step.id, status: 'completed' };
       onProgress({ ...progress, steps: [...progress.steps] });
     } catch (err) {
       const errorMessage = err instanceof Error ? err.message : 'Unknown error';
-      progress.steps[i] = { stepId: step.id, status: 'error', error: errorMessage };
+      for (let j = i; j < end; j++) {
+        progress.steps[j] = { stepId: steps[j].id, status: 'error', error: errorMessage };
+      }
       progress.error = errorMessage;
       onProgress({ ...progress, steps: [...progress.steps] });
       throw err;
     }
+
+    i = end;
   }
 
   progress.isComplete = true;
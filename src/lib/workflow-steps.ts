@@ -9,7 +9,7 @@ import {
   flattenPDF,
   loadPDF,
 } from '@/lib/pdf-operations';
-import type { StepType, StepExecutor } from './workflow-engine';
+import type { StepType, StepExecutor, PipelineExecutor } from './workflow-engine';
 
 export type ConfigFieldType = 'select' | 'text' | 'number' | 'color' | 'range' | 'password';
 
@@ -351,6 +351,38 @@ export function createStepExecutors(): Record<StepType, StepExecutor> {
   };
 }
 
+// Sends consecutive backend steps to /api/pipeline so they cost one upload/download
+export function createPipelineExecutor(): PipelineExecutor {
+  return {
+    canRun(type) {
+      return Boolean(stepRegistry[type]?.isBackend);
+    },
+    async execute(pdfData, steps) {
+      const apiUrl = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
+      const blob = new Blob([pdfData as unknown as BlobPart], { type: 'application/pdf' });
+      const formData = new FormData();
+      formData.append('file', blob, 'document.pdf');
+      formData.append(
+        'steps',
+        JSON.stringify(steps.map((step) => ({ ...step.config, operation: step.type })))
+      );
+
+      const response = await fetch(`${apiUrl}/api/pipeline`, {
+        method: 'POST',
+        body: formData,
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.detail || 'Processing failed');
+      }
+
+      const resultBlob = await response.blob();
+      return new Uint8Array(await resultBlob.arrayBuffer());
+    },
+  };
+}
+
 export const allStepTypes: StepType[] = [
   'rotate',
   'reverse',